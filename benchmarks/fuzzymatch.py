@@ -0,0 +1,104 @@
+import pandas as pd
+import numpy as np
+import argparse
+import contextlib
+import io
+import time
+import gbif2wcvp
+from benchmarks import synthetic
+
+# Throughput of the fuzzy match stage of gbif2wcvp, for names which are
+# misspellings (one or two edits after the genus) of WCVP names and names
+# which are not in WCVP at all. For a sample of the names, the matches are
+# checked against those found by comparing every pair of names in the genus.
+#
+# Run from the repository root: python -m benchmarks.fuzzymatch
+
+def misspell(name, rng, edits):
+    # Apply random substitutions, deletions and insertions after the genus
+    genus, _, rest = name.partition(' ')
+    rest = list(rest)
+    for _ in range(edits):
+        position = rng.integers(0, len(rest))
+        edit = rng.integers(0, 3)
+        letter = 'abcdefghiklmnoprstuvy'[rng.integers(0, 21)]
+        if edit == 0:
+            rest[position] = letter
+        elif edit == 1 and len(rest) > 1:
+            del rest[position]
+        else:
+            rest.insert(position, letter)
+    return genus + ' ' + ''.join(rest)
+
+def makeMisspelledTaxa(df_wcvp_source, n, rng, misspelled_fraction=0.5):
+    # GBIF names, some misspelled from WCVP names, and some not in WCVP
+    df_gbif = synthetic.makeGbifTaxa(df_wcvp_source, n, rng)
+    misspelled = rng.choice(n, int(n * misspelled_fraction), replace=False)
+    names = (df_gbif.genericName + ' ' + df_gbif.specificEpithet).to_numpy()
+    for position in misspelled:
+        names[position] = misspell(names[position], rng, rng.integers(1, 3))
+    df_gbif['specificEpithet'] = pd.Series(names).str.partition(' ')[2]
+    return gbif2wcvp.prepareGbifNames(df_gbif)
+
+def bruteForceMatches(df_gbif, df_wcvp, positions, max_distance, max_relative_distance):
+    # The closest WCVP names (as sets of plant_name_id) for each name, found
+    # by comparing every WCVP name in the same genus
+    df_block = df_wcvp[['genericName','taxon_name_minus_authors','plant_name_id']].dropna()
+    blocks = {genus: df for genus, df in df_block.groupby('genericName')}
+    matches = dict()
+    for position in positions:
+        genus = df_gbif.genericName.iat[position]
+        name = df_gbif.name.iat[position]
+        rest = name[len(genus) + 1:]
+        limit = min(max_distance, int(np.floor(max_relative_distance * len(rest))))
+        best = limit + 1
+        ids = set()
+        if genus in blocks:
+            for wcvp_name, plant_name_id in zip(blocks[genus].taxon_name_minus_authors, blocks[genus].plant_name_id):
+                if not wcvp_name.startswith(genus + ' '):
+                    continue
+                distance = gbif2wcvp.boundedLevenshtein(rest, wcvp_name[len(genus) + 1:], limit)
+                if distance < best:
+                    best, ids = distance, {plant_name_id}
+                elif distance == best and distance <= limit:
+                    ids.add(plant_name_id)
+        matches[df_gbif.taxonID.iat[position]] = ids
+    return matches
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--wcvp_size', default=200000, type=int)
+    parser.add_argument('--sizes', type=str, default='10000,50000,200000')
+    parser.add_argument('--max_distance', default=2, type=int)
+    parser.add_argument('--max_relative_distance', default=0.2, type=float)
+    parser.add_argument('--check_size', default=500, type=int, help='Number of names to check against pairwise comparison')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    df_wcvp_source = synthetic.makeWcvpNames(args.wcvp_size, rng)
+    df_wcvp = gbif2wcvp.prepareWcvpNames(df_wcvp_source.copy())
+    encodings = dict()
+    block_encoding = gbif2wcvp.encodeColumn(df_wcvp, 'genericName', encodings)
+    accepted_positions = gbif2wcvp.buildAcceptedIndex(df_wcvp)
+
+    print('{:>10} {:>10} {:>10} {:>12} {:>10}'.format('names', 'matched', 'seconds', 'names/s', 'checked'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        df_gbif = makeMisspelledTaxa(df_wcvp_source, size, rng)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            df_match = gbif2wcvp.matchNamesFuzzily(df_gbif, df_wcvp, block_encoding, accepted_positions
+                                                , id_col='taxonID'
+                                                , max_distance=args.max_distance
+                                                , max_relative_distance=args.max_relative_distance)
+        elapsed = time.perf_counter() - start
+        matched = df_match[df_match.match_id.notnull()].original_id.nunique()
+        # Check a sample of names against pairwise comparison
+        positions = rng.choice(len(df_gbif), min(args.check_size, len(df_gbif)), replace=False)
+        expected = bruteForceMatches(df_gbif, df_wcvp, positions, args.max_distance, args.max_relative_distance)
+        found = df_match[df_match.match_id.notnull()].groupby('original_id').match_id.agg(set)
+        agreed = sum(found.get(taxon_id, set()) == ids for taxon_id, ids in expected.items())
+        print('{:>10} {:>10} {:>10.3f} {:>12.0f} {:>10}'.format(size, matched, elapsed, size / elapsed, '{}/{}'.format(agreed, len(expected))))
+
+if __name__ == '__main__':
+    main()
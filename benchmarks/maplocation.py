@@ -0,0 +1,55 @@
+import pandas as pd
+import numpy as np
+import argparse
+import time
+import types2publisherlocations
+from benchmarks import synthetic
+
+# Compares types2publisherlocations.mapLocation with the previous
+# implementation (kept below), which scanned the whole lookup table once per
+# distinct value to be located. Both must give the same result.
+#
+# Run from the repository root: python -m benchmarks.maplocation
+
+def mapLocationLegacy(df, local_column, df_lookup, lookup_column, lat_column='latitude', long_column='longitude'):
+    location_mapper = dict()
+    coordinates_missing_mask=df.latitude.isnull()&df.longitude.isnull()
+    for local_value in df[coordinates_missing_mask][local_column].unique():
+        mask = (df_lookup[lookup_column]==local_value)
+        if len(df_lookup[mask]) > 0:
+            location_mapper[local_value] = (df_lookup[mask].head(n=1)[lat_column].iloc[0],df_lookup[mask].head(n=1)[long_column].iloc[0])
+    df.loc[coordinates_missing_mask,'location_temp']=df[coordinates_missing_mask][local_column].map(location_mapper)
+    coordinates_missing_mask = df.location_temp.notnull()
+    df.loc[coordinates_missing_mask,'latitude']=df[coordinates_missing_mask].location_temp.apply(lambda x: x[0])
+    df.loc[coordinates_missing_mask,'longitude']=df[coordinates_missing_mask].location_temp.apply(lambda x: x[1])
+    df.drop(columns=['location_temp'],inplace=True)
+    return df
+
+def timeMapping(map_location, df, df_ih):
+    df = df.copy()
+    start = time.perf_counter()
+    for (local_column, ih_column) in {'title':'organization','city':'physicalCity'}.items():
+        df = map_location(df, local_column, df_ih, ih_column)
+    return df, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ih_size', default=4000, type=int)
+    parser.add_argument('--publisher_sizes', type=str, default='500,2000,8000')
+    parser.add_argument('--rows', default=100000, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    df_ih = synthetic.makeIhInstitutions(args.ih_size, rng)
+
+    print('{:>12} {:>12} {:>10} {:>10}'.format('publishers', 'located', 'legacy_s', 'index_s'))
+    for n_publishers in [int(size) for size in args.publisher_sizes.split(',')]:
+        df = synthetic.makePublisherLocations(args.rows, df_ih, rng, n_publishers=n_publishers)
+        df_legacy, legacy_elapsed = timeMapping(mapLocationLegacy, df, df_ih)
+        df_index, index_elapsed = timeMapping(types2publisherlocations.mapLocation, df, df_ih)
+        pd.testing.assert_frame_equal(df_legacy, df_index, check_dtype=False)
+        print('{:>12} {:>12} {:>10.3f} {:>10.3f}'.format(n_publishers, df_index.latitude.notnull().sum(), legacy_elapsed, index_elapsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import pandas as pd
+import numpy as np
+import argparse
+import contextlib
+import io
+import time
+import gbif2wcvp
+from benchmarks import synthetic
+
+# Times each match stage of gbif2wcvp for increasing numbers of names matched
+# in the first stage, while the number of names left for later stages is held
+# constant. Later stages should cost the same whatever the size of the output
+# of earlier stages.
+#
+# Run from the repository root: python -m benchmarks.matchstages
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--wcvp_size', default=200000, type=int)
+    parser.add_argument('--unmatched_size', default=50000, type=int)
+    parser.add_argument('--prior_sizes', type=str, default='10000,100000,400000')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    df_wcvp_source = synthetic.makeWcvpNames(args.wcvp_size, rng)
+    df_wcvp = gbif2wcvp.prepareWcvpNames(df_wcvp_source.replace({np.nan:None}))
+    df_unmatched = synthetic.makeGbifTaxa(df_wcvp_source, args.unmatched_size, rng, matched_fraction=0)
+
+    print('{:>12} {:>6} {:>12} {:>10}'.format('prior_size', 'stage', 'matched', 'seconds'))
+    for prior_size in [int(size) for size in args.prior_sizes.split(',')]:
+        # Names which all match in the first stage, plus the constant set of
+        # names which are left over for the later stages
+        df_prior = synthetic.makeGbifTaxa(df_wcvp_source, prior_size, rng, matched_fraction=1, author_variation=0, family_variation=0, first_taxon_id=args.unmatched_size + 1)
+        df_gbif = gbif2wcvp.prepareGbifNames(pd.concat([df_prior, df_unmatched], ignore_index=True))
+        with contextlib.redirect_stdout(io.StringIO()):
+            homonym_mask = gbif2wcvp.findHomonyms(df_gbif)
+        stages = gbif2wcvp.matchStages(df_gbif, df_wcvp, gbif2wcvp.MATCH_CONFIGURATIONS, homonym_mask)
+        stage = 0
+        while True:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                df_match = next(stages, None)
+            elapsed = time.perf_counter() - start
+            if df_match is None:
+                break
+            print('{:>12} {:>6} {:>12} {:>10.3f}'.format(prior_size, stage, df_match.taxonID.nunique(), elapsed))
+            stage += 1
+
+if __name__ == '__main__':
+    main()
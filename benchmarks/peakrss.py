@@ -0,0 +1,34 @@
+import json
+import os
+import runpy
+import sys
+from instrumentation import peakRssMb
+
+# Runs a script (or, with -m, a module) as __main__ and then writes its peak
+# RSS to a JSON file. The peak is read by the process itself, as the
+# ru_maxrss of a child process (as returned by wait4) includes the memory of
+# the parent it was forked from. (The instrumented scripts reset the high
+# water mark of the RSS for each span, peakRssMb includes that before the
+# resets.)
+#
+# Usage: python -m benchmarks.peakrss outputfile script.py [args...]
+#        python -m benchmarks.peakrss outputfile -m module [args...]
+
+def main():
+    outputfile = sys.argv[1]
+    args = sys.argv[2:]
+    try:
+        if args[0] == '-m':
+            sys.argv = args[1:]
+            runpy.run_module(args[1], run_name='__main__', alter_sys=True)
+        else:
+            sys.argv = args
+            # As when run directly, imports are first looked for beside the script
+            sys.path[0] = os.path.dirname(os.path.abspath(args[0]))
+            runpy.run_path(args[0], run_name='__main__')
+    finally:
+        with open(outputfile, 'w') as f:
+            json.dump({'peak_rss_mb': peakRssMb()}, f)
+
+if __name__ == '__main__':
+    main()
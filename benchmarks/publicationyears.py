@@ -0,0 +1,84 @@
+import pandas as pd
+import numpy as np
+import argparse
+import time
+import gbif2wcvp
+from benchmarks import synthetic
+
+# Throughput of extracting the year of publication of names from WCVP
+# first_published values, per value (cleanPublicationYear, as applied before)
+# and per column (cleanPublicationYears), for columns drawn from a set of
+# distinct values as in WCVP. The results of the two are first checked to be
+# identical over a corpus of values: hand written edge cases, and values
+# made at random from the parts of publication dates.
+#
+# Run from the repository root: python -m benchmarks.publicationyears
+
+EDGE_CASES = synthetic.FIRST_PUBLISHED + ['(1890 publ. 1891)', '(1999 publ. 20000)', '(1753 publ. 17)', '(1999) publ. 2000'
+                                          , '(1999 publ. 2000 publ. 2001)', '(1999 publ.  2000)', 'publ. publ. 1999', 'xpubl. publ. 1999'
+                                          , 'publ. 1999', '1999', '1699', '(1700)', '(2029)', '(2030)', '()', '', ' 1999', '1999 ', '19x9'
+                                          , '1999\n', '(1999\n)', 'x publ. 1999\n', 'x publ. \n1999', '(１９９９)', '(1832 publ. 1833?)']
+
+# Parts from which random first_published values are made
+PARTS = ['(', ')', ' ', 'publ. ', 'publ.', 'publ', '1753', '1891', '1999', '2029', '2030', '1699', '17', '20', '?', 'x', '\n']
+
+def makeCorpus(n, rng):
+    # The edge cases, and n values each of one to six random parts
+    counts = rng.integers(1, 7, n)
+    parts = np.array(PARTS, dtype=object)
+    return EDGE_CASES + [''.join(parts[rng.integers(0, len(parts), count)]) for count in counts]
+
+def makeFirstPublished(size, n_distinct, rng):
+    # A column of size values drawn from n_distinct dates, some published a
+    # year after the date given, and some missing
+    years = rng.integers(1753, 2023, n_distinct)
+    dates = ['({})'.format(year) if rng.random() < 0.9 else '({} publ. {})'.format(year, year + 1) for year in years]
+    dates = np.array(dates + ['sine anno', None], dtype=object)
+    return pd.Series(dates[rng.integers(0, len(dates), size)])
+
+def cleanPublicationYearsPerValue(s):
+    # As applied before: each value in turn, with missing values left missing
+    mask = s.notnull()
+    years = pd.Series(np.nan, index=s.index, dtype=object)
+    years[mask] = s[mask].apply(gbif2wcvp.cleanPublicationYear)
+    return years
+
+def asYears(s):
+    return [None if pd.isna(year) else int(year) for year in s]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=str, default='100000,1000000', help='Comma separated list of the column lengths to time')
+    parser.add_argument('--distinct', default=5000, type=int, help='Number of distinct first_published values in each column')
+    parser.add_argument('--corpus_size', default=100000, type=int, help='Number of random values to check, besides the edge cases')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    corpus = pd.Series(makeCorpus(args.corpus_size, rng), dtype=object)
+    expected = [gbif2wcvp.cleanPublicationYear(value) if value is not None else None for value in corpus]
+    found = asYears(gbif2wcvp.cleanPublicationYears(corpus))
+    mismatches = [(value, year, found_year) for value, year, found_year in zip(corpus, expected, found) if year != found_year]
+    print('Checked {} values ({} distinct, {} with a year): {} mismatches'.format(len(corpus), corpus.nunique(), sum(year is not None for year in expected), len(mismatches)))
+    for mismatch in mismatches[:10]:
+        print('  {!r}: expected {}, found {}'.format(*mismatch))
+    if mismatches:
+        raise SystemExit(1)
+
+    print('{:>10} {:>12} {:>12} {:>12} {:>12} {:>10}'.format('values', 'dtype', 'per value s', 'column s', 'speedup', 'identical'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        s = makeFirstPublished(size, args.distinct, rng)
+        # As read by gbif2wcvp (see tableio.WCVP_NAMES_SCHEMA), and as text
+        for dtype in ['category', 'object']:
+            s_typed = s.astype(dtype)
+            start = time.perf_counter()
+            years_per_value = cleanPublicationYearsPerValue(s_typed)
+            per_value_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            years = gbif2wcvp.cleanPublicationYears(s_typed)
+            column_seconds = time.perf_counter() - start
+            identical = asYears(years) == asYears(years_per_value)
+            print('{:>10} {:>12} {:>12.3f} {:>12.3f} {:>12.1f} {:>10}'.format(size, dtype, per_value_seconds, column_seconds, per_value_seconds / column_seconds, str(identical)))
+
+if __name__ == '__main__':
+    main()
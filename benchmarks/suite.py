@@ -0,0 +1,191 @@
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks import synthetic
+from gbifregistry import OrganizationCache
+
+# Runs the pipeline scripts on synthetic inputs generated at each of a list
+# of scales, recording the wall and CPU time and peak RSS of each, and those
+# of each of their sections. Each script is run in its own process, as it
+# would be from the Makefile. The results are written as JSON, so that runs
+# on different commits can be compared (with --compare).
+#
+# Run from the repository root: python -m benchmarks.suite
+
+# The scale is the number of rows of the GBIF backbone taxonomy (Taxon.tsv),
+# the other inputs are sized relative to this
+WCVP_NAMES_RATIO=0.2
+OCCURRENCES_RATIO=0.5
+
+PERIODS='all,cbd:1992,nagoya:2014'
+
+GBIF_TAXON_COLUMNS='taxonID,scientificName,genericName,specificEpithet,taxonRank,family'
+
+# Stages in run order: name, and the command line (as a module to run, and
+# its arguments) with file names relative to the data directory. The scripts
+# which are instrumented (see instrumentation.py) write the time and memory
+# of each of their sections to <name>-spans.json
+STAGES=[('filtergbif', ['filtergbif.py', 'Taxon.tsv', '--removeHybrids', '--usecols', GBIF_TAXON_COLUMNS, '--spans_file', 'filtergbif-spans.json', 'Taxon-Tracheophyta.tsv'])
+        ,('gbif2wcvp', ['gbif2wcvp.py', 'Taxon-Tracheophyta.tsv', 'wcvp_names.txt', '--spans_file', 'gbif2wcvp-spans.json', 'gbif2wcvp.csv'])
+        ,('types2publisherlocations', ['types2publisherlocations.py', 'gbif-types.zip', 'ih.txt', 'cities.txt', '--registry_cache', 'registry-cache', '--per_publisher', '--spans_file', 'types2publisherlocations-spans.json', 'gbif-typesloc.zip'])
+        ,('gadm2tdwg', ['gadm2tdwg.py', 'gadm.gpkg', 'tdwg.json', 'gadm-tdwg.parquet'])
+        ,('taxa2gbiftypeavailability', ['taxa2gbiftypeavailability.py', 'gbif2wcvp.csv', 'gbif-types.zip', '--periods={}'.format(PERIODS), '--spans_file', 'taxa2gbiftypeavailability-spans.json', 'taxa2gbiftypeavailability.csv', 'taxa2gbiftypeavailability.yaml'])
+        ,('taxa2nativerangetypeavailability', ['taxa2nativerangetypeavailability.py', 'gbif2wcvp.csv', 'wcvp_distribution.txt', 'gbif-types.zip', 'gbif-typesloc.zip', 'gadm.gpkg', 'tdwg.json', '--gadm_tdwg_lookup_file', 'gadm-tdwg.parquet', '--periods={}'.format(PERIODS), '--spans_file', 'taxa2nativerangetypeavailability-spans.json', 'taxa2nativerangetypeavailability.csv', 'taxa2nativerangetypeavailability.yaml'])]
+
+REPOSITORY_DIR=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=str, default='10000,100000', help='Comma separated list of the numbers of GBIF backbone rows to generate inputs for')
+    parser.add_argument('--stages', type=str, default=None, help='Comma separated list of the stages to run (each reads the outputs of those before it), defaults to all: {}'.format(','.join(name for name, _ in STAGES)))
+    parser.add_argument('--datadir', type=str, default=None, help='Directory to generate the inputs in (a subdirectory per scale), defaults to a temporary directory which is removed afterwards')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--compare', type=str, default=None, help='Path to the JSON output of a previous run, to compare the results with')
+    parser.add_argument("outputfile", type=str, help='Path to JSON file to write the results to')
+    args = parser.parse_args()
+
+    stage_names = [name for name, _ in STAGES]
+    if args.stages is not None:
+        stage_names = args.stages.split(',')
+        unknown = [name for name in stage_names if name not in dict(STAGES)]
+        if unknown:
+            parser.error('Unknown stages: {}'.format(','.join(unknown)))
+
+    datadir = args.datadir if args.datadir is not None else tempfile.mkdtemp(prefix='benchmarks-')
+    results = {'environment': describeEnvironment(), 'seed': args.seed, 'scales': []}
+    try:
+        for scale in [int(scale) for scale in args.scales.split(',')]:
+            scaledir = os.path.join(datadir, str(scale))
+            os.makedirs(scaledir, exist_ok=True)
+            start = time.perf_counter()
+            inputs = writeInputs(scaledir, scale, np.random.default_rng(args.seed))
+            print('Generated inputs for scale {} in {:.1f}s: {}'.format(scale, time.perf_counter() - start, inputs))
+            scale_results = {'scale': scale, 'inputs': inputs, 'stages': []}
+            for name, command in STAGES:
+                if name not in stage_names:
+                    continue
+                stage_result = runStage(name, command, scaledir)
+                spans_filepath = os.path.join(scaledir, '{}-spans.json'.format(name))
+                if stage_result['returncode'] == 0 and os.path.exists(spans_filepath):
+                    with open(spans_filepath) as f:
+                        stage_result['spans'] = json.load(f)['spans']
+                print('{:>10} {:<34} {:>10.3f}s {:>10.3f}s cpu {:>8.0f}MB{}'.format(scale, name, stage_result['seconds'], stage_result['cpu_seconds'], stage_result['peak_rss_mb'], '' if stage_result['returncode'] == 0 else ' FAILED, see {}'.format(stage_result['log'])))
+                scale_results['stages'].append(stage_result)
+            results['scales'].append(scale_results)
+    finally:
+        if args.datadir is None:
+            shutil.rmtree(datadir, ignore_errors=True)
+
+    with open(args.outputfile, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Wrote results to {}'.format(args.outputfile))
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compareResults(json.load(f), results)
+
+def describeEnvironment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit
+            ,'python': platform.python_version()
+            ,'pandas': pd.__version__
+            ,'numpy': np.__version__
+            ,'platform': platform.platform()
+            ,'cpu_count': os.cpu_count()}
+
+def writeInputs(datadir, scale, rng):
+    # Writes each of the pipeline input files to datadir, as downloaded (see
+    # the Makefile), and returns the number of rows of each
+    n_wcvp = max(1000, int(scale * WCVP_NAMES_RATIO))
+    n_occurrences = max(1000, int(scale * OCCURRENCES_RATIO))
+    n_publishers = min(5000, max(100, scale // 1000))
+    n_ih = min(10000, max(500, scale // 1000))
+
+    df_wcvp = synthetic.makeWcvpNames(n_wcvp, rng)
+    df_gbif = synthetic.makeGbifBackbone(df_wcvp, scale, rng)
+    df_ih = synthetic.makeIhInstitutions(n_ih, rng)
+    df_publ = synthetic.makePublishers(df_ih, rng, n_publishers=n_publishers)
+    df_occ = synthetic.makeTypeOccurrences(df_gbif, df_publ.publishingOrgKey, n_occurrences, rng)
+    df_gn = synthetic.makeGeonamesCities(df_publ.country.dropna().unique(), rng)
+    df_tdwg = synthetic.makeTdwgAreas()
+    df_gadm = synthetic.makeGadmUnits()
+    df_dist = synthetic.makeWcvpDistributions(df_wcvp, df_tdwg, rng)
+
+    df_gbif.to_csv(os.path.join(datadir, 'Taxon.tsv'), sep='\t', index=False)
+    df_wcvp.astype({'accepted_plant_name_id': 'Int64'}).to_csv(os.path.join(datadir, 'wcvp_names.txt'), sep='|', index=False)
+    df_dist.to_csv(os.path.join(datadir, 'wcvp_distribution.txt'), sep='|', index=False)
+    df_occ.astype({'year': 'Int64'}).to_csv(os.path.join(datadir, 'gbif-types.zip'), sep='\t', index=False, compression={'method': 'zip', 'archive_name': 'occurrence.txt'})
+    df_ih.to_csv(os.path.join(datadir, 'ih.txt'), index=False)
+    df_gn.to_csv(os.path.join(datadir, 'cities.txt'), sep='\t', index=False, header=False)
+    df_tdwg.to_file(os.path.join(datadir, 'tdwg.json'), driver='GeoJSON')
+    df_gadm.to_file(os.path.join(datadir, 'gadm.gpkg'), layer='ADM_1', driver='GPKG')
+    # The registry lookups are all cached, so none are made over the network
+    cache = OrganizationCache(os.path.join(datadir, 'registry-cache'))
+    for key, data in synthetic.registryEntries(df_publ).items():
+        cache.put(key, data)
+
+    return {'gbif_taxa': len(df_gbif)
+            ,'wcvp_names': len(df_wcvp)
+            ,'wcvp_distributions': len(df_dist)
+            ,'occurrences': len(df_occ)
+            ,'publishers': len(df_publ)
+            ,'ih_institutions': len(df_ih)
+            ,'geonames_cities': len(df_gn)
+            ,'tdwg_areas': len(df_tdwg)
+            ,'gadm_units': len(df_gadm)}
+
+def runStage(name, command, datadir):
+    # Runs the command in its own process, in datadir, and returns its wall
+    # time, its CPU time (from the resource usage of that process alone, as
+    # returned by wait4) and its peak RSS (as recorded by benchmarks.peakrss)
+    peak_filepath = os.path.join(datadir, '{}.peak.json'.format(name))
+    args = [sys.executable, '-m', 'benchmarks.peakrss', peak_filepath] + [command[0] if command[0] == '-m' else os.path.join(REPOSITORY_DIR, command[0])] + command[1:]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPOSITORY_DIR] + [path for path in [os.environ.get('PYTHONPATH')] if path]))
+    log_filepath = os.path.join(datadir, '{}.log'.format(name))
+    with open(log_filepath, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(args, cwd=datadir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+    with open(peak_filepath) as f:
+        peak_rss_mb = json.load(f)['peak_rss_mb']
+    return {'stage': name
+            ,'returncode': os.waitstatus_to_exitcode(status)
+            ,'seconds': seconds
+            ,'cpu_seconds': rusage.ru_utime + rusage.ru_stime
+            ,'peak_rss_mb': peak_rss_mb
+            ,'log': log_filepath}
+
+def compareResults(previous, current):
+    # Prints the ratio of the time and peak RSS of each stage (and of each of
+    # its spans) to those of the previous run, for the scales and stages in
+    # both
+    def index(results):
+        rows = dict()
+        for scale_results in results['scales']:
+            for stage_result in scale_results['stages']:
+                rows[(scale_results['scale'], stage_result['stage'])] = stage_result
+                for span in stage_result.get('spans', []):
+                    rows[(scale_results['scale'], '{}.{}'.format(stage_result['stage'], span['span']))] = span
+        return rows
+    previous_rows = index(previous)
+    print('Compared with {} (commit {}):'.format(previous['environment'].get('platform'), previous['environment'].get('commit')))
+    print('{:>10} {:<52} {:>10} {:>10} {:>10} {:>10}'.format('scale', 'stage', 'seconds', 'ratio', 'peak_mb', 'ratio'))
+    for key, row in index(current).items():
+        if key not in previous_rows:
+            continue
+        previous_row = previous_rows[key]
+        print('{:>10} {:<52} {:>10.3f} {:>10.2f} {:>10.0f} {:>10.2f}'.format(key[0], key[1], row['seconds'], row['seconds'] / max(previous_row['seconds'], 1e-9), row['peak_rss_mb'], row['peak_rss_mb'] / max(previous_row['peak_rss_mb'], 1e-9)))
+
+if __name__ == '__main__':
+    main()
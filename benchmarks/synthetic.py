@@ -0,0 +1,214 @@
+import pandas as pd
+import numpy as np
+
+# Generators for synthetic versions of the pipeline input files, so that
+# benchmarks can run at a chosen scale without network downloads.
+
+AUTHORS = ['L.', 'Mill.', 'Sm.', 'Thunb.', 'Hook.f.', 'DC.', 'Benth.', 'Kunth', 'Lam.', 'Willd.']
+TAXON_STATUSES = ['Accepted', 'Synonym', 'Orthographic', 'Unplaced', 'Illegitimate', 'Artificial Hybrid']
+TAXON_STATUS_WEIGHTS = [0.35, 0.45, 0.04, 0.1, 0.05, 0.01]
+FIRST_PUBLISHED = ['(1753)', '(1789)', '(1824)', '(1890 publ. 1891)', '(1905)', '(1937)', '(1992)', '(1999 publ. 2000)', '(2014)', '(2021)', 'sine anno', '(18)', None]
+
+def randomWords(rng, n, min_length=5, max_length=10, alphabet='abcdefghiklmnoprstuvy'):
+    letters = np.array(list(alphabet))
+    lengths = rng.integers(min_length, max_length + 1, n)
+    chars = letters[rng.integers(0, len(letters), (n, max_length))]
+    return pd.Series([''.join(row[:length]) for row, length in zip(chars, lengths)], dtype=object)
+
+def makeWcvpNames(n, rng, duplicate_fraction=0.05):
+    n_genera = max(10, n // 40)
+    n_families = max(5, n_genera // 30)
+    genera = randomWords(rng, n_genera).str.capitalize() + 'a'
+    families = randomWords(rng, n_families).str.capitalize() + 'aceae'
+    genus_family = families.to_numpy()[rng.integers(0, n_families, n_genera)]
+    epithets = randomWords(rng, max(10, n // 3))
+
+    genus_idx = rng.integers(0, n_genera, n)
+    df = pd.DataFrame({'plant_name_id': np.arange(1, n + 1)})
+    df['taxon_rank'] = np.where(rng.random(n) < 0.1, 'Variety', 'Species')
+    df['taxon_status'] = rng.choice(TAXON_STATUSES, n, p=TAXON_STATUS_WEIGHTS)
+    df['family'] = genus_family[genus_idx]
+    df['genus'] = genera.to_numpy()[genus_idx]
+    df['species'] = epithets.to_numpy()[rng.integers(0, len(epithets), n)]
+    df['infraspecific_rank'] = np.where(df.taxon_rank == 'Variety', 'var.', None)
+    df['infraspecies'] = np.where(df.taxon_rank == 'Variety', epithets.to_numpy()[rng.integers(0, len(epithets), n)], None)
+    df['first_published'] = rng.choice(np.array(FIRST_PUBLISHED, dtype=object), n)
+    df['taxon_name'] = df.genus + ' ' + df.species
+    mask = df.taxon_rank == 'Variety'
+    df.loc[mask, 'taxon_name'] = df[mask].taxon_name + ' var. ' + df[mask].infraspecies
+    df['taxon_authors'] = rng.choice(np.array(AUTHORS + [None], dtype=object), n)
+
+    # Some names occur more than once, with different IDs and statuses
+    df_dup = df.sample(frac=duplicate_fraction, random_state=rng.integers(2**31)).copy()
+    df_dup['plant_name_id'] = np.arange(n + 1, n + 1 + len(df_dup))
+    df_dup['taxon_status'] = rng.choice(TAXON_STATUSES, len(df_dup), p=TAXON_STATUS_WEIGHTS)
+    df = pd.concat([df, df_dup], ignore_index=True)
+
+    accepted_ids = df.plant_name_id[df.taxon_status == 'Accepted'].to_numpy()
+    df['accepted_plant_name_id'] = np.where(df.taxon_status == 'Accepted', df.plant_name_id, np.nan)
+    mask = df.taxon_status.isin(['Synonym', 'Orthographic'])
+    df.loc[mask, 'accepted_plant_name_id'] = rng.choice(accepted_ids, mask.sum())
+    df['homotypic_synonym'] = np.where((df.taxon_status == 'Synonym') & (rng.random(len(df)) < 0.3), 'T', None)
+    return df.sample(frac=1, random_state=rng.integers(2**31)).reset_index(drop=True)
+
+def makeGbifTaxa(df_wcvp, n, rng, matched_fraction=0.6, author_variation=0.2, family_variation=0.05, first_taxon_id=1):
+    # A sample of WCVP names rendered as GBIF would (some with different
+    # authors or family), plus names which are not in WCVP at all
+    n_matched = int(n * matched_fraction)
+    df_authored = df_wcvp[df_wcvp.taxon_authors.notnull()]
+    df_m = df_authored.iloc[rng.integers(0, len(df_authored), n_matched)].reset_index(drop=True)
+    authors = df_m.taxon_authors.where(rng.random(n_matched) >= author_variation, 'Other')
+    df_matched = pd.DataFrame({'scientificName': df_m.taxon_name.str.cat(authors, sep=' ', na_rep='').str.strip(),
+                            'genericName': df_m.genus,
+                            'specificEpithet': df_m.species,
+                            'family': df_m.family.where(rng.random(n_matched) >= family_variation, df_m.family.sample(frac=1, random_state=1).to_numpy())})
+
+    n_unmatched = n - n_matched
+    genera = df_wcvp[['genus', 'family']].drop_duplicates('genus')
+    df_g = genera.iloc[rng.integers(0, len(genera), n_unmatched)].reset_index(drop=True)
+    epithets = randomWords(rng, n_unmatched, min_length=6, max_length=11, alphabet='aeiouwxzq')
+    df_unmatched = pd.DataFrame({'scientificName': df_g.genus + ' ' + epithets + ' ' + rng.choice(AUTHORS, n_unmatched),
+                            'genericName': df_g.genus,
+                            'specificEpithet': epithets,
+                            'family': df_g.family})
+
+    df = pd.concat([df_matched, df_unmatched], ignore_index=True).sample(frac=1, random_state=rng.integers(2**31)).reset_index(drop=True)
+    df.insert(0, 'taxonID', np.arange(first_taxon_id, first_taxon_id + len(df)))
+    df['canonicalName'] = df.genericName + ' ' + df.specificEpithet
+    df['taxonRank'] = 'species'
+    df['taxonomicStatus'] = np.where(rng.random(len(df)) < 0.7, 'accepted', 'synonym')
+    df['kingdom'] = 'Plantae'
+    df['phylum'] = 'Tracheophyta'
+    return df
+
+def makeIhInstitutions(n, rng, city_fraction=0.5):
+    # Index Herbariorum institutions: names and cities (which repeat), with
+    # coordinates for most
+    n_cities = max(1, int(n * city_fraction))
+    cities = randomWords(rng, n_cities).str.capitalize()
+    df = pd.DataFrame({'organization': 'Herbarium ' + randomWords(rng, n, max_length=12).str.capitalize(),
+                    'physicalCity': cities.to_numpy()[rng.integers(0, n_cities, n)],
+                    'latitude': rng.uniform(-60, 70, n),
+                    'longitude': rng.uniform(-180, 180, n)})
+    df.loc[rng.random(n) < 0.05, ['latitude', 'longitude']] = np.nan
+    return df
+
+def makePublishers(df_ih, rng, n_publishers=2000, located_fraction=0.6, ih_fraction=0.5):
+    # Publisher details as held in the GBIF registry: some publishers have
+    # coordinates, others have a title or city which may be found in IH
+    located = rng.random(n_publishers) < located_fraction
+    in_ih = rng.random(n_publishers) < ih_fraction
+    df_ih_sample = df_ih.iloc[rng.integers(0, len(df_ih), n_publishers)].reset_index(drop=True)
+    return pd.DataFrame({'publishingOrgKey': ['org-{:06d}'.format(i) for i in range(n_publishers)],
+                    'title': np.where(in_ih, df_ih_sample.organization, 'Museum ' + randomWords(rng, n_publishers)),
+                    'city': np.where(rng.random(n_publishers) < 0.5, df_ih_sample.physicalCity, randomWords(rng, n_publishers)),
+                    'country': rng.choice(['GB', 'US', 'BR', 'FR', 'ZA', None], n_publishers),
+                    'latitude': np.where(located, rng.uniform(-60, 70, n_publishers), np.nan),
+                    'longitude': np.where(located, rng.uniform(-180, 180, n_publishers), np.nan)})
+
+def makePublisherLocations(n, df_ih, rng, n_publishers=2000, located_fraction=0.6, ih_fraction=0.5):
+    # Occurrence oriented publisher details as joined from the GBIF registry
+    df_publ = makePublishers(df_ih, rng, n_publishers=n_publishers, located_fraction=located_fraction, ih_fraction=ih_fraction)
+    return df_publ.iloc[rng.integers(0, n_publishers, n)].reset_index(drop=True)
+
+def registryEntries(df_publ):
+    # The publishers as returned by the GBIF registry (see gbifregistry.py),
+    # keyed on publishingOrgKey
+    df = df_publ.rename(columns={'publishingOrgKey': 'key'}).assign(province=None)
+    df = df.astype(object).where(df.notnull(), None)
+    return {row['key']: row for row in df.to_dict(orient='records')}
+
+def makeGbifBackbone(df_wcvp, n, rng, in_scope_fraction=0.5, hybrid_fraction=0.01):
+    # The whole GBIF backbone taxonomy (Taxon.tsv): names which filtergbif.py
+    # keeps (Tracheophyta species, some of them hybrids) and names of other
+    # phyla and ranks which it drops
+    df = makeGbifTaxa(df_wcvp, n, rng)
+    out_of_scope = rng.random(n) >= in_scope_fraction
+    df.loc[out_of_scope, 'phylum'] = rng.choice(['Bryophyta', 'Chlorophyta', 'Ascomycota'], out_of_scope.sum())
+    df.loc[rng.random(n) < 0.2, 'taxonRank'] = 'genus'
+    hybrid = rng.random(n) < hybrid_fraction
+    df.loc[hybrid, 'scientificName'] = '\u00d7' + df.scientificName[hybrid]
+    df['parentNameUsageID'] = np.where(rng.random(n) < 0.8, rng.integers(1, max(2, n // 10), n), np.nan)
+    return df
+
+def makeTypeOccurrences(df_taxa, publisher_keys, n, rng, notatype_fraction=0.2, missing_year_fraction=0.1):
+    # GBIF occurrences with a type status, of the given taxa, published by
+    # the given publishers
+    df = pd.DataFrame({'gbifID': np.arange(1, n + 1),
+                    'datasetKey': 'dataset-' + pd.Series(rng.integers(0, 100, n)).astype(str),
+                    'typeStatus': rng.choice(['HOLOTYPE', 'ISOTYPE', 'LECTOTYPE', 'PARATYPE', 'TYPE'], n),
+                    'taxonKey': rng.choice(df_taxa.taxonID.to_numpy(), n),
+                    'scientificName': 'x',
+                    'countryCode': rng.choice(['GB', 'US', 'BR', 'FR', 'ZA'], n),
+                    'publishingOrgKey': rng.choice(np.asarray(publisher_keys, dtype=object), n),
+                    'year': np.where(rng.random(n) < missing_year_fraction, np.nan, rng.integers(1750, 2023, n))})
+    df.loc[rng.random(n) < notatype_fraction, 'typeStatus'] = 'NOTATYPE'
+    return df
+
+def makeGeonamesCities(countries, rng):
+    # A capital city (feature code PPLC) in the geonames cities file format
+    # (no header, see types2publisherlocations.GEONAMES_COLUMNS) for each
+    # country, among other populated places
+    n = len(countries) * 5
+    df = pd.DataFrame({'geonameid': np.arange(1, n + 1)})
+    df['name'] = randomWords(rng, n).str.capitalize()
+    df['asciiname'] = df['name']
+    df['alternatenames'] = None
+    df['latitude'] = rng.uniform(-60, 70, n)
+    df['longitude'] = rng.uniform(-180, 180, n)
+    df['feature class'] = 'P'
+    df['feature code'] = np.where(np.arange(n) % 5 == 0, 'PPLC', 'PPL')
+    df['country code'] = np.repeat(np.asarray(countries, dtype=object), 5)
+    for column in ['cc2', 'admin1 code', 'admin2 code', 'admin3 code', 'admin4 code']:
+        df[column] = None
+    df['population'] = rng.integers(15000, 10000000, n)
+    df['elevation'] = None
+    df['dem'] = 0
+    df['timezone'] = 'UTC'
+    df['modification date'] = '2022-01-01'
+    return df
+
+def makeTdwgAreas(cell_size=20):
+    # TDWG WGSRPD L3 areas as a grid of square cells, grouped into L2 regions
+    # of four cells and L1 continents of forty
+    import geopandas as gpd
+    from shapely.geometry import box
+    cells = [box(x, y, x + cell_size, y + cell_size) for x in range(-180, 180, cell_size) for y in range(-80, 80, cell_size)]
+    i = np.arange(len(cells))
+    return gpd.GeoDataFrame({'LEVEL3_COD': ['A{:03d}'.format(j) for j in i],
+                    'LEVEL3_NAM': ['Area {}'.format(j) for j in i],
+                    'LEVEL2_COD': 10 + i // 4,
+                    'LEVEL1_COD': 1 + i // 40}, geometry=cells, crs='EPSG:4326')
+
+def makeGadmUnits(cell_size=5, country_size=30):
+    # GADM level 1 units as a grid of square cells, with a country for each
+    # band of longitude
+    import geopandas as gpd
+    from shapely.geometry import box
+    origins = [(x, y) for x in range(-180, 180, cell_size) for y in range(-80, 80, cell_size)]
+    countries = ['C{:02d}'.format((x + 180) // country_size) for x, _ in origins]
+    return gpd.GeoDataFrame({'GID_0': [country + 'X' for country in countries],
+                    'COUNTRY': ['Country ' + country for country in countries],
+                    'GID_1': ['{}.{}_1'.format(country, i) for i, country in enumerate(countries)],
+                    'NAME_1': ['Unit {}'.format(i) for i in range(len(origins))],
+                    'ISO_1': ['{}-{}'.format(country[1:], i) for i, country in enumerate(countries)]},
+                    geometry=[box(x, y, x + cell_size, y + cell_size) for x, y in origins], crs='EPSG:4326')
+
+def makeWcvpDistributions(df_wcvp, df_tdwg, rng, max_areas=5, introduced_fraction=0.2):
+    # Distributions of the accepted WCVP names, each in between one and
+    # max_areas TDWG L3 areas
+    accepted_ids = df_wcvp.accepted_plant_name_id.dropna().unique()
+    counts = rng.integers(1, max_areas + 1, len(accepted_ids))
+    areas = df_tdwg.iloc[rng.integers(0, len(df_tdwg), counts.sum())].reset_index(drop=True)
+    n = len(areas)
+    return pd.DataFrame({'plant_locality_id': np.arange(1, n + 1),
+                    'plant_name_id': np.repeat(accepted_ids, counts).astype(np.int64),
+                    'continent_code_l1': areas.LEVEL1_COD,
+                    'continent': 'Continent ' + areas.LEVEL1_COD.astype(str),
+                    'region_code_l2': areas.LEVEL2_COD,
+                    'region': 'Region ' + areas.LEVEL2_COD.astype(str),
+                    'area_code_l3': areas.LEVEL3_COD,
+                    'area': areas.LEVEL3_NAM,
+                    'introduced': (rng.random(n) < introduced_fraction).astype(int),
+                    'extinct': 0,
+                    'location_doubtful': 0})
@@ -1,8 +1,17 @@
 import pandas as pd
 pd.set_option('display.max_rows',100)
 import argparse
+import functools
+import io
+import multiprocessing
+import os
+from instrumentation import Instrumentation, addInstrumentationArguments
+from tableio import FORMATS, GBIF_TAXON_SCHEMA, writeTableChunks
 
-def main():
+# Columns used in the filter, these are always read
+FILTER_COLUMNS=['phylum','taxonRank','scientificName']
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("inputfile", type=str)
     parser.add_argument("--limit", default=None, type=int)
@@ -11,36 +20,104 @@ def main():
     parser.add_argument('--phylum', type=str, default='Tracheophyta')
     parser.add_argument('--taxonRank', type=str, default='species')
     parser.add_argument('--removeHybrids', action='store_true')
+    parser.add_argument('--usecols', type=str, default=None, help='Comma separated list of the columns to output, defaults to all columns')
+    parser.add_argument('--format', type=str, choices=FORMATS, default='tsv')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes to filter with, each reading its own byte range of the input file')
+    addInstrumentationArguments(parser)
     parser.add_argument("outputfile", type=str)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    instrumentation = Instrumentation.fromArgs('filtergbif', args)
 
     ###########################################################################
     # 1. Assemble filter
     ###########################################################################
     query_filter = "(phylum == '{phylum}') & (taxonRank == '{taxonRank}')".format(phylum=args.phylum, taxonRank=args.taxonRank)
+    # Only read the columns which are output, plus those used in the filter
+    usecols = None
+    readcols = None
+    if args.usecols is not None:
+        usecols = args.usecols.split(',')
+        readcols = usecols + [column for column in FILTER_COLUMNS if column not in usecols]
 
     ###########################################################################
-    # 2. Incrementally read file, applying filter
+    # 2. Incrementally read file, applying filter (and removing hybrids), and 
+    # append each filtered batch to the output file. Values are read as text, 
+    # so that they are written out exactly as read, and only one batch is held 
+    # in memory at a time
     ###########################################################################
     print('Reading from: {}, filtering on: {}'.format(args.inputfile,query_filter))
-    gen = pd.read_csv(args.inputfile, sep=args.delimiter, chunksize=args.batchsize, nrows=args.limit, on_bad_lines='skip')
-    df = pd.concat([x.query(query_filter) for x in gen])
-    print('Read {} GBIF lines'.format(len(df)))
+    print('Writing to: {}'.format(args.outputfile))
+    with instrumentation.span('filter') as span:
+        if args.workers > 1 and args.limit is None:
+            # Split the file into byte ranges (each of roughly one batch of 
+            # lines) and filter them in a pool of processes. imap returns the 
+            # filtered ranges in file order, so the output is the same as the 
+            # sequential read
+            columns = readHeader(args.inputfile, args.delimiter)
+            ranges = splitByteRanges(args.inputfile, args.batchsize)
+            print('Filtering {} byte ranges with {} workers'.format(len(ranges), args.workers))
+            filter_range = functools.partial(filterByteRange, filepath=args.inputfile, sep=args.delimiter, columns=columns, readcols=readcols, query_filter=query_filter, remove_hybrids=args.removeHybrids, usecols=usecols)
+            with multiprocessing.Pool(args.workers) as pool:
+                # (each batch is a span, covering the wait for it)
+                row_count = writeTableChunks(instrumentation.iterate(pool.imap(filter_range, ranges), 'filter_batch_{}'), args.outputfile, format=args.format, schema=GBIF_TAXON_SCHEMA)
+        else:
+            if args.workers > 1:
+                print('Limit set, filtering in a single process')
+            gen = pd.read_csv(args.inputfile, sep=args.delimiter, chunksize=args.batchsize, nrows=args.limit, on_bad_lines='skip', usecols=readcols, dtype=str)
+            filtered = (filterChunk(x, query_filter, remove_hybrids=args.removeHybrids, usecols=usecols) for x in gen)
+            # (each batch is a span, covering its reading and filtering)
+            row_count = writeTableChunks(instrumentation.iterate(filtered, 'filter_batch_{}'), args.outputfile, format=args.format, schema=GBIF_TAXON_SCHEMA)
+        span['rows'] = row_count
+    print('Wrote {} filtered GBIF lines{}'.format(row_count, ' (hybrids removed)' if args.removeHybrids else ''))
+    if args.spans_file is not None:
+        instrumentation.write(args.spans_file)
 
-    ###########################################################################
-    # 3. Remove hybrids
-    ###########################################################################
-    if args.removeHybrids:
+def filterChunk(df, query_filter, remove_hybrids=False, usecols=None):
+    df = df.query(query_filter)
+    if remove_hybrids:
         #dropmask = (df.scientificName.str.contains('\u00d7') | df.scientificName.str.contains(' x '))
-        dropmask = (df.scientificName.str.contains('\u00d7'))
-        df.drop(df[dropmask].index, inplace=True)
-        print('Filtered hybrids, retained {} lines'.format(len(df)))
+        dropmask = (df.scientificName.str.contains('\u00d7', na=False))
+        df = df[~dropmask]
+    if usecols is not None:
+        df = df[usecols]
+    return df
 
-    ###########################################################################
-    # 4. Output filtered file
-    ###########################################################################
-    print('Writing to: {}'.format(args.outputfile))
-    df.to_csv(args.outputfile, sep='\t', index=False)
+def readHeader(filepath, sep='\t'):
+    return pd.read_csv(filepath, sep=sep, nrows=0).columns.tolist()
+
+def splitByteRanges(filepath, batchsize, sample_lines=1000):
+    # Split the data lines (after the header) of a file into (start, end) 
+    # byte ranges, each starting at the beginning of a line. The size of a 
+    # range is estimated from the length of the first lines, so that each 
+    # holds roughly batchsize lines.
+    # NB: this assumes that no quoted value contains a line break
+    file_size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as f:
+        f.readline()
+        data_start = f.tell()
+        sample = [f.readline() for _ in range(sample_lines)]
+        sample_bytes = sum(len(line) for line in sample)
+        sample_count = sum(1 for line in sample if line)
+        range_size = max(1, (sample_bytes // max(1, sample_count)) * batchsize)
+        ranges = []
+        start = data_start
+        while start < file_size:
+            f.seek(min(start + range_size, file_size))
+            # Move the end on to the start of the next line
+            if f.tell() < file_size:
+                f.readline()
+            end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def filterByteRange(byte_range, filepath, sep, columns, readcols, query_filter, remove_hybrids=False, usecols=None):
+    start, end = byte_range
+    with open(filepath, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    df = pd.read_csv(io.BytesIO(data), sep=sep, header=None, names=columns, on_bad_lines='skip', usecols=readcols, dtype=str)
+    return filterChunk(df, query_filter, remove_hybrids=remove_hybrids, usecols=usecols)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
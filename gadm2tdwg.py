@@ -0,0 +1,110 @@
+import pandas as pd
+pd.set_option('display.max_rows',100)
+import geopandas as gpd
+import argparse
+from shapely.geometry import GeometryCollection
+
+# Builds a lookup from each GADM level 1 unit, via its representative point,
+# to the TDWG WGSRPD L3 region(s) containing that point. Publisher locations
+# are assigned to TDWG L3 regions by finding the GADM unit which contains
+# them, so with this lookup prepared once (and stored as GeoParquet, which is
+# much quicker to read than the GADM geopackage) each analysis run only needs
+# a single point in polygon join.
+
+GADM_L1_COLUMNS=['GID_0'
+                ,'COUNTRY'
+                ,'GID_1'
+                ,'NAME_1'
+                ,'ISO_1']
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('gadm_geopackage_file', type=str, help='Path to GADM geopackage file')
+    parser.add_argument("inputfile_tdwg_wgsrpd_l3_json", type=str)
+    parser.add_argument('--simplify_tolerance', type=float, default=None, help='Simplify the GADM unit polygons to this tolerance (in degrees) after determining their representative points')
+    parser.add_argument("outputfile", type=str, help='Path to GeoParquet output file')
+    args = parser.parse_args(argv)
+
+    ###########################################################################
+    # 1. Read input files
+    ###########################################################################
+    #
+    # 1.1 Read GADM level 1 units =============================================
+    df_gadm_l1 = readGadmL1(args.gadm_geopackage_file)
+    print('Read {} GADM L1 units from {}'.format(len(df_gadm_l1), args.gadm_geopackage_file))
+
+    # 1.2 Read TDWG WGSRPD L3 geojson format shape file ========================
+    df_tdwg_poly = gpd.read_file(args.inputfile_tdwg_wgsrpd_l3_json)
+    print('Read {} TDWG WGSRPD l3 shapes from {}'.format(len(df_tdwg_poly), args.inputfile_tdwg_wgsrpd_l3_json))
+
+    ###########################################################################
+    # 2. Determine TDWG WGSRPD L3 region of each GADM L1 unit
+    ###########################################################################
+    df_lookup = buildGadmTdwgLookup(df_gadm_l1, df_tdwg_poly, simplify_tolerance=args.simplify_tolerance)
+    print('GADM L1 units without a TDWG L3 region: {}'.format(df_lookup.LEVEL3_COD.isnull().sum()))
+
+    ###########################################################################
+    # 3. Output
+    ###########################################################################
+    print('Outputting {} rows to {}'.format(len(df_lookup), args.outputfile))
+    df_lookup.to_parquet(args.outputfile, index=False)
+
+def readGadmL1(filepath, mask=None):
+    # Reads the GADM level 1 units, with only the columns used. If a mask 
+    # geometry is given, only units intersecting it are read, using the 
+    # spatial index of the geopackage (so none if the mask is empty)
+    if mask is not None and mask.is_empty:
+        df_gadm_l1 = gpd.read_file(filepath, layer="ADM_1", rows=slice(0, 0))
+    else:
+        df_gadm_l1 = gpd.read_file(filepath, layer="ADM_1", mask=mask)
+    return df_gadm_l1[GADM_L1_COLUMNS + ['geometry']]
+
+def buildPointsMask(df_point, buffer):
+    # Returns a single geometry covering the (non empty) points, each 
+    # buffered by the given distance, to use when reading GADM units. This is
+    # an empty geometry if there are no points (rather than None, which
+    # readGadmL1 would take as no mask)
+    points = df_point.geometry[~(df_point.geometry.is_empty | df_point.geometry.isna())]
+    if len(points) == 0:
+        return GeometryCollection()
+    return points.buffer(buffer).unary_union
+
+def buildGadmTdwgLookup(df_gadm_l1, df_tdwg_poly, simplify_tolerance=None):
+    # Returns a geodataframe with a row per GADM L1 unit and containing TDWG
+    # L3 region (there can be more than one, if the representative point is
+    # on a boundary). The geometry is the GADM unit polygon, and the 
+    # representative point is kept in geometry_gadm_l1_repr_point
+    df = df_gadm_l1[GADM_L1_COLUMNS + ['geometry']].copy()
+    # Save the representative point of each GADM unit
+    df['geometry_gadm_l1_repr_point'] = df.geometry.representative_point()
+    # The polygons are only simplified after the representative points are 
+    # found, so these (and so the TDWG L3 region of each unit) do not change
+    if simplify_tolerance is not None:
+        df.geometry = df.geometry.simplify(simplify_tolerance)
+    # Determine intersection between the GADM representative point and the TDWG L3 polygon
+    df = df.rename_geometry('geometry_gadm_l1').set_geometry('geometry_gadm_l1_repr_point')
+    df.crs = df_tdwg_poly.crs
+    df = df.sjoin(df_tdwg_poly[[column for column in df_tdwg_poly.columns if column != 'geometry_tdwg_l3']], how="left")
+    df = df.drop(columns=['index_right']).set_geometry('geometry_gadm_l1').rename_geometry('geometry')
+    return df.reset_index(drop=True)
+
+def buildPublisherPoints(df_publ):
+    # Make a geodataframe where the geometry is a point built from the 
+    # lat/long values of each publisher location
+    df_gbif_point = gpd.GeoDataFrame(df_publ[['publishingOrgKey','latitude','longitude','country', 'title']].drop_duplicates(), geometry=gpd.points_from_xy(df_publ['longitude'], df_publ['latitude']))
+    df_gbif_point['geometry_original_point'] = df_gbif_point.geometry
+    df_gbif_point.rename(columns={'country':'country_gbif','title':'title_gbif'}, inplace=True)
+    return df_gbif_point
+
+def locatePublishers(df_gbif_point, df_gadm_tdwg):
+    # Determine intersection between GBIF publisher location and GADM L1 
+    # unit, and so the TDWG L3 region 
+    # The join will be made on the geometry columns ie point in polygon
+    df_gbif_point.crs = df_gadm_tdwg.crs
+    return df_gbif_point.sjoin(df_gadm_tdwg, how="left")
+
+def readGadmTdwgLookup(filepath):
+    return gpd.read_parquet(filepath)
+
+if __name__ == '__main__':
+    main()
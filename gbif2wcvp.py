@@ -4,8 +4,46 @@ import argparse
 from unidecode import unidecode
 import re
 import numpy as np
+import functools
+import contextlib
+import io
+import multiprocessing
+from instrumentation import Instrumentation, addInstrumentationArguments
+from tableio import FORMATS, GBIF_TAXON_SCHEMA, GBIF2WCVP_SCHEMA, WCVP_NAMES_SCHEMA, applySchema, readTable, writeTable
 
-def main():
+# Infraspecific rank marker within a name
+RANK_PATTERN=r'(?<= )(var\.|ssp\.|subsp\.|f.)(?= )'
+
+# Year of publication of a name (in WCVP first_published, without brackets):
+# either the whole value, or what follows the first "publ. " in it (as in
+# "1890 publ. 1891"). As cleanPublicationYear, with a group for each case
+PUBLICATION_YEAR=r'1[7-9][0-9][0-9]|20[0-2][0-9]'
+PUBLICATION_YEAR_PATTERN=r'^(?:({year})|(?:(?!publ\. ).)*publ\. ({year}))\Z'.format(year=PUBLICATION_YEAR)
+
+# Match strategies, applied in order, first strict, later looser
+MATCH_CONFIGURATIONS=[{'gbif_name_source':'scientificName','wcvp_name_source':'taxon_name_plus_authors','match_cols':['family','genericName'],'exclude_homonyms':False},
+                    {'gbif_name_source':'scientificName','wcvp_name_source':'taxon_name_plus_authors','match_cols':['genericName'],'exclude_homonyms':False},
+                    {'gbif_name_source':'name','wcvp_name_source':'taxon_name_minus_authors','match_cols':['family','genericName'],'exclude_homonyms':True}]
+
+# Optional final match strategy: names (without authors) within an edit
+# distance of each other, compared within blocks of the same genus. Homonyms
+# are excluded, as in the last exact stage
+FUZZY_MATCH_CONFIGURATION={'gbif_name_source':'name','wcvp_name_source':'taxon_name_minus_authors','match_cols':['genericName'],'exclude_homonyms':True,
+                    'fuzzy':True,'max_distance':2,'max_relative_distance':0.2}
+
+# Prepared WCVP columns used in matching and output
+WCVP_MATCH_COLUMNS=['plant_name_id'
+                ,'taxon_rank'
+                ,'taxon_status'
+                ,'family'
+                ,'genericName'
+                ,'first_published'
+                ,'taxon_authors'
+                ,'taxon_name_plus_authors'
+                ,'taxon_name_minus_authors'
+                ,'accepted_plant_name_id']
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--limit", default=None, type=int)
     parser.add_argument("inputfile_gbif", type=str)
@@ -14,20 +52,41 @@ def main():
     parser.add_argument('--delimiter_wcvp', type=str, default='|')
     parser.add_argument("--filter", action='store_true')
     parser.add_argument('--filter_name_prefix', type=str, default='Roella retic')
+    parser.add_argument('--format', type=str, choices=FORMATS, default='tsv', help='Format of the filtered GBIF input file and the output file')
+    parser.add_argument('--wcvp_index', type=str, default=None, help='Directory of the compiled WCVP index (see wcvpindex.py), built if missing or out of date with the WCVP input file')
+    parser.add_argument('--no_build_index', action='store_true', help='Fail, rather than build the --wcvp_index, if it is missing or out of date (for when it is built by a separate step)')
+    parser.add_argument('--fuzzy', action='store_true', help='Add a final match stage matching names within an edit distance, within the same genus')
+    parser.add_argument('--fuzzy_max_distance', type=int, default=FUZZY_MATCH_CONFIGURATION['max_distance'], help='Maximum edit distance between names in the fuzzy match stage')
+    parser.add_argument('--fuzzy_max_relative_distance', type=float, default=FUZZY_MATCH_CONFIGURATION['max_relative_distance'], help='Maximum edit distance in the fuzzy match stage, as a fraction of the length of the name after the genus')
+    parser.add_argument('--previous_output', type=str, default=None, help='Output of a previous run, from --previous_gbif and --previous_wcvp. Only names which are new or changed (or whose WCVP candidates changed) are re-matched, the rest are copied from this')
+    parser.add_argument('--previous_gbif', type=str, default=None, help='GBIF input file of the previous run')
+    parser.add_argument('--previous_wcvp', type=str, default=None, help='WCVP input file of the previous run')
+    parser.add_argument('--incremental_report', type=str, default=None, help='Path to YAML file to write counts of the names recomputed and reused to')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes to match with, each matching (and resolving) the names of a partition of the genera')
     
+    addInstrumentationArguments(parser)
     parser.add_argument("outputfile", type=str)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    instrumentation = Instrumentation.fromArgs('gbif2wcvp', args)
+    if args.previous_output is not None and (args.previous_gbif is None or args.previous_wcvp is None):
+        parser.error('--previous_output requires --previous_gbif and --previous_wcvp')
+    match_configurations = MATCH_CONFIGURATIONS
+    if args.fuzzy:
+        match_configurations = MATCH_CONFIGURATIONS + [dict(FUZZY_MATCH_CONFIGURATION, max_distance=args.fuzzy_max_distance, max_relative_distance=args.fuzzy_max_relative_distance)]
 
     ###########################################################################
     # 1. Read GBIF input file and process
     ###########################################################################
     #
     # 1.1 Read file ===========================================================
-    df_gbif = pd.read_csv(args.inputfile_gbif, sep=args.delimiter_gbif, nrows=args.limit)
-    print('Read {} GBIF lines from: {}'.format(len(df_gbif), args.inputfile_gbif))
+    with instrumentation.span('read_gbif') as span:
+        df_gbif = readTable(args.inputfile_gbif, format=args.format, sep=args.delimiter_gbif, nrows=args.limit, schema=GBIF_TAXON_SCHEMA)
+        print('Read {} GBIF lines from: {}'.format(len(df_gbif), args.inputfile_gbif))
+        span['rows'] = len(df_gbif)
     #
     # 1.2 Create name column for matching =====================================
-    df_gbif['name'] = df_gbif.apply(lambda row: unidecode('{} {}'.format(row['genericName'],row['specificEpithet'])),axis=1)
+    with instrumentation.span('prepare_gbif', rows=len(df_gbif)):
+        df_gbif = prepareGbifNames(df_gbif)
     # (Note - did look at using the canonicalName column for this purpose BUT whilst it 
     # is mostly OK, a few thousand records (primarily from dataset ID 
     # 7ddf754f-d193-4cc9-b351-99906754a03b) include names of the form "Genus species publnote" 
@@ -43,142 +102,680 @@ def main():
     # 2. Read WCVP input file and process
     ###########################################################################
     #
-    # 2.1 Read file ===========================================================
-    df_wcvp = pd.read_csv(args.inputfile_wcvp, sep=args.delimiter_wcvp, nrows=args.limit)
-    df_wcvp = df_wcvp.replace({np.nan:None})
-    print('Read {} WCVP lines from: {}'.format(len(df_wcvp), args.inputfile_wcvp))
-    #
-    # 2.2 Process homotypic synonym status ====================================
-    mask = (df_wcvp.homotypic_synonym.notnull())
-    df_wcvp.loc[mask,'taxon_status'] = 'Homotypic Synonym'
-    #
-    # 2.3 Add column with name plus/ minus authors ============================
-    df_wcvp['taxon_name_plus_authors'] = df_wcvp.apply(lambda row: '{} {}'.format(row['taxon_name'],row['taxon_authors']), axis=1)
-    df_wcvp['taxon_name_minus_authors'] = df_wcvp['taxon_name']
-    df_wcvp.drop(columns=['taxon_name'],inplace=True)
-    #
-    # 2.4 Add genericName column
-    df_wcvp['genericName'] = df_wcvp['genus']
+    # 2.1 Read the compiled index, which holds the prepared names and their
+    # match keys (only used for complete runs, as its row positions are those
+    # of the whole file) ======================================================
+    with instrumentation.span('read_wcvp') as span:
+        wcvp_encodings = None
+        accepted_positions = None
+        if args.wcvp_index is not None and args.limit is None and not args.filter:
+            from wcvpindex import loadWcvpIndex
+            df_wcvp, wcvp_encodings, accepted_positions = loadWcvpIndex(args.inputfile_wcvp, args.wcvp_index, sep=args.delimiter_wcvp, build=not args.no_build_index)
+        else:
+            # 2.2 Read file =======================================================
+            df_wcvp = readWcvpNames(args.inputfile_wcvp, sep=args.delimiter_wcvp, nrows=args.limit)
+            print('Read {} WCVP lines from: {}'.format(len(df_wcvp), args.inputfile_wcvp))
+            #
+            # 2.3 Process homotypic synonym status, add match name and genericName columns
+            df_wcvp = prepareWcvpNames(df_wcvp)
 
-    if args.filter:
-        dropmask = (df_wcvp.taxon_name_plus_authors.str.startswith(args.filter_name_prefix)==False)
-        df_wcvp.drop(df_wcvp[dropmask].index,inplace=True)
-        print(df_wcvp.T)
+            if args.filter:
+                dropmask = (df_wcvp.taxon_name_plus_authors.str.startswith(args.filter_name_prefix)==False)
+                df_wcvp.drop(df_wcvp[dropmask].index,inplace=True)
+                print(df_wcvp.T)
+        span['rows'] = len(df_wcvp)
     
     ###########################################################################
     # 3. Match names
     ###########################################################################
 
     # 3.1 Gather list of homonyms as these will be excluded from some of the looser matching strategies
-    dfg = df_gbif.groupby('name').agg({'family':'nunique'})
-    print('Found {} homonyms: same name (without authors), different family'.format(len(dfg[dfg.family>1])))
-    homonym_ids = df_gbif[df_gbif.name.isin(dfg[dfg.family>1].index)].taxonID
-    print('Homonyms translate to {} source records'.format(len(homonym_ids)))
+    with instrumentation.span('find_homonyms', rows=len(df_gbif)):
+        homonym_mask = findHomonyms(df_gbif)
     #
-    # 3.2 Process a sequence of match strategies, first strict, later looser
-    df_matches = None
-    match_configurations = [{'gbif_name_source':'scientificName','wcvp_name_source':'taxon_name_plus_authors','match_cols':['family','genericName'],'exclude_homonyms':False},
-                            {'gbif_name_source':'scientificName','wcvp_name_source':'taxon_name_plus_authors','match_cols':['genericName'],'exclude_homonyms':False},
-                            {'gbif_name_source':'name','wcvp_name_source':'taxon_name_minus_authors','match_cols':['family','genericName'],'exclude_homonyms':True}]
-
-    matched_ids = []
-    for i, match_configuration in enumerate(match_configurations):
-        # Exclude anything already matched in previous stages
-        mask = (df_gbif.taxonID.isin(matched_ids)==False)
-        # We may also exclude homonyms from the looser match strategies
-        if match_configuration['exclude_homonyms']:
-            print('Excluding homonyms')
-            mask = mask & (df_gbif.taxonID.isin(homonym_ids)==False)
-        # We temporarily apply column renames so that the specified name columns 
-        # are both named "match_name" for a simpler pandas join
-        gbif_renames = {match_configuration['gbif_name_source']:'match_name'}
-        wcvp_renames = {match_configuration['wcvp_name_source']:'match_name'}
-        df_match = matchNamesExactly(df_gbif[mask].rename(columns=gbif_renames)
-                                , df_wcvp.rename(columns=wcvp_renames)
-                                , id_col='taxonID'
-                                , name_col='match_name'
-                                , match_cols=match_configuration['match_cols'])    
-        num_ids_matched = df_match[df_match.match_id.notnull()].original_id.nunique()
-        print('Number of IDs matched at stage {}: {}'.format(i, num_ids_matched))
-        df_match = pd.merge(left=df_match[df_match.match_id.notnull()]
-                                , right=df_gbif[['taxonID','scientificName','name']]
-                                , left_on='original_id'
-                                , right_on='taxonID'
-                                , how='left')
-        df_match['original_name'] = df_match[match_configuration['gbif_name_source']]
-        # Save match stage for debugging any suspicious matches
-        df_match['match_stage'] = [i] * len(df_match)
-        df_matches = pd.concat([df_matches,df_match])
-        # Update the list of matched IDs so that anything that was matched can be 
-        # excluded from later (looser) match strategies
-        matched_ids = list(df_matches[df_matches.match_id.notnull()].taxonID.unique())
+    # 3.2 In incremental mode, only match the names whose results may differ
+    # from those of the previous run. Homonyms are found from all names (above)
+    gbif_taxon_ids = df_gbif.taxonID
+    if args.previous_output is not None:
+        with instrumentation.span('find_names_to_rematch') as span:
+            df_previous_gbif = prepareGbifNames(readTable(args.previous_gbif, format=args.format, sep=args.delimiter_gbif, nrows=args.limit, schema=GBIF_TAXON_SCHEMA))
+            print('Read {} previous GBIF lines from: {}'.format(len(df_previous_gbif), args.previous_gbif))
+            df_previous_wcvp = prepareWcvpNames(readWcvpNames(args.previous_wcvp, sep=args.delimiter_wcvp, nrows=args.limit))
+            print('Read {} previous WCVP lines from: {}'.format(len(df_previous_wcvp), args.previous_wcvp))
+            df_previous = readTable(args.previous_output, format=args.format, schema=GBIF2WCVP_SCHEMA)
+            print('Read {} previous output lines from: {}'.format(len(df_previous), args.previous_output))
+            rematch_mask, incremental_report = findNamesToRematch(df_gbif, df_previous_gbif, df_wcvp, df_previous_wcvp, df_previous, match_configurations)
+            df_previous = df_previous[df_previous.taxonID.isin(df_gbif.taxonID[~rematch_mask])]
+            df_gbif = df_gbif[rematch_mask]
+            homonym_mask = homonym_mask[rematch_mask]
+            span['rows'] = len(df_gbif)
+            incremental_report['previous_output_rows_reused'] = len(df_previous)
+            printIncrementalReport(incremental_report)
+            if args.incremental_report is not None:
+                import yaml
+                with open(args.incremental_report, 'w') as f:
+                    yaml.dump({'gbif2wcvp-incremental': incremental_report}, f)
     #
-    # 3.3 Output stats on matches / stage and total left unmatched
-    print('Matches by match stage:')
-    print(df_matches[df_matches.match_id.notnull()].groupby('match_stage').taxonID.nunique())
-    print('Number unmatched = {}'.format(df_gbif.taxonID.nunique() - df_matches[df_matches.match_id.notnull()].taxonID.nunique()))
+    # 3.3 Process a sequence of match strategies, first strict, later looser.
+    # The stage results are concatenated once (each stage is recorded as a
+    # span as it is drawn from the generator)
+    if args.workers > 1:
+        # With workers, the names are matched and resolved (as in 4. below)
+        # in partitions of the genera, each partition a span
+        with instrumentation.span('match', rows=len(df_gbif)):
+            if accepted_positions is None:
+                accepted_positions = buildAcceptedIndex(df_wcvp)
+            partitions = partitionMatching(df_gbif, df_wcvp, accepted_positions, homonym_mask, match_configurations, args.workers)
+            print('Matching {} partitions of the genera with {} workers'.format(len(partitions), args.workers))
+            with multiprocessing.Pool(args.workers) as pool:
+                # (imap returns the partitions in order, so the merge is deterministic)
+                results = list(instrumentation.iterate(pool.imap(matchPartition, partitions), 'match_partition_{}', rows=lambda result: len(result[0])))
+            df_matches = mergePartitionMatches(df_gbif, [df_partition for df_partition, _ in results])
+            stage_counts = pd.concat([stage_counts for _, stage_counts in results]).groupby(level=0).sum()
+        #
+        # 3.4 Output stats on matches / stage and total left unmatched
+        print('Matches by match stage:')
+        print(stage_counts)
+        print('Number unmatched = {}'.format(df_gbif.taxonID.nunique() - stage_counts.sum()))
+    else:
+        with instrumentation.span('match', rows=len(df_gbif)):
+            df_matches = pd.concat(instrumentation.iterate(matchStages(df_gbif, df_wcvp, match_configurations, homonym_mask, wcvp_encodings, accepted_positions), 'match_stage_{}'))
+        #
+        # 3.4 Output stats on matches / stage and total left unmatched
+        print('Matches by match stage:')
+        print(df_matches[df_matches.match_id.notnull()].groupby('match_stage').taxonID.nunique())
+        print('Number unmatched = {}'.format(df_gbif.taxonID.nunique() - df_matches[df_matches.match_id.notnull()].taxonID.nunique()))
 
-    ###########################################################################
-    # 4. Resolve names - getting data about the accepted name and processing 
-    # those which match to multiple names to arrive at a single decision
-    ###########################################################################
+        #######################################################################
+        # 4. Resolve names - getting data about the accepted name and processing 
+        # those which match to multiple names to arrive at a single decision
+        #######################################################################
 
-    df_matches = resolveAccepted(df_matches)
-    df_matches = resolveMultipleMatches(df_matches)
+        with instrumentation.span('resolve_accepted', rows=len(df_matches)):
+            df_matches = resolveAccepted(df_matches)
+        with instrumentation.span('resolve_multiple_matches', rows=len(df_matches)):
+            df_matches = resolveMultipleMatches(df_matches)
 
 
     ###########################################################################
     # 5. Add unmatched names
     ###########################################################################
 
-    unmatched_mask = (df_gbif.taxonID.isin(df_matches.taxonID)==False)
-    print('Adding unmatched entries from GBIF taxonomy, number of rows:', len(df_gbif[(unmatched_mask)]))
-    df_out = pd.concat([df_matches, df_gbif[(unmatched_mask)]])    
+    with instrumentation.span('add_unmatched') as span:
+        unmatched_mask = (df_gbif.taxonID.isin(df_matches.taxonID)==False)
+        print('Adding unmatched entries from GBIF taxonomy, number of rows:', len(df_gbif[(unmatched_mask)]))
+        df_out = pd.concat([df_matches, df_gbif[(unmatched_mask)]])    
+        span['rows'] = int(unmatched_mask.sum())
 
     ###########################################################################
     # 6. Add date of publication of name
     ###########################################################################
 
-    print('Adding date of publication of name')
-    df_out = pd.merge(left=df_out,right=df_wcvp[['plant_name_id','first_published']],left_on='plant_name_id',right_on='plant_name_id',how='left')
-    mask = (df_out.first_published.notnull())
-    df_out.loc[mask,'first_published_yr'] = df_out[mask]['first_published'].apply(cleanPublicationYear)
+    with instrumentation.span('add_publication_year') as span:
+        print('Adding date of publication of name')
+        df_out = pd.merge(left=df_out,right=df_wcvp[['plant_name_id','first_published']],left_on='plant_name_id',right_on='plant_name_id',how='left')
+        df_out['first_published_yr'] = cleanPublicationYears(df_out.first_published)
+        span['rows'] = int(df_out.first_published.notnull().sum())
+
+    if args.previous_output is not None:
+        print('Adding {} rows reused from the previous output'.format(len(df_previous)))
+        df_out = pd.concat([df_out, df_previous])
+    # Rows are output in the order of the GBIF names, so the output is the
+    # same whether the names were matched in one process, in partitions, or
+    # (partly) reused from a previous run
+    df_out = orderByTaxon(df_out, gbif_taxon_ids)
 
     ###########################################################################
     # 7. Output file
     ###########################################################################
-    print('Outputting {} rows to {}'.format(len(df_out), args.outputfile))
-    df_out.to_csv(args.outputfile,sep='\t',index=False)
-
-def matchNamesExactly(df, df_wcvp, id_col='id', name_col='name', match_cols=['taxon_name']):
-    print('matchNamesExactly: name_col: {}, match_cols: {}'.format(name_col, match_cols))
-    column_mapper_source={id_col:'original_id',
-                    name_col:'match_name',
-                    'plant_name_id':'match_id',
-                    'taxon_rank':'match_rank',
-                    'taxon_authors':'match_authors',
-                    'taxon_status':'match_status',
-                    'accepted_plant_name_id':'accepted_id'}
-    df_join = pd.merge(left=df
-                        ,right=df_wcvp
-                        ,left_on=match_cols+[name_col]
-                        ,right_on=match_cols+[name_col]
+    with instrumentation.span('write_output', rows=len(df_out)):
+        print('Outputting {} rows to {}'.format(len(df_out), args.outputfile))
+        writeTable(df_out, args.outputfile, format=args.format, schema=GBIF2WCVP_SCHEMA)
+    if args.spans_file is not None:
+        instrumentation.write(args.spans_file)
+
+def prepareGbifNames(df_gbif):
+    df_gbif['name'] = transliterate(concatenateColumns(df_gbif, ['genericName','specificEpithet'], na_rep='nan'))
+    return df_gbif
+
+def readWcvpNames(filepath, sep='|', nrows=None):
+    # Missing values are left as NaN (rather than replaced with None, which
+    # makes every column object typed), the name processing handles both
+    return readTable(filepath, sep=sep, nrows=nrows, schema=WCVP_NAMES_SCHEMA)
+
+def prepareWcvpNames(df_wcvp):
+    # Process homotypic synonym status
+    mask = (df_wcvp.homotypic_synonym.notnull())
+    if isinstance(df_wcvp.taxon_status.dtype, pd.CategoricalDtype) and 'Homotypic Synonym' not in df_wcvp.taxon_status.cat.categories:
+        df_wcvp['taxon_status'] = df_wcvp.taxon_status.cat.add_categories(['Homotypic Synonym'])
+    df_wcvp.loc[mask,'taxon_status'] = 'Homotypic Synonym'
+    # Add column with name plus/ minus authors
+    df_wcvp['taxon_name_plus_authors'] = concatenateColumns(df_wcvp, ['taxon_name','taxon_authors'], na_rep='None')
+    df_wcvp['taxon_name_minus_authors'] = df_wcvp['taxon_name']
+    df_wcvp.drop(columns=['taxon_name'],inplace=True)
+    # Add genericName column
+    df_wcvp['genericName'] = df_wcvp['genus']
+    return applySchema(df_wcvp, WCVP_NAMES_SCHEMA)
+
+def orderByTaxon(df, taxon_ids):
+    # Returns the rows in the order of their taxonID in taxon_ids (rows with
+    # the same taxonID in their original order)
+    taxon_ids = pd.Index(taxon_ids)
+    positions = taxon_ids[~taxon_ids.duplicated()].get_indexer(df.taxonID)
+    return df.iloc[np.argsort(positions, kind='stable')]
+
+def diffRows(df, df_previous, id_col, columns):
+    # Returns the ids of rows which are new, removed, or changed (in any of
+    # the given columns) compared with the previous version
+    hashes = pd.DataFrame({id_col: df[id_col].array, 'hash': pd.util.hash_pandas_object(df[columns], index=False).to_numpy()})
+    previous_hashes = pd.DataFrame({id_col: df_previous[id_col].array, 'hash': pd.util.hash_pandas_object(df_previous[columns], index=False).to_numpy()})
+    df_diff = pd.merge(hashes, previous_hashes, on=id_col, how='outer', suffixes=('','_previous'), indicator=True)
+    added = pd.Index(df_diff.loc[df_diff._merge == 'left_only', id_col]).unique()
+    removed = pd.Index(df_diff.loc[df_diff._merge == 'right_only', id_col]).unique()
+    changed = pd.Index(df_diff.loc[(df_diff._merge == 'both') & (df_diff.hash != df_diff.hash_previous), id_col]).unique()
+    return added, removed, changed
+
+def findNamesToRematch(df_gbif, df_previous_gbif, df_wcvp, df_previous_wcvp, df_previous, match_configurations=MATCH_CONFIGURATIONS):
+    # Boolean mask aligned to df_gbif flagging the names whose match results
+    # may differ from those in the previous output (which must have been made
+    # with the same match configurations), and a report of why
+    report = dict()
+    # GBIF names which are new or changed. If the columns differ, the output
+    # rows would too, so everything is re-matched
+    if list(df_gbif.columns) == list(df_previous_gbif.columns):
+        gbif_added, gbif_removed, gbif_changed = diffRows(df_gbif, df_previous_gbif, 'taxonID', list(df_gbif.columns))
+    else:
+        print('GBIF columns differ from those of the previous run, re-matching all names')
+        gbif_added, gbif_removed, gbif_changed = pd.Index(df_gbif.taxonID), pd.Index(df_previous_gbif.taxonID), pd.Index([])
+    report['gbif_names_added'] = len(gbif_added)
+    report['gbif_names_removed'] = len(gbif_removed)
+    report['gbif_names_changed'] = len(gbif_changed)
+    rematch_mask = df_gbif.taxonID.isin(gbif_added.union(gbif_changed)).to_numpy(dtype=bool)
+    # Names without previous output (which should not happen) are re-matched
+    missing_mask = ~df_gbif.taxonID.isin(df_previous.taxonID).to_numpy(dtype=bool) & ~rematch_mask
+    report['gbif_names_missing_from_previous_output'] = int(missing_mask.sum())
+    rematch_mask |= missing_mask
+    # GBIF names with the same match keys (in any match stage) as a new,
+    # removed or changed WCVP name, or as a WCVP name whose accepted name is
+    # one of those, as they may now match differently or have different
+    # accepted name details. In fuzzy stages the names are not keys, so all
+    # names in the same block are included
+    wcvp_added, wcvp_removed, wcvp_changed = diffRows(df_wcvp, df_previous_wcvp, 'plant_name_id', WCVP_MATCH_COLUMNS)
+    report['wcvp_names_added'] = len(wcvp_added)
+    report['wcvp_names_removed'] = len(wcvp_removed)
+    report['wcvp_names_changed'] = len(wcvp_changed)
+    wcvp_dirty_ids = wcvp_added.union(wcvp_removed).union(wcvp_changed)
+    df_wcvp_dirty = pd.concat([df[df.plant_name_id.isin(wcvp_dirty_ids) | df.accepted_plant_name_id.isin(wcvp_dirty_ids)] for df in [df_wcvp, df_previous_wcvp]])
+    wcvp_mask = np.zeros(len(df_gbif), dtype=bool)
+    for match_configuration in match_configurations:
+        key_cols = match_configuration['match_cols'] + [match_configuration['wcvp_name_source']]
+        name_cols = match_configuration['match_cols'] + [match_configuration['gbif_name_source']]
+        if match_configuration.get('fuzzy', False):
+            key_cols = name_cols = match_configuration['match_cols']
+        df_probe = df_gbif[name_cols].set_axis(key_cols, axis=1).assign(gbif_position=np.arange(len(df_gbif)))
+        # Missing keys join to each other, as in the matching
+        df_join = pd.merge(df_probe, df_wcvp_dirty[key_cols].drop_duplicates(), on=key_cols, how='inner')
+        wcvp_mask[df_join.gbif_position.to_numpy()] = True
+    wcvp_mask &= ~rematch_mask
+    report['gbif_names_rematched_for_wcvp_changes'] = int(wcvp_mask.sum())
+    rematch_mask |= wcvp_mask
+    # Names sharing a name (with or without authors) with a re-matched,
+    # removed or changed name, as homonyms are found, and multiple matches
+    # resolved, across all names with the same name. This is repeated until
+    # no more names are added
+    names = set()
+    previous_mask = df_previous_gbif.taxonID.isin(gbif_removed.union(gbif_changed))
+    for column in ['scientificName','name']:
+        names.update(df_previous_gbif[column][previous_mask].dropna())
+    shared_count = 0
+    while True:
+        for column in ['scientificName','name']:
+            names.update(df_gbif[column][rematch_mask].dropna())
+        shared_mask = (df_gbif.scientificName.isin(names) | df_gbif.name.isin(names)).to_numpy(dtype=bool) & ~rematch_mask
+        if not shared_mask.any():
+            break
+        shared_count += shared_mask.sum()
+        rematch_mask |= shared_mask
+    report['gbif_names_rematched_for_shared_names'] = int(shared_count)
+    report['gbif_names_rematched'] = int(rematch_mask.sum())
+    report['gbif_names_reused'] = int((~rematch_mask).sum())
+    return rematch_mask, report
+
+def printIncrementalReport(report):
+    print('Incremental matching:')
+    for key, value in report.items():
+        print('    {}: {}'.format(key, value))
+
+def findHomonyms(df_gbif):
+    # Boolean mask aligned to df_gbif flagging names which are homonyms: same
+    # name (without authors), different family
+    dfg = df_gbif.groupby('name').agg({'family':'nunique'})
+    print('Found {} homonyms: same name (without authors), different family'.format(len(dfg[dfg.family>1])))
+    homonym_mask = df_gbif.name.isin(dfg[dfg.family>1].index).to_numpy(dtype=bool)
+    print('Homonyms translate to {} source records'.format(homonym_mask.sum()))
+    return homonym_mask
+
+def concatenateColumns(df, columns, sep=' ', na_rep=''):
+    # Vectorized equivalent of '{} {}'.format(...) applied row-wise, na_rep
+    # gives the text that a missing value rendered as in the formatted string
+    return df[columns[0]].astype(object).str.cat([df[column] for column in columns[1:]], sep=sep, na_rep=na_rep)
+
+@functools.lru_cache(maxsize=None)
+def cachedUnidecode(s):
+    return unidecode(s)
+
+def transliterate(s):
+    # Only the distinct values containing non-ASCII characters need converting,
+    # so the unidecode calls scale with the number of distinct names, not rows
+    s = s.copy()
+    mask = s.str.contains(r'[^\x00-\x7f]', na=False)
+    if mask.any():
+        s.loc[mask] = s[mask].map({value: cachedUnidecode(value) for value in s[mask].unique()})
+    return s
+
+def encodeValues(values, categories):
+    # Integer codes for values against a fixed set of categories. Missing values
+    # code as -1 (as pandas joins missing keys to each other) and values which
+    # are not in the categories code as -2, so that they never join
+    codes = pd.Categorical(values, categories=categories).codes.astype(np.int32)
+    codes[(codes == -1) & pd.notnull(np.asarray(values))] = -2
+    return codes
+
+def encodeColumn(df_wcvp, column, encodings):
+    # Categories and codes are computed once per WCVP column, and shared by
+    # all of the indexes which use that column
+    if column not in encodings:
+        categories = pd.Index(df_wcvp[column].dropna().unique().astype(object))
+        encodings[column] = (categories, encodeValues(df_wcvp[column], categories))
+    return encodings[column]
+
+def buildNameIndex(df_wcvp, key_cols, encodings=None):
+    if encodings is None:
+        encodings = dict()
+    categories = []
+    df_keys = pd.DataFrame({'wcvp_position': np.arange(len(df_wcvp), dtype=np.int32)})
+    for i, column in enumerate(key_cols):
+        column_categories, codes = encodeColumn(df_wcvp, column, encodings)
+        categories.append(column_categories)
+        df_keys['key_{}'.format(i)] = codes
+    return {'key_cols': key_cols, 'categories': categories, 'keys': df_keys}
+
+def buildAcceptedIndex(df_wcvp):
+    # Row position of the accepted name of each WCVP name, -1 where there is none
+    ids = pd.Index(df_wcvp.plant_name_id)
+    first_mask = ~ids.duplicated()
+    positions = ids[first_mask].get_indexer(df_wcvp.accepted_plant_name_id)
+    return np.where(positions >= 0, np.arange(len(df_wcvp))[first_mask][positions], -1)
+
+def takeValues(s, positions):
+    # Values of s at the given row positions, missing where the position is -1
+    values = s.array if pd.api.types.is_extension_array_dtype(s.dtype) else s.to_numpy()
+    return pd.api.extensions.take(values, positions, allow_fill=True)
+
+def matchNamesExactly(df, df_wcvp, name_index, accepted_positions, id_col='id', name_cols=['name']):
+    print('matchNamesExactly: name_cols: {}, wcvp key_cols: {}'.format(name_cols, name_index['key_cols']))
+    key_names = ['key_{}'.format(i) for i in range(len(name_cols))]
+    df_probe = pd.DataFrame({'original_position': np.arange(len(df), dtype=np.int32)})
+    for key_name, name_col, categories in zip(key_names, name_cols, name_index['categories']):
+        df_probe[key_name] = encodeValues(df[name_col], categories)
+    df_join = pd.merge(left=df_probe
+                        ,right=name_index['keys']
+                        ,on=key_names
                         ,how='left')
-    df_join.rename(columns=column_mapper_source,inplace=True)
-    column_mapper_wcvp = {'plant_name_id':'plant_name_id',
-                    name_col:'accepted_name',
-                    'taxon_authors':'accepted_authors',
-                    'taxon_rank':'accepted_rank'}
-    df_join = pd.merge(left=df_join[list(column_mapper_source.values())] 
-                    ,right=df_wcvp.rename(columns=column_mapper_wcvp)[[col for col in column_mapper_wcvp.values()]]
-                    ,left_on='accepted_id'
-                    ,right_on='plant_name_id'
-                    ,how='left')
+    df_join = buildMatchRows(df, df_wcvp
+                        ,original_positions=df_join.original_position.to_numpy()
+                        ,match_positions=df_join.wcvp_position.fillna(-1).to_numpy(dtype=np.int64)
+                        ,accepted_positions=accepted_positions
+                        ,id_col=id_col
+                        ,name_col=name_cols[-1]
+                        ,wcvp_name_col=name_index['key_cols'][-1])
     printMatchStatistics(df_join)
 
     # Return complete join datastructure
     return df_join
 
+def buildMatchRows(df, df_wcvp, original_positions, match_positions, accepted_positions, id_col, name_col, wcvp_name_col):
+    # Output rows for pairs of names and their WCVP matches, given as row
+    # positions (match position -1 where a name is unmatched)
+    accepted = np.where(match_positions >= 0, accepted_positions[np.maximum(match_positions, 0)], -1)
+    return pd.DataFrame({'original_id': takeValues(df[id_col], original_positions),
+                    'match_name': takeValues(df[name_col], original_positions),
+                    'match_id': takeValues(df_wcvp.plant_name_id, match_positions),
+                    'match_rank': takeValues(df_wcvp.taxon_rank, match_positions),
+                    'match_authors': takeValues(df_wcvp.taxon_authors, match_positions),
+                    'match_status': takeValues(df_wcvp.taxon_status, match_positions),
+                    'accepted_id': takeValues(df_wcvp.accepted_plant_name_id, match_positions),
+                    'plant_name_id': takeValues(df_wcvp.plant_name_id, accepted),
+                    'accepted_name': takeValues(df_wcvp[wcvp_name_col], accepted),
+                    'accepted_authors': takeValues(df_wcvp.taxon_authors, accepted),
+                    'accepted_rank': takeValues(df_wcvp.taxon_rank, accepted)})
+
+def boundedLevenshtein(s, t, max_distance):
+    # Edit distance between s and t, or max_distance + 1 if it is greater.
+    # Stops as soon as every entry of a row of the distance matrix exceeds
+    # max_distance
+    if abs(len(s) - len(t)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(t) + 1))
+    for i, s_char in enumerate(s, 1):
+        current = [i]
+        for j, t_char in enumerate(t, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (s_char != t_char)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return min(previous[-1], max_distance + 1)
+
+def removeBlockPrefix(names, blocks):
+    # Row positions of the names which start with their block (genus) and a
+    # space, and the rest of each of those names
+    positions = []
+    suffixes = []
+    for position, (name, block) in enumerate(zip(names, blocks)):
+        if isinstance(name, str) and isinstance(block, str) and name.startswith(block + ' '):
+            positions.append(position)
+            suffixes.append(name[len(block) + 1:])
+    return np.array(positions, dtype=np.int64), pd.Series(suffixes, dtype=object)
+
+def qgramCodes(strings, q=2):
+    # Arrays of (position, qgram, occurrence) for the q-grams of each string,
+    # padded so that the first and last characters are in q q-grams. Each
+    # q-gram is coded as an integer from its (21 bit) code points, so q can
+    # be at most 3. The occurrence numbers repeats of a q-gram in a string,
+    # so that joining on it counts the q-grams two strings have in common as
+    # multisets
+    #
+    # The code points of all of the strings are held in one flat buffer, with
+    # the q-grams of each string starting at its offset in the buffer, so
+    # memory use does not depend on the length of the longest string
+    padded = ['#' * (q - 1) + string + '#' * (q - 1) for string in strings]
+    lengths = np.array([len(string) for string in padded], dtype=np.int64)
+    chars = np.frombuffer(''.join(padded).encode('utf-32-le'), dtype=np.uint32)
+    offsets = np.cumsum(lengths) - lengths
+    counts = np.maximum(lengths - q + 1, 0)
+    positions = np.repeat(np.arange(len(padded), dtype=np.int64), counts)
+    starts = np.repeat(offsets - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum(), dtype=np.int64)
+    qgrams = np.zeros(len(starts), dtype=np.int64)
+    for offset in range(q):
+        qgrams = (qgrams << 21) | chars[starts + offset].astype(np.int64)
+    # Number the repeats of each q-gram within each string
+    order = np.lexsort((qgrams, positions))
+    positions, qgrams = positions[order], qgrams[order]
+    new_run = np.ones(len(positions), dtype=bool)
+    new_run[1:] = (positions[1:] != positions[:-1]) | (qgrams[1:] != qgrams[:-1])
+    run_starts = np.maximum.accumulate(np.where(new_run, np.arange(len(positions)), 0))
+    return positions, qgrams, np.arange(len(positions)) - run_starts
+
+class QgramIndex:
+    # The q-grams of a set of strings, each in a block, sorted on an integer
+    # key combining the block, q-gram and occurrence, so that the strings
+    # sharing each q-gram of another string in the same block are found with
+    # a binary search
+    def __init__(self, strings, blocks, q=2):
+        self.q = q
+        positions, qgrams, occurrences = qgramCodes(strings, q)
+        self.vocabulary = np.unique(qgrams)
+        self.occurrence_count = occurrences.max() + 1 if len(occurrences) else 1
+        keys = self.keys(blocks[positions], np.searchsorted(self.vocabulary, qgrams), occurrences)
+        order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[order]
+        self.sorted_positions = positions[order]
+
+    def keys(self, blocks, qgram_indexes, occurrences):
+        return (blocks.astype(np.int64) * len(self.vocabulary) + qgram_indexes) * self.occurrence_count + occurrences
+
+    def sharedCounts(self, strings, blocks):
+        # Returns arrays of (string position, indexed string position, number
+        # of shared q-grams) for the pairs of strings sharing any q-grams
+        positions, qgrams, occurrences = qgramCodes(strings, self.q)
+        if len(self.vocabulary) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        # Only q-grams (and repeats) which are in the index can be shared
+        qgram_indexes = np.minimum(np.searchsorted(self.vocabulary, qgrams), len(self.vocabulary) - 1)
+        known = (self.vocabulary[qgram_indexes] == qgrams) & (occurrences < self.occurrence_count)
+        positions = positions[known]
+        keys = self.keys(blocks[positions], qgram_indexes[known], occurrences[known])
+        lefts = np.searchsorted(self.sorted_keys, keys, side='left')
+        counts = np.searchsorted(self.sorted_keys, keys, side='right') - lefts
+        # Expand each q-gram to the indexed strings sharing it
+        total = counts.sum()
+        offsets = np.repeat(lefts - (np.cumsum(counts) - counts), counts) + np.arange(total)
+        pair_keys = np.repeat(positions, counts) * len(self.sorted_positions) + self.sorted_positions[offsets]
+        pair_keys, shared = np.unique(pair_keys, return_counts=True)
+        return pair_keys // len(self.sorted_positions), pair_keys % len(self.sorted_positions), shared
+
+def matchNamesFuzzily(df, df_wcvp, block_encoding, accepted_positions, id_col='id', name_col='name', wcvp_name_col='taxon_name_minus_authors', block_col='genericName', max_distance=2, max_relative_distance=0.2, q=2, batchsize=20000):
+    # Matches names to the WCVP names in the same block (genus) with the
+    # smallest edit distance, if this is within max_distance and within
+    # max_relative_distance of the length of the name after the genus.
+    # Comparing every pair of names in a block is too slow for the large
+    # genera, so candidate pairs are found from the q-grams they share: a
+    # pair of strings within edit distance k share at least 
+    # (longest length + q - 1) - k * q padded q-grams. Only the candidates
+    # are compared with (bounded) edit distance. The genus (and following
+    # space) is the same in both names, so is left out of the comparison
+    print('matchNamesFuzzily: name_col: {}, wcvp name_col: {}, block_col: {}, max_distance: {}, max_relative_distance: {}'.format(name_col, wcvp_name_col, block_col, max_distance, max_relative_distance))
+    block_categories, wcvp_block_codes = block_encoding
+    # Names to match, and their part after the genus
+    block_codes = encodeValues(df[block_col], block_categories)
+    probe_positions, probe_names = removeBlockPrefix(df[name_col], df[block_col])
+    in_wcvp_block = block_codes[probe_positions] >= 0
+    probe_positions = probe_positions[in_wcvp_block]
+    probe_names = probe_names[in_wcvp_block].reset_index(drop=True)
+    probe_blocks = block_codes[probe_positions]
+    probe_lengths = probe_names.str.len().to_numpy(dtype=np.int64)
+    probe_max_distances = np.minimum(max_distance, np.floor(max_relative_distance * probe_lengths).astype(np.int64))
+    # WCVP names in the blocks of the names to match, and their part after
+    # the genus
+    wcvp_positions = np.flatnonzero(np.isin(wcvp_block_codes, np.unique(probe_blocks)))
+    block_positions, candidate_names = removeBlockPrefix(df_wcvp[wcvp_name_col].iloc[wcvp_positions], df_wcvp[block_col].iloc[wcvp_positions])
+    wcvp_positions = wcvp_positions[block_positions]
+    candidate_blocks = np.asarray(wcvp_block_codes)[wcvp_positions]
+    candidate_lengths = candidate_names.str.len().to_numpy(dtype=np.int64)
+    qgram_index = QgramIndex(candidate_names, candidate_blocks, q)
+    df_candidates = pd.DataFrame({'block': candidate_blocks, 'candidate': np.arange(len(candidate_blocks))})
+
+    original_positions = []
+    match_positions = []
+    distances = []
+    pair_count = 0
+    for start in range(0, len(probe_positions), batchsize):
+        batch = np.arange(start, min(start + batchsize, len(probe_positions)))
+        # Count the q-grams each name shares with the WCVP names in its block
+        probes, candidates, shared = qgram_index.sharedCounts(probe_names.iloc[batch], probe_blocks[batch])
+        probes = batch[probes]
+        # Names which are short enough for the q-gram bound not to exclude
+        # anything are compared with every WCVP name in their block
+        unbounded = batch[(probe_lengths[batch] + q - 1 - probe_max_distances[batch] * q) <= 0]
+        if len(unbounded):
+            df_unbounded = pd.merge(pd.DataFrame({'probe': unbounded, 'block': probe_blocks[unbounded]}), df_candidates, on='block')
+            keep = ~np.isin(probes, unbounded)
+            probes = np.concatenate([probes[keep], df_unbounded.probe.to_numpy()])
+            candidates = np.concatenate([candidates[keep], df_unbounded.candidate.to_numpy()])
+            shared = np.concatenate([shared[keep], np.zeros(len(df_unbounded), dtype=shared.dtype)])
+        pair_max_distances = probe_max_distances[probes]
+        longest = np.maximum(probe_lengths[probes], candidate_lengths[candidates])
+        keep = ((np.abs(probe_lengths[probes] - candidate_lengths[candidates]) <= pair_max_distances)
+                & ((shared >= longest + q - 1 - pair_max_distances * q) | np.isin(probes, unbounded)))
+        probes, candidates, pair_max_distances = probes[keep], candidates[keep], pair_max_distances[keep]
+        pair_count += len(probes)
+        # Compare the candidate pairs, keeping the closest match(es) of each name
+        pair_distances = np.array([boundedLevenshtein(probe_names.iat[probe], candidate_names.iat[candidate], pair_max_distance)
+                                    for probe, candidate, pair_max_distance in zip(probes, candidates, pair_max_distances)], dtype=np.int64)
+        df_distances = pd.DataFrame({'probe': probes, 'candidate': candidates, 'distance': pair_distances})
+        df_distances = df_distances[df_distances.distance <= pair_max_distances]
+        df_distances = df_distances[df_distances.distance == df_distances.groupby('probe').distance.transform('min')].sort_values(['probe','candidate'])
+        original_positions.append(probe_positions[df_distances.probe.to_numpy()])
+        match_positions.append(wcvp_positions[df_distances.candidate.to_numpy()])
+        distances.append(df_distances.distance.to_numpy())
+    print('Compared {} candidate pairs for {} names'.format(pair_count, len(probe_positions)))
+
+    original_positions = np.concatenate(original_positions + [np.array([], dtype=np.int64)]).astype(np.int64)
+    match_positions = np.concatenate(match_positions + [np.array([], dtype=np.int64)]).astype(np.int64)
+    distances = np.concatenate(distances + [np.array([], dtype=np.int64)])
+    # Unmatched names are included (with match position -1), as from
+    # matchNamesExactly
+    unmatched_positions = np.setdiff1d(np.arange(len(df)), original_positions)
+    order = np.argsort(np.concatenate([original_positions, unmatched_positions]), kind='stable')
+    df_join = buildMatchRows(df, df_wcvp
+                        ,original_positions=np.concatenate([original_positions, unmatched_positions])[order]
+                        ,match_positions=np.concatenate([match_positions, np.full(len(unmatched_positions), -1)])[order]
+                        ,accepted_positions=accepted_positions
+                        ,id_col=id_col
+                        ,name_col=name_col
+                        ,wcvp_name_col=wcvp_name_col)
+    df_join['match_distance'] = np.concatenate([distances, np.full(len(unmatched_positions), np.nan)])[order]
+    printMatchStatistics(df_join)
+    return df_join
+
+def matchStages(df_gbif, df_wcvp, match_configurations, homonym_mask=None, wcvp_encodings=None, accepted_positions=None):
+    # Generator yielding the matched names from each match stage in turn
+    #
+    # Build the WCVP lookup indexes once, these are keyed on integer codes
+    # for the match columns and name, and are shared by the match stages.
+    # The codes and accepted name positions can be passed in precomputed
+    # (eg from the compiled WCVP index)
+    if wcvp_encodings is None:
+        wcvp_encodings = dict()
+    name_indexes = dict()
+    for match_configuration in match_configurations:
+        key_cols = match_configuration['match_cols'] + [match_configuration['wcvp_name_source']]
+        if not match_configuration.get('fuzzy', False) and tuple(key_cols) not in name_indexes:
+            name_indexes[tuple(key_cols)] = buildNameIndex(df_wcvp, key_cols, wcvp_encodings)
+    if accepted_positions is None:
+        accepted_positions = buildAcceptedIndex(df_wcvp)
+
+    # Boolean masks aligned to df_gbif, flagging the names matched in earlier
+    # stages and the homonyms
+    matched_mask = np.zeros(len(df_gbif), dtype=bool)
+    if homonym_mask is None:
+        homonym_mask = np.zeros(len(df_gbif), dtype=bool)
+    for i, match_configuration in enumerate(match_configurations):
+        # Exclude anything already matched in previous stages
+        mask = ~matched_mask
+        # We may also exclude homonyms from the looser match strategies
+        if match_configuration['exclude_homonyms']:
+            print('Excluding homonyms')
+            mask = mask & ~homonym_mask
+        candidate_positions = np.flatnonzero(mask)
+        df_candidates = df_gbif.iloc[candidate_positions]
+        if match_configuration.get('fuzzy', False):
+            # Compare names within blocks of the (last) match column
+            block_col = match_configuration['match_cols'][-1]
+            df_match = matchNamesFuzzily(df_candidates
+                                , df_wcvp
+                                , block_encoding=encodeColumn(df_wcvp, block_col, wcvp_encodings)
+                                , accepted_positions=accepted_positions
+                                , id_col='taxonID'
+                                , name_col=match_configuration['gbif_name_source']
+                                , wcvp_name_col=match_configuration['wcvp_name_source']
+                                , block_col=block_col
+                                , max_distance=match_configuration['max_distance']
+                                , max_relative_distance=match_configuration['max_relative_distance'])
+        else:
+            # Probe the WCVP index built for the match columns and WCVP name source
+            # with the same columns from GBIF, using the GBIF name source
+            key_cols = match_configuration['match_cols'] + [match_configuration['wcvp_name_source']]
+            df_match = matchNamesExactly(df_candidates
+                                    , df_wcvp
+                                    , name_index=name_indexes[tuple(key_cols)]
+                                    , accepted_positions=accepted_positions
+                                    , id_col='taxonID'
+                                    , name_cols=match_configuration['match_cols'] + [match_configuration['gbif_name_source']])
+        num_ids_matched = df_match[df_match.match_id.notnull()].original_id.nunique()
+        print('Number of IDs matched at stage {}: {}'.format(i, num_ids_matched))
+        df_match = pd.merge(left=df_match[df_match.match_id.notnull()]
+                                , right=df_candidates[['taxonID','scientificName','name']]
+                                , left_on='original_id'
+                                , right_on='taxonID'
+                                , how='left')
+        df_match['original_name'] = df_match[match_configuration['gbif_name_source']]
+        # Save match stage for debugging any suspicious matches
+        df_match['match_stage'] = i
+        # Flag anything that was matched so that it can be excluded from later
+        # (looser) match strategies. This only touches the names which were
+        # candidates in this stage, not everything matched so far
+        matched_mask[candidate_positions[df_candidates.taxonID.isin(df_match.taxonID).to_numpy(dtype=bool)]] = True
+        yield df_match
+
+def partitionGenera(df_gbif, partition_count):
+    # Partition number of each GBIF name, from a hash of its genus. The names
+    # of all of the genera which share a name (scientificName or name, eg
+    # after transliteration) are put in the same partition, as multiple
+    # matches are resolved across all of the rows with the same name. Missing
+    # genera are treated as a genus, as missing keys join to each other.
+    # Returns the partition of each name and of each genus (and the genera)
+    genus_codes, genera = pd.factorize(df_gbif.genericName.astype(object), use_na_sentinel=False)
+    # Label each genus with the lowest code of the genera it shares names
+    # with, repeated until no labels change
+    labels = pd.Series(genus_codes, dtype=np.int64)
+    while True:
+        previous_labels = labels
+        for column in ['scientificName','name']:
+            labels = labels.groupby(df_gbif[column].to_numpy()).transform('min').fillna(labels).astype(np.int64)
+        labels = labels.groupby(genus_codes).transform('min').astype(np.int64)
+        if labels.equals(previous_labels):
+            break
+    genus_labels = np.zeros(len(genera), dtype=np.int64)
+    genus_labels[genus_codes] = labels.to_numpy()
+    genus_partitions = (pd.util.hash_array(pd.Index(genera).astype(str).to_numpy(dtype=object)) % partition_count).astype(np.int64)[genus_labels]
+    return genus_partitions[genus_codes], genus_partitions, pd.Index(genera)
+
+def partitionMatching(df_gbif, df_wcvp, accepted_positions, homonym_mask, match_configurations, partition_count):
+    # The inputs to matchPartition for each (non empty) partition of the
+    # genera: the GBIF names in the partition, and the WCVP names in the same
+    # genera together with their accepted names (which may be in other
+    # genera), with the positions of these in the partition. Homonyms are
+    # found across all names beforehand, so their mask is partitioned too
+    gbif_partitions, genus_partitions, genera = partitionGenera(df_gbif, partition_count)
+    wcvp_genus_codes = genera.get_indexer(df_wcvp.genericName.astype(object))
+    wcvp_partitions = np.where(wcvp_genus_codes >= 0, genus_partitions[np.maximum(wcvp_genus_codes, 0)], -1)
+    partitions = []
+    for partition in range(partition_count):
+        gbif_positions = np.flatnonzero(gbif_partitions == partition)
+        if len(gbif_positions) == 0:
+            continue
+        wcvp_positions = np.flatnonzero(wcvp_partitions == partition)
+        partition_accepted = accepted_positions[wcvp_positions]
+        wcvp_positions = np.union1d(wcvp_positions, partition_accepted[partition_accepted >= 0])
+        # Accepted name positions within the partition (only those of the
+        # names in the partition's genera are used)
+        partition_accepted = accepted_positions[wcvp_positions]
+        local_positions = np.minimum(np.searchsorted(wcvp_positions, partition_accepted), len(wcvp_positions) - 1)
+        partition_accepted = np.where((partition_accepted >= 0) & (wcvp_positions[local_positions] == partition_accepted), local_positions, -1)
+        partitions.append({'df_gbif': df_gbif.iloc[gbif_positions]
+                           ,'df_wcvp': df_wcvp.iloc[wcvp_positions]
+                           ,'accepted_positions': partition_accepted
+                           ,'homonym_mask': homonym_mask[gbif_positions]
+                           ,'match_configurations': match_configurations})
+    return partitions
+
+def matchPartition(partition):
+    # Runs in a pool process: matches the names of a partition in each match
+    # stage, and resolves them (as in main). Returns the resolved matches,
+    # flagged where they were resolved from multiple matches, and the number
+    # of names matched in each stage. The output of the stages is discarded
+    with contextlib.redirect_stdout(io.StringIO()):
+        df_matches = pd.concat(matchStages(partition['df_gbif'], partition['df_wcvp'], partition['match_configurations'], partition['homonym_mask'], accepted_positions=partition['accepted_positions']))
+        stage_counts = df_matches[df_matches.match_id.notnull()].groupby('match_stage').taxonID.nunique()
+        df_matches['multiple_match'] = (df_matches.groupby('original_name')['match_id'].transform('nunique') > 1).to_numpy()
+        df_matches = resolveMultipleMatches(resolveAccepted(df_matches))
+    return df_matches, stage_counts
+
+def mergePartitionMatches(df_gbif, partition_matches):
+    # The resolved matches of the partitions, in the order of a single
+    # process run: names with a single match grouped by name, in match stage
+    # and then GBIF order, followed by those resolved from multiple matches
+    # in name order
+    df_matches = pd.concat(partition_matches)
+    multiple_mask = df_matches.pop('multiple_match').to_numpy(dtype=bool)
+    df_single = df_matches[~multiple_mask]
+    taxon_ids = pd.Index(df_gbif.taxonID)
+    gbif_positions = taxon_ids[~taxon_ids.duplicated()].get_indexer(df_single.taxonID)
+    df_single = groupByName(df_single.iloc[np.lexsort((gbif_positions, df_single.match_stage.to_numpy()))])
+    df_multi = df_matches[multiple_mask].sort_values('original_name', kind='stable')
+    return pd.concat([df_single, df_multi])
+
 def printMatchStatistics(df):
     # Multiple matches
     dfg = df.groupby('original_id').size()
@@ -191,65 +788,55 @@ def printMatchStatistics(df):
     unmatched_name_count = df[df['match_id'].isnull()]['original_id'].nunique()
     print('Unmatched names: {}'.format(unmatched_name_count))
 
-def extractRank(s):
-    rank = None
-    m = re.search(r'(?<= )(var\.|ssp\.|subsp\.|f.)(?= )',s)
-    if m:
-        rank = m.groups()[0]
-        if rank == 'ssp.':
-            rank = 'subsp.'
-    return rank
-
-def resolveMultiGroup(dfg):
-    matched_row = None
-    original_name = dfg['original_name'].unique()[0]
-    if len(dfg) == 1:
-        matched_row = dfg
-    # If the name to match is an infraspecific, take the match with the right rank
-    rank = extractRank(original_name)
-    if matched_row is None and rank is not None:
-        padded_rank = ' {} '.format(rank)
-        mask = (dfg.original_name.str.contains(padded_rank))
-        if len(dfg[mask]) == 1:
-            matched_row = dfg[mask]
-    # If there is an accepted name present, take that
-    if matched_row is None:
-        mask = (dfg.match_status == 'Accepted')
-        if len(dfg[mask]) == 1:
-            matched_row = dfg[mask]
-    # If there is an orthographic variant present, take that
-    if matched_row is None:
-        mask = (dfg.match_status == 'Orthographic')
-        if len(dfg[mask]) == 1:
-            matched_row = dfg[mask]
-    # If there is a homotypic synonym present, take that
-    if matched_row is None:
-        mask = (dfg.match_status == 'Homotypic Synonym')
-        if len(dfg[mask]) == 1:
-            matched_row = dfg[mask]
-    return matched_row
-
 def resolveMultipleMatches(df):
-    dfg = df.groupby('original_name')['match_id'].nunique().to_frame('match_count')
-
-    df_single = pd.merge(left=df,
-                        right=dfg[dfg.match_count==1],
-                        left_on='original_name',
-                        right_index=True,
-                        how='inner').drop(columns='match_count')
-
-    df_multi = pd.merge(left=df,
-                        right=dfg[dfg.match_count>1],
-                        left_on='original_name',
-                        right_index=True,
-                        how='inner').drop(columns='match_count')
-
-    # Group df_multi and resolve at group level
-    df_multi = df_multi.groupby('original_name').apply(lambda x: resolveMultiGroup(x))
+    match_count = df.groupby('original_name')['match_id'].transform('nunique')
+
+    df_single = groupByName(df[(match_count==1).to_numpy()])
+    df_multi = df[(match_count>1).to_numpy()].reset_index(drop=True)
+
+    # Resolve the groups of rows sharing an original_name with a cascade of
+    # rules. Each rule flags candidate rows, and a group is resolved by the
+    # first rule which flags exactly one of its rows
+    group_codes, group_names = pd.factorize(df_multi.original_name)
+    group_count = len(group_names)
+    resolved_groups = np.zeros(group_count, dtype=bool)
+    selected_rows = np.zeros(len(df_multi), dtype=bool)
+    for candidate_rows in multiMatchCandidates(df_multi):
+        candidate_counts = np.bincount(group_codes[candidate_rows], minlength=group_count)
+        newly_resolved_groups = (candidate_counts == 1) & ~resolved_groups
+        selected_rows |= candidate_rows & newly_resolved_groups[group_codes]
+        resolved_groups |= newly_resolved_groups
+    # Unresolved groups are dropped, resolved groups are output in name order
+    df_multi = df_multi[selected_rows].sort_values('original_name', kind='stable')
     df_multi.reset_index(drop=True, inplace=True)
 
     return pd.concat([df_single, df_multi])
 
+def groupByName(df):
+    # Returns the rows grouped by original_name, with the names in the order
+    # in which they first appear, and rows in their original order within
+    # each name
+    name_codes, _ = pd.factorize(df.original_name)
+    return df.iloc[np.argsort(name_codes, kind='stable')]
+
+def multiMatchCandidates(df):
+    # Generator yielding boolean masks of candidate rows for each rule, in order
+    #
+    # A group with a single row is resolved to that row
+    yield np.ones(len(df), dtype=bool)
+    # If the name to match is an infraspecific, take the match with the right rank
+    ranks = df.original_name.str.extract(RANK_PATTERN, expand=False).replace({'ssp.':'subsp.'})
+    rank_mask = np.zeros(len(df), dtype=bool)
+    for rank in ranks.dropna().unique():
+        rows = (ranks == rank).to_numpy(dtype=bool, na_value=False)
+        padded_rank = ' {} '.format(rank)
+        rank_mask[rows] = df.original_name[rows].str.contains(padded_rank).to_numpy(dtype=bool, na_value=False)
+    yield rank_mask
+    # If there is an accepted name present, take that, then an orthographic
+    # variant, then a homotypic synonym
+    for status in ['Accepted','Orthographic','Homotypic Synonym']:
+        yield (df.match_status == status).to_numpy(dtype=bool, na_value=False)
+
 def resolveAccepted(df, blank_columns=False):
     # print(df)
     prefix_to_status_mapper={'match':['Accepted'],'accepted':['Homotypic Synonym','Orthographic']}
@@ -260,11 +847,13 @@ def resolveAccepted(df, blank_columns=False):
             source_column = '{}_{}'.format(prefix,column)
             dest_column = dest_prefix + column
             #print('{}: {}->{}'.format(','.join(statuses), source_column, dest_column))
-            df.loc[mask,dest_column]= df[mask][source_column]
+            # (where rather than assigning to a slice, as pyarrow backed
+            # string columns do not support setting a masked selection)
+            df[dest_column] = df[source_column].where(mask, df[dest_column])
     if blank_columns:
         for column in ['id','authors','rank','name',]:
             dest_column = dest_prefix + column
-            df.loc[~df.match_status.isin(['Accepted','Homotypic Synonym','Orthographic']),dest_column]= None
+            df[dest_column] = df[dest_column].where(df.match_status.isin(['Accepted','Homotypic Synonym','Orthographic']))
     # print(df)
     return df
 
@@ -284,5 +873,23 @@ def cleanPublicationYear(s):
         year = None
     return year
 
+def cleanPublicationYears(s):
+    # cleanPublicationYear over a column, as nullable integers. The year is
+    # extracted (by PUBLICATION_YEAR_PATTERN) from each distinct value once,
+    # as there are far fewer publication dates than names
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        # (as read, see WCVP_NAMES_SCHEMA) the distinct values are the
+        # categories, and missing values have the code -1
+        distinct = s.cat.categories
+        positions = s.cat.codes.to_numpy()
+    else:
+        distinct = pd.Index(np.asarray(s.dropna().unique(), dtype=object))
+        positions = distinct.get_indexer(s.astype(object))
+    values = pd.Series(distinct, dtype=object).str.replace('(','',regex=False).str.replace(')','',regex=False)
+    df_years = values.str.extract(PUBLICATION_YEAR_PATTERN, flags=re.DOTALL)
+    years = pd.array(df_years[0].fillna(df_years[1]).astype(float), dtype='Int64')
+    # Missing values are at position -1, which is filled with NA
+    return pd.Series(years.take(positions, allow_fill=True), index=s.index, name='first_published_yr')
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,28 @@
+import pandas as pd
+from tableio import OCCURRENCE_SCHEMA
+
+# Reader for the GBIF occurrence download of type specimens (data/gbif-types.zip).
+# The download has a large number of columns, but the analyses only use a 
+# few of these, so only the requested columns are read (in batches, dropping 
+# unwanted occurrences from each) with their types set on read.
+
+OCCURRENCE_COLUMNS=['gbifID','typeStatus','taxonKey','publishingOrgKey','year']
+
+def readOccurrences(filepath, sep='\t', nrows=None, usecols=OCCURRENCE_COLUMNS, exclude_notatype=False, batchsize=1000000):
+    # Returns the occurrences as a single dataframe, optionally excluding 
+    # those with typeStatus NOTATYPE. Columns without a type in 
+    # OCCURRENCE_SCHEMA are left for pandas to infer
+    readcols = list(usecols)
+    if exclude_notatype and 'typeStatus' not in readcols:
+        readcols.append('typeStatus')
+    dtype = {column: dtype for column, dtype in OCCURRENCE_SCHEMA.items() if column in readcols and dtype != 'category'}
+    chunks = []
+    for df in pd.read_csv(filepath, sep=sep, nrows=nrows, usecols=readcols, dtype=dtype, chunksize=batchsize):
+        if exclude_notatype:
+            df = df[~df.typeStatus.isin(['NOTATYPE'])]
+        chunks.append(df.drop(columns=[column for column in readcols if column not in usecols]))
+    df = pd.concat(chunks, ignore_index=True)
+    # Categories are set once all batches are read, so that all share the 
+    # same categories
+    columns = {column: df[column].astype(dtype) for column, dtype in OCCURRENCE_SCHEMA.items() if column in usecols and dtype == 'category'}
+    return df.assign(**columns)
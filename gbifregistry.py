@@ -0,0 +1,143 @@
+import concurrent.futures
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+
+# Lookups of GBIF registry organization metadata, keyed by organization UUID.
+# Lookups are made concurrently in a pool of threads (they spend their time
+# waiting on the network) and can be stored in an on-disk cache, so that
+# re-runs do not need to query the registry again. Transports return None for
+# organizations unknown to the registry, which are cached too, while failed
+# lookups (eg network errors) are not.
+
+GBIF_API_URL='https://api.gbif.org/v1'
+
+class PygbifTransport:
+    # Fetches organization metadata using pygbif (the default)
+    def getOrganization(self, key):
+        from pygbif import registry
+        import requests
+        try:
+            return registry.organizations(data='all', uuid=key)['data']
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+
+class HttpTransport:
+    # Fetches organization metadata from a registry API at base_url, eg a
+    # local stub server (HTTP errors other than 404 are raised as
+    # urllib.error.HTTPError)
+    def __init__(self, base_url=GBIF_API_URL, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def getOrganization(self, key):
+        try:
+            with urllib.request.urlopen('{}/organization/{}'.format(self.base_url, key), timeout=self.timeout) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+class OrganizationCache:
+    # A directory holding one JSON file per organization UUID (with null data
+    # for organizations unknown to the registry). Entries older than ttl_days
+    # are treated as missing and evicted. The cache can be shared by
+    # concurrent runs
+    def __init__(self, directory, ttl_days=30):
+        self.directory = directory
+        self.ttl = ttl_days * 24 * 60 * 60
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, '{}.json'.format(key))
+
+    def get(self, key):
+        # Returns the entry ({'fetched': time, 'data': metadata}), or None if
+        # there is none (or it has expired)
+        try:
+            with open(self.path(key), encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry['fetched'] > self.ttl:
+            return None
+        return entry
+
+    def put(self, key, data):
+        # Write to a temporary file first so that a partly written entry is
+        # never read
+        filepath = self.path(key)
+        temp_filepath = '{}.{}.tmp'.format(filepath, os.getpid())
+        with open(temp_filepath, 'w', encoding='utf-8') as f:
+            json.dump({'fetched': time.time(), 'data': data}, f)
+        os.replace(temp_filepath, filepath)
+
+    def evictExpired(self):
+        # Removes expired (or unreadable) entries, and temporary files left
+        # by runs which did not finish writing them. Temporary files younger
+        # than the TTL may be being written by another run, so are kept, as
+        # are any other files
+        evicted = 0
+        now = time.time()
+        for filename in os.listdir(self.directory):
+            filepath = os.path.join(self.directory, filename)
+            try:
+                if filename.endswith('.json'):
+                    try:
+                        with open(filepath, encoding='utf-8') as f:
+                            expired = now - json.load(f)['fetched'] > self.ttl
+                    except (ValueError, KeyError, TypeError):
+                        expired = True
+                elif filename.endswith('.tmp'):
+                    expired = now - os.path.getmtime(filepath) > self.ttl
+                else:
+                    expired = False
+                if expired:
+                    os.remove(filepath)
+                    evicted += 1
+            except FileNotFoundError:
+                # Replaced or evicted by another run meanwhile
+                pass
+        return evicted
+
+def getOrganizationData(key, transport):
+    # Returns the organization metadata (None for keys which cannot be looked
+    # up, eg missing keys, or those unknown to the registry) and the error if
+    # the lookup failed
+    if not isinstance(key, str):
+        return None, None
+    try:
+        return transport.getOrganization(key), None
+    except Exception as e:
+        return None, e
+
+def getOrganizationsData(keys, transport=None, cache=None, workers=8):
+    # Returns a dict of organization metadata, in the order of keys
+    keys = list(keys)
+    if transport is None:
+        transport = PygbifTransport()
+    metadata = dict()
+    if cache is not None:
+        cache.evictExpired()
+        entries = {key: cache.get(key) for key in keys if isinstance(key, str)}
+        metadata = {key: entry['data'] for key, entry in entries.items() if entry is not None}
+    missing_keys = [key for key in keys if key not in metadata]
+    print('Looking up {} organizations in the GBIF registry ({} cached)'.format(len(missing_keys), len(metadata)))
+    failures = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for key, (data, error) in zip(missing_keys, executor.map(lambda key: getOrganizationData(key, transport), missing_keys)):
+            metadata[key] = data
+            if error is not None:
+                failures[key] = error
+            if cache is not None and isinstance(key, str) and error is None:
+                cache.put(key, data)
+    if failures:
+        print('Registry lookup failed for {} organizations, eg:'.format(len(failures)))
+        for key, error in list(failures.items())[:5]:
+            print('  {}: {}'.format(key, error))
+    return {key: metadata[key] for key in keys}
@@ -0,0 +1,161 @@
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import time
+
+# Records the wall time, CPU time, peak RSS and number of rows of named spans
+# of a script (its numbered sections), so that we can see where the time and
+# memory of a run go. Spans can be nested, and can be written as a JSON or
+# YAML sidecar file alongside the script's output. One span can also be
+# profiled with cProfile.
+#
+# The peak RSS of each span is its own: on Linux the high water mark of the
+# process RSS is reset as each span starts (by writing to
+# /proc/self/clear_refs), and folded into the peaks of all of the spans open
+# at the time before each reset. Elsewhere the peak is that of the process
+# up to the end of the span. CPU time is that of this process, so excludes
+# any worker processes.
+
+# Highest RSS high water mark read so far, as it is reset for each span
+_peak_rss_mb = 0
+
+def readRssHighWaterMb():
+    # The high water mark of the RSS since it was last reset (or since the
+    # process started), from /proc on Linux, ru_maxrss elsewhere
+    global _peak_rss_mb
+    rss_mb = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    rss_mb = int(line.split()[1]) / 1024
+                    break
+    except OSError:
+        pass
+    if rss_mb is None:
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    _peak_rss_mb = max(_peak_rss_mb, rss_mb)
+    return rss_mb
+
+def resetRssHighWater():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peakRssMb():
+    # Peak RSS of this process, including that before any resets
+    readRssHighWaterMb()
+    return _peak_rss_mb
+
+def addInstrumentationArguments(parser):
+    parser.add_argument('--spans_file', type=str, default=None, help='Path to JSON (or, if named .yaml, YAML) file to write the time, memory and rows of each section of the run to')
+    parser.add_argument('--profile_span', type=str, default=None, help='Name of a section (as in --spans_file) to profile with cProfile')
+    parser.add_argument('--profile_file', type=str, default=None, help='Path to write the --profile_span profile to, defaults to <span>.prof')
+
+class Instrumentation:
+    def __init__(self, script, profile_span=None, profile_filepath=None):
+        self.script = script
+        self.spans = []
+        self.open_spans = []
+        self.profile_span = profile_span
+        self.profile_filepath = profile_filepath if profile_filepath is not None else '{}.prof'.format(profile_span)
+        self.profiler = None
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    @classmethod
+    def fromArgs(cls, script, args):
+        return cls(script, profile_span=args.profile_span, profile_filepath=args.profile_file)
+
+    def foldRssHighWater(self):
+        rss_mb = readRssHighWaterMb()
+        for span in self.open_spans:
+            span['peak_rss_mb'] = max(span['peak_rss_mb'], rss_mb)
+
+    def startSpan(self, name):
+        self.foldRssHighWater()
+        resetRssHighWater()
+        span = {'span': name
+                ,'parent': self.open_spans[-1]['span'] if self.open_spans else None
+                ,'seconds': time.perf_counter()
+                ,'cpu_seconds': time.process_time()
+                ,'peak_rss_mb': readRssHighWaterMb()
+                ,'rows': None}
+        self.open_spans.append(span)
+        # Spans are listed in the order they start, so parents come first
+        self.spans.append(span)
+        if name == self.profile_span:
+            if self.profiler is None:
+                self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return span
+
+    def stopSpan(self, span, record=True):
+        if span['span'] == self.profile_span:
+            self.profiler.disable()
+            # Spans entered more than once (eg in a loop) are profiled together
+            self.profiler.dump_stats(self.profile_filepath)
+        self.foldRssHighWater()
+        self.open_spans.remove(span)
+        span['seconds'] = round(time.perf_counter() - span['seconds'], 3)
+        span['cpu_seconds'] = round(time.process_time() - span['cpu_seconds'], 3)
+        span['peak_rss_mb'] = round(span['peak_rss_mb'], 1)
+        if not record:
+            self.spans.remove(span)
+
+    @contextlib.contextmanager
+    def span(self, name, rows=None):
+        # Yields the span record, so that the rows can be set in the block
+        # (eg span['rows'] = len(df)). As a context manager made by
+        # contextlib, this can also decorate a function
+        span = self.startSpan(name)
+        span['rows'] = rows
+        try:
+            yield span
+        finally:
+            self.stopSpan(span)
+
+    def iterate(self, items, name, rows=None):
+        # Yields the items of an iterable (eg a generator of stage results),
+        # recording the drawing of each as a span named name.format(i), with
+        # the number of rows of the item (or as counted by rows(item))
+        iterator = iter(items)
+        i = 0
+        while True:
+            span = self.startSpan(name.format(i))
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.stopSpan(span, record=False)
+                return
+            except BaseException:
+                self.stopSpan(span)
+                raise
+            if rows is not None:
+                span['rows'] = rows(item)
+            else:
+                span['rows'] = len(item) if hasattr(item, '__len__') else None
+            self.stopSpan(span)
+            yield item
+            i += 1
+
+    def summary(self):
+        return {'script': self.script
+                ,'seconds': round(time.perf_counter() - self.start, 3)
+                ,'cpu_seconds': round(time.process_time() - self.start_cpu, 3)
+                ,'peak_rss_mb': round(peakRssMb(), 1)
+                ,'spans': self.spans}
+
+    def write(self, filepath):
+        summary = self.summary()
+        with open(filepath, 'w') as f:
+            if os.path.splitext(filepath)[1] in ['.yaml','.yml']:
+                import yaml
+                yaml.dump(summary, f, sort_keys=False)
+            else:
+                json.dump(summary, f, indent=2)
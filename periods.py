@@ -0,0 +1,61 @@
+import argparse
+import os
+
+# The analyses can be run for several periods in one pass, so that the input
+# files are read (and joined) once. Periods are given as a comma separated 
+# list, each as name:year_min (eg cbd:1992), or just a name for a period 
+# without a minimum year (eg all).
+# The results of each period are output in a YAML section (and data file)
+# named with the period name as a suffix, except for periods without a
+# minimum year which use the unsuffixed name. So the names must be distinct,
+# and at most one period may be without a minimum year.
+
+def parsePeriods(periods):
+    # Returns a list of (name, year_min) tuples. Raises ValueError if periods
+    # would have their results output under the same name
+    parsed = []
+    for period in periods.split(','):
+        name, _, year_min = period.partition(':')
+        parsed.append((name, int(year_min) if year_min else None))
+    names = [name for name, _ in parsed]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError('Duplicate period names: {}'.format(','.join(duplicates)))
+    unsuffixed = [name for name, year_min in parsed if periodSuffix(name, year_min) == '']
+    if len(unsuffixed) > 1:
+        raise ValueError('More than one period without a minimum year (their results would be output under the same name): {}'.format(','.join(unsuffixed)))
+    return parsed
+
+def checkPeriods(periods):
+    # For use as the argparse type of a --periods option: returns the
+    # periods unchanged, if they are valid
+    try:
+        parsePeriods(periods)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return periods
+
+def periodSuffix(name, year_min):
+    return '' if year_min is None else '-{}'.format(name)
+
+def periodFilepath(filepath, suffix):
+    # Inserts the suffix before the file extension
+    root, ext = os.path.splitext(filepath)
+    return '{}{}{}'.format(root, suffix, ext)
+
+def applyYearMin(df_tax, df_occ, year_min):
+    # Returns copies of the taxonomy and occurrences, without those first
+    # published / collected before year_min
+    df_tax = df_tax.copy()
+    df_occ = df_occ.copy()
+    # Occurrences
+    dropmask = df_occ.year.notnull() & (df_occ.year < year_min)
+    df_occ.drop(df_occ[dropmask].index,inplace=True)
+    print('Dropped occurrences outside date range ({}-date), retained {} lines'.format(year_min, len(df_occ)))
+    # Taxonomy
+    dropmask = df_tax.first_published_yr.isnull()
+    df_tax.drop(df_tax[dropmask].index,inplace=True)
+    dropmask = (df_tax.first_published_yr < year_min)
+    df_tax.drop(df_tax[dropmask].index,inplace=True)
+    print('Dropped taxonomy outside date range ({}-date), retained {} lines'.format(year_min, len(df_tax)))
+    return df_tax, df_occ
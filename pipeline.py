@@ -0,0 +1,369 @@
+import argparse
+import ast
+import concurrent.futures
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from periods import checkPeriods, parsePeriods, periodFilepath, periodSuffix
+from wcvpindex import fileChecksum
+
+# Runs the processing and analysis steps of the Makefile (from the extracted
+# GBIF backbone and the downloads onwards) as stages, each calling the main
+# function of its script. A stage is skipped when it is up to date: its key,
+# a hash of the content of its input files, its arguments and the source of
+# its script (and of the repository modules that imports), is that recorded
+# when it last ran, and its outputs are unchanged since. Unlike the mtimes
+# used by make, touching (or re-extracting) an input does not cause a re-run,
+# and a stage whose re-run writes the same outputs does not cause re-runs of
+# the stages which read them.
+#
+# The stages a stage depends on are those which write its inputs. Stages are
+# each run in a new process (so memory is released after each), as soon as
+# those they depend on are up to date, so independent stages (eg linking the
+# taxonomies and locating the publishers) run concurrently. The output of
+# each stage is written to a log file.
+#
+# Usage: python pipeline.py [--jobs N] [--stages gbif2wcvp,...] [--dry_run]
+
+# Increment to re-run all stages, eg if the way the keys are made changes
+PIPELINE_VERSION=2
+
+PERIODS='all,cbd:1992,nagoya:2014'
+
+GBIF_TAXON_COLUMNS='taxonID,scientificName,genericName,specificEpithet,taxonRank,family'
+
+# As gbif_publ_ids_with_bad_coordinates in the Makefile: Rutgers, Universidade
+# Federal de Juiz de Fora, Instituto do Meio Ambiente do Estado de Alagoas
+GBIF_PUBL_IDS_WITH_BAD_COORDINATES=('eb126411-e092-4abc-a0b9-a2e1c98c6578'
+                                    ',303e2432-448c-41ec-be2b-020a25c7adc4'
+                                    ',81114709-2a6c-4e0b-908b-cb207a8708c2')
+
+# Options which only change how a stage runs (not its outputs), so are left
+# out of its key
+EXECUTION_OPTIONS=['--workers','--spans_file']
+
+REPOSITORY_DIR=os.path.dirname(os.path.abspath(__file__))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default='data')
+    parser.add_argument('--downloads_dir', type=str, default='downloads')
+    parser.add_argument('--stages', type=str, default=None, help='Comma separated list of the stages to bring up to date (with the stages they depend on), defaults to all')
+    parser.add_argument('--force', type=str, default=None, help='Comma separated list of stages to run even if they are up to date')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Maximum number of stages to run at once')
+    parser.add_argument('--dry_run', action='store_true', help='Report which stages are out of date without running them')
+    parser.add_argument("--limit", default=None, type=int)
+    parser.add_argument('--format', type=str, default=None, help='Format of the intermediate data files, as the --format of each script')
+    parser.add_argument('--periods', type=checkPeriods, default=PERIODS)
+    parser.add_argument('--fuzzy', action='store_true', help='Add the fuzzy match stage to the linking of the taxonomies')
+    parser.add_argument('--filter_workers', type=int, default=1)
+    parser.add_argument('--match_workers', type=int, default=1)
+    parser.add_argument('--spans', action='store_true', help='Write the time and memory of each section of each stage to <output>.spans.yaml')
+    args = parser.parse_args(argv)
+
+    stages = defineStages(args)
+    stage_names = [stage['name'] for stage in stages]
+    for option in ['stages','force']:
+        unknown = [name for name in (getattr(args, option) or '').split(',') if name and name not in stage_names]
+        if unknown:
+            parser.error('Unknown stages in --{}: {} (known stages: {})'.format(option, ','.join(unknown), ','.join(stage_names)))
+    dependencies = stageDependencies(stages)
+    if args.stages is not None:
+        stages = selectStages(stages, dependencies, args.stages.split(','))
+    forced = set(args.force.split(',')) if args.force is not None else set()
+
+    # Inputs which are not written by any stage must already exist
+    outputs = set(output for stage in stages for output in stage['outputs'])
+    missing = sorted(set(filepath for stage in stages for filepath in stage['inputs'] if filepath not in outputs and not os.path.exists(filepath)))
+    if missing:
+        parser.error('Missing input files (see the download steps of the Makefile): {}'.format(', '.join(missing)))
+
+    cache_dir = os.path.join(args.data_dir, 'pipeline-cache')
+    log_dir = os.path.join(args.data_dir, 'pipeline-logs')
+    os.makedirs(cache_dir, exist_ok=True)
+    os.makedirs(log_dir, exist_ok=True)
+    hashes = FileHashes(os.path.join(cache_dir, 'hashes.json'))
+    try:
+        ok = runStages(stages, dependencies, forced, args.jobs, hashes, cache_dir, log_dir, dry_run=args.dry_run)
+    finally:
+        hashes.save()
+    if not ok:
+        sys.exit(1)
+
+def defineStages(args):
+    # Returns the stages in run order, each with the script it runs, the
+    # arguments it is called with, and its input and output files, with the
+    # same file names and options as the Makefile
+    data = lambda filename: os.path.join(args.data_dir, filename)
+    downloads = lambda filename: os.path.join(args.downloads_dir, filename)
+    common_args = []
+    if args.limit is not None:
+        common_args += ['--limit={}'.format(args.limit)]
+    if args.format is not None:
+        common_args += ['--format={}'.format(args.format)]
+    spans_args = lambda outputfile: ['--spans_file={}.spans.yaml'.format(outputfile)] if args.spans else []
+    # Intermediate data files, named .parquet when written as parquet
+    ext = lambda extension: 'parquet' if args.format == 'parquet' else extension
+    gbif_filtered = data('Taxon-Tracheophyta.{}'.format(ext('tsv')))
+    gbif2wcvp = data('gbif2wcvp.{}'.format(ext('csv')))
+    gbif_typesloc = data('gbif-typesloc.{}'.format(ext('zip')))
+    gbif_type_availability = data('taxa2gbiftypeavailability.{}'.format(ext('csv')))
+    periods = parsePeriods(args.periods)
+
+    stages = []
+    # Filter GBIF backbone taxonomy for Tracheophyta
+    stages.append({'name': 'filter'
+                   ,'script': 'filtergbif.py'
+                   ,'inputs': [data('Taxon.tsv')]
+                   ,'outputs': [gbif_filtered]
+                   ,'argv': [data('Taxon.tsv')] + common_args + ['--removeHybrids', '--usecols', GBIF_TAXON_COLUMNS, '--workers', str(args.filter_workers)] + spans_args(gbif_filtered) + [gbif_filtered]})
+    # Compile the WCVP names into an index
+    stages.append({'name': 'wcvpindex'
+                   ,'script': 'wcvpindex.py'
+                   ,'inputs': [downloads('wcvp_names.txt')]
+                   ,'outputs': [data('wcvp-index')]
+                   ,'argv': [downloads('wcvp_names.txt'), data('wcvp-index')]})
+    # Process GBIF and WCVP taxonomies
+    stages.append({'name': 'gbif2wcvp'
+                   ,'script': 'gbif2wcvp.py'
+                   ,'inputs': [gbif_filtered, downloads('wcvp_names.txt'), data('wcvp-index')]
+                   ,'outputs': [gbif2wcvp]
+                   ,'argv': [gbif_filtered, downloads('wcvp_names.txt')] + common_args + (['--fuzzy'] if args.fuzzy else []) + spans_args(gbif2wcvp) + ['--workers', str(args.match_workers), '--wcvp_index', data('wcvp-index'), '--no_build_index', gbif2wcvp]})
+    # Process GBIF type data to add details of publishing organisation
+    stages.append({'name': 'types2publisherlocations'
+                   ,'script': 'types2publisherlocations.py'
+                   ,'inputs': [data('gbif-types.zip'), downloads('ih.txt'), downloads('cities15000.zip')]
+                   ,'outputs': [gbif_typesloc]
+                   ,'argv': [data('gbif-types.zip'), downloads('ih.txt'), downloads('cities15000.zip')] + common_args + ['--ignore_gbif_publ_coordinates', GBIF_PUBL_IDS_WITH_BAD_COORDINATES, '--registry_cache', downloads('gbif-registry-cache'), '--per_publisher'] + spans_args(gbif_typesloc) + [gbif_typesloc]})
+    # Prepare lookup from GADM level 1 units to TDWG WGSRPD L3 regions
+    stages.append({'name': 'gadm2tdwg'
+                   ,'script': 'gadm2tdwg.py'
+                   ,'inputs': [downloads('gadm_410-levels.gpkg'), downloads('tdwg_wgsrpd_l3.json')]
+                   ,'outputs': [data('gadm2tdwg.parquet')]
+                   ,'argv': [downloads('gadm_410-levels.gpkg'), downloads('tdwg_wgsrpd_l3.json'), data('gadm2tdwg.parquet')]})
+    # Analyse how many taxa have type material in GBIF (a data file per period)
+    stages.append({'name': 'taxa2gbiftypeavailability'
+                   ,'script': 'taxa2gbiftypeavailability.py'
+                   ,'inputs': [gbif2wcvp, data('gbif-types.zip')]
+                   ,'outputs': [periodFilepath(gbif_type_availability, periodSuffix(name, year_min)) for name, year_min in periods] + [data('taxa2gbiftypeavailability.yaml')]
+                   ,'argv': [gbif2wcvp, data('gbif-types.zip')] + common_args + ['--periods={}'.format(args.periods)] + spans_args(data('taxa2gbiftypeavailability.yaml')) + [gbif_type_availability, data('taxa2gbiftypeavailability.yaml')]})
+    # Analyse how many taxa have type material published from within native range
+    # (the data file is not written)
+    stages.append({'name': 'taxa2nativerangetypeavailability'
+                   ,'script': 'taxa2nativerangetypeavailability.py'
+                   ,'inputs': [gbif2wcvp, downloads('wcvp_distribution.txt'), data('gbif-types.zip'), gbif_typesloc, downloads('gadm_410-levels.gpkg'), downloads('tdwg_wgsrpd_l3.json'), data('gadm2tdwg.parquet')]
+                   ,'outputs': [data('taxa2nativerangetypeavailability.yaml')]
+                   ,'argv': [gbif2wcvp, downloads('wcvp_distribution.txt'), data('gbif-types.zip'), gbif_typesloc, downloads('gadm_410-levels.gpkg'), downloads('tdwg_wgsrpd_l3.json')] + common_args + ['--gadm_tdwg_lookup_file', data('gadm2tdwg.parquet'), '--periods={}'.format(args.periods)] + spans_args(data('taxa2nativerangetypeavailability.yaml')) + [data('taxa2nativerangetypeavailability.csv'), data('taxa2nativerangetypeavailability.yaml')]})
+    return stages
+
+def stageDependencies(stages):
+    # Returns the names of the stages which write the inputs of each stage
+    writers = {output: stage['name'] for stage in stages for output in stage['outputs']}
+    return {stage['name']: set(writers[filepath] for filepath in stage['inputs'] if filepath in writers) for stage in stages}
+
+def selectStages(stages, dependencies, names):
+    # Returns the named stages and those they depend on (directly or not), in run order
+    selected = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(dependencies[name])
+    return [stage for stage in stages if stage['name'] in selected]
+
+class FileHashes:
+    # Content hashes of files (and directories, from those of the files in
+    # them), cached with the size and modification time of each file, so
+    # that files are only re-read when they may have changed
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.entries = dict()
+        if os.path.exists(filepath):
+            with open(filepath) as f:
+                self.entries = json.load(f)
+
+    def hash(self, path):
+        if os.path.isdir(path):
+            checksum = hashlib.sha256()
+            for root, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    filepath = os.path.join(root, filename)
+                    checksum.update('{}:{}\n'.format(os.path.relpath(filepath, path), self.hash(filepath)).encode())
+            return checksum.hexdigest()
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': fileChecksum(path)}
+            self.entries[path] = entry
+        return entry['sha256']
+
+    def save(self):
+        with open(self.filepath, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+
+def scriptVersion(script, hashes):
+    # Hash of the source of the script and of the repository modules it
+    # imports (directly or not)
+    checksum = hashlib.sha256()
+    seen = set()
+    pending = [script]
+    while pending:
+        filename = pending.pop()
+        if filename in seen:
+            continue
+        seen.add(filename)
+        filepath = os.path.join(REPOSITORY_DIR, filename)
+        with open(filepath, 'rb') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+                modules = [node.module]
+            else:
+                continue
+            for module in modules:
+                module_filename = module.replace('.', os.sep) + '.py'
+                if os.path.exists(os.path.join(REPOSITORY_DIR, module_filename)):
+                    pending.append(module_filename)
+    for filename in sorted(seen):
+        checksum.update('{}:{}\n'.format(filename, hashes.hash(os.path.join(REPOSITORY_DIR, filename))).encode())
+    return checksum.hexdigest()
+
+def keyArgv(argv):
+    # The arguments without the execution options (and their values, given
+    # as --option=value or --option value)
+    key_argv = []
+    skip_value = False
+    for arg in argv:
+        if skip_value:
+            skip_value = False
+        elif arg in EXECUTION_OPTIONS:
+            skip_value = True
+        elif arg.split('=')[0] not in EXECUTION_OPTIONS:
+            key_argv.append(arg)
+    return key_argv
+
+def stageKey(stage, hashes):
+    key = {'pipeline_version': PIPELINE_VERSION
+           ,'script': scriptVersion(stage['script'], hashes)
+           ,'argv': keyArgv(stage['argv'])
+           ,'inputs': {filepath: hashes.hash(filepath) for filepath in stage['inputs']}}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def readStageManifest(cache_dir, stage):
+    filepath = os.path.join(cache_dir, '{}.json'.format(stage['name']))
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath) as f:
+        return json.load(f)
+
+def writeStageManifest(cache_dir, stage, key, hashes, seconds):
+    manifest = {'key': key
+                ,'outputs': {filepath: hashes.hash(filepath) for filepath in stage['outputs']}
+                ,'seconds': round(seconds, 3)
+                ,'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(os.path.join(cache_dir, '{}.json'.format(stage['name'])), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+def isUpToDate(stage, key, hashes, cache_dir):
+    # A stage is up to date if it last ran with the same key, and its outputs
+    # have not changed (or been removed) since
+    manifest = readStageManifest(cache_dir, stage)
+    if manifest is None or manifest['key'] != key:
+        return False
+    return all(os.path.exists(filepath) and hashes.hash(filepath) == manifest['outputs'].get(filepath) for filepath in stage['outputs'])
+
+def runStage(stage, log_filepath):
+    # Runs in a new process: calls the main function of the stage's script,
+    # with the output of this process (and of any it starts) written to the
+    # log file. Returns the wall time taken
+    with open(log_filepath, 'w') as log:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        # As if the script was run from the command line (eg for the usage
+        # of argument errors)
+        sys.argv = [stage['script']] + stage['argv']
+        start = time.perf_counter()
+        try:
+            module = importlib.import_module(os.path.splitext(stage['script'])[0])
+            module.main(stage['argv'])
+        except SystemExit as e:
+            # eg an argument error, reported by argparse
+            if e.code not in (None, 0):
+                raise RuntimeError('{} exited with {}'.format(stage['script'], e.code))
+        except BaseException:
+            traceback.print_exc()
+            raise
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+    return time.perf_counter() - start
+
+def runStages(stages, dependencies, forced, jobs, hashes, cache_dir, log_dir, dry_run=False):
+    # Runs each stage which is out of date once those it depends on are up to
+    # date, at most jobs at a time. Stages which depend on a failed stage are
+    # not run. Returns whether all of the stages are up to date (or, for a
+    # dry run, True)
+    #
+    # Each stage runs in an executor of its own with a single (spawned)
+    # process, which is shut down when the stage finishes
+    pending = list(stages)
+    done = set()
+    not_done = set()
+    running = dict()
+    context = multiprocessing.get_context('spawn')
+    while pending or running:
+        for stage in list(pending):
+            upstream = dependencies[stage['name']]
+            if upstream & not_done:
+                pending.remove(stage)
+                not_done.add(stage['name'])
+                print('{}: {} (after {})'.format(stage['name'], 'would run' if dry_run else 'not run', ','.join(sorted(upstream & not_done))))
+                continue
+            if not upstream <= done or len(running) >= max(1, jobs):
+                continue
+            pending.remove(stage)
+            key = stageKey(stage, hashes)
+            if stage['name'] not in forced and isUpToDate(stage, key, hashes, cache_dir):
+                print('{}: up to date'.format(stage['name']))
+                done.add(stage['name'])
+            elif dry_run:
+                print('{}: would run'.format(stage['name']))
+                not_done.add(stage['name'])
+            else:
+                log_filepath = os.path.join(log_dir, '{}.log'.format(stage['name']))
+                print('{}: running, logging to {}'.format(stage['name'], log_filepath))
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context)
+                running[executor.submit(runStage, stage, log_filepath)] = (stage, key, log_filepath, executor)
+        if not running:
+            continue
+        finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+            stage, key, log_filepath, executor = running.pop(future)
+            executor.shutdown()
+            try:
+                seconds = future.result()
+                missing = [filepath for filepath in stage['outputs'] if not os.path.exists(filepath)]
+                if missing:
+                    raise RuntimeError('outputs not written: {}'.format(', '.join(missing)))
+            except Exception as e:
+                print('{}: FAILED ({}), see {}'.format(stage['name'], e, log_filepath))
+                not_done.add(stage['name'])
+                continue
+            writeStageManifest(cache_dir, stage, key, hashes, seconds)
+            print('{}: finished in {:.1f}s'.format(stage['name'], seconds))
+            done.add(stage['name'])
+    return dry_run or len(not_done) == 0
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import pandas as pd
+pd.set_option('display.max_rows',100)
+import geopandas as gpd
+import argparse
+import multiprocessing
+import os
+import matplotlib
+# Render without a display, so this can run in worker processes (and on servers)
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from gadm2tdwg import buildPublisherPoints, locatePublishers, readGadmTdwgLookup
+from tableio import FORMATS, PUBLISHER_LOCATIONS_SCHEMA, readTable
+
+# Plots each publisher location with the GADM L1 unit containing it, the
+# representative point of that unit and the TDWG WGSRPD L3 region containing
+# the representative point, to check the assignment of publishers to TDWG
+# regions made in taxa2nativerangetypeavailability.py
+
+# Geometry columns plotted, and how
+PLOT_LAYERS=[('geometry_original_point', dict(marker='x', color='red', markersize=5))
+            ,('geometry_gadm_l1', dict(color='red', alpha=0.1))
+            ,('geometry_gadm_l1_repr_point', dict(marker='x', color='blue', markersize=5))
+            ,('geometry_tdwg_l3', dict(color='green', alpha=0.1))]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--limit", default=None, type=int)
+    parser.add_argument("inputfile_publ", type=str)
+    parser.add_argument('--delimiter_publ', type=str, default='\t')
+    parser.add_argument('gadm_tdwg_lookup_file', type=str, help='Path to the GADM L1 to TDWG L3 lookup prepared by gadm2tdwg.py')
+    parser.add_argument("inputfile_tdwg_wgsrpd_l3_json", type=str)
+    parser.add_argument('--format', type=str, choices=FORMATS, default='tsv', help='Format of the publisher location input file')
+    parser.add_argument('--publishers', type=str, default=None, help='Comma separated list of the publishingOrgKey values to plot, defaults to all')
+    parser.add_argument('--disagreeing_country', action='store_true', help='Only plot publishers whose GBIF country differs from that of the GADM unit containing them')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes to render plots with')
+    parser.add_argument("outputdir", type=str)
+    args = parser.parse_args(argv)
+
+    ###########################################################################
+    # 1. Read input files
+    ###########################################################################
+    #
+    # 1.1 Publishing organisation locations (GBIF) ============================
+    df_publ = readTable(args.inputfile_publ, format=args.format, sep=args.delimiter_publ, nrows=args.limit, usecols=['publishingOrgKey','latitude','longitude','country', 'title'], schema=PUBLISHER_LOCATIONS_SCHEMA)
+    df_publ.drop_duplicates(inplace=True)
+    print('Read {} GBIF publishing organisation lines from: {}'.format(len(df_publ), args.inputfile_publ))
+
+    # 1.2 GADM L1 to TDWG L3 lookup ===========================================
+    df_gadm_tdwg = readGadmTdwgLookup(args.gadm_tdwg_lookup_file)
+    df_gadm_tdwg['geometry_gadm_l1'] = df_gadm_tdwg.geometry
+    print('Read {} GADM L1 to TDWG L3 lookup lines from {}'.format(len(df_gadm_tdwg), args.gadm_tdwg_lookup_file))
+
+    # 1.3 Read TDWG WGSRPD L3 geojson format shape file ========================
+    df_tdwg_poly = gpd.read_file(args.inputfile_tdwg_wgsrpd_l3_json)
+    print('Read {} TDWG WGSRPD l3 shapes from {}'.format(len(df_tdwg_poly), args.inputfile_tdwg_wgsrpd_l3_json))
+
+    ###########################################################################
+    # 2. Locate publishers, as in taxa2nativerangetypeavailability.py
+    ###########################################################################
+    df = locatePublishers(buildPublisherPoints(df_publ), df_gadm_tdwg)
+    df['geometry_tdwg_l3'] = df.LEVEL3_COD.map(df_tdwg_poly.drop_duplicates(subset='LEVEL3_COD').set_index('LEVEL3_COD').geometry)
+
+    ###########################################################################
+    # 3. Select publishers to plot
+    ###########################################################################
+    # Those without a location cannot be plotted
+    df = df[df.latitude.notnull() & df.longitude.notnull()]
+    if args.publishers is not None:
+        df = df[df.publishingOrgKey.isin(args.publishers.split(','))]
+    if args.disagreeing_country:
+        # GADM ISO_1 codes are prefixed with the ISO 3166-1 alpha-2 country
+        # code, but are often missing (null or "NA"): publishers in units
+        # without one are left out, as their country cannot be compared
+        iso_1 = df.ISO_1.where(df.ISO_1 != 'NA')
+        df = df[iso_1.notnull() & (df.country_gbif != iso_1.str[:2]).fillna(False)]
+    print('Plotting {} publisher locations'.format(len(df)))
+
+    ###########################################################################
+    # 4. Render plots (named by publishingOrgKey, suffixed where a publisher
+    # has more than one location)
+    ###########################################################################
+    os.makedirs(args.outputdir, exist_ok=True)
+    duplicate_count = df.groupby('publishingOrgKey').cumcount()
+    fignames = df.publishingOrgKey.where(duplicate_count == 0, df.publishingOrgKey + '-' + duplicate_count.astype(str))
+    plots = [(os.path.join(args.outputdir, '{}.png'.format(figname)),
+                '{org_title} ({country})'.format(org_title=title, country=country),
+                [(row[column], style) for column, style in PLOT_LAYERS])
+                for figname, title, country, (_, row) in zip(fignames, df.title_gbif, df.country_gbif, df[[column for column, _ in PLOT_LAYERS]].iterrows())]
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers) as pool:
+            for _ in pool.imap_unordered(renderPlot, plots, chunksize=16):
+                pass
+    else:
+        for plot in plots:
+            renderPlot(plot)
+    print('Wrote {} plots to {}'.format(len(plots), args.outputdir))
+
+def renderPlot(plot):
+    figpath, title, layers = plot
+    fig, ax = plt.subplots(figsize=(8,10))
+    for geometry, style in layers:
+        if geometry is not None and not pd.isnull(geometry) and not geometry.is_empty:
+            gpd.GeoSeries([geometry]).plot(ax=ax, **style)
+    ax.set_title(title)
+    fig.savefig(figpath)
+    # Close the figure, so that memory use does not grow with each plot
+    plt.close(fig)
+
+if __name__ == '__main__':
+    main()
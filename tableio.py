@@ -0,0 +1,172 @@
+import pandas as pd
+
+# The intermediate data files passed between the pipeline scripts can be
+# stored as delimited text (the default) or as parquet. Parquet keeps the
+# column types, so they do not need to be inferred on every read, and
+# supports reading only the columns that are needed.
+FORMATS=['tsv','parquet']
+
+# Types of the columns of the files read and written by the pipeline scripts.
+# IDs and years are nullable integers, rather than becoming floats once
+# missing values are present. Text with few distinct values (ranks,
+# statuses, families, genera) is read as categories, and other text as
+# pyarrow backed strings, both of which take much less memory than Python
+# string objects. Columns which are not listed are left for pandas to infer.
+# IDs which are not numbers (eg WCVP IDs of the form 123-wcs) are left as
+# text. On write, only the numeric types are applied, as text is stored the
+# same whatever its type in memory
+GBIF_TAXON_SCHEMA={'taxonID':'Int64'
+                ,'parentNameUsageID':'Int64'
+                ,'acceptedNameUsageID':'Int64'
+                ,'originalNameUsageID':'Int64'
+                ,'scientificName':'string[pyarrow]'
+                ,'canonicalName':'string[pyarrow]'
+                ,'specificEpithet':'string[pyarrow]'
+                ,'infraspecificEpithet':'string[pyarrow]'
+                ,'genericName':'category'
+                ,'family':'category'
+                ,'taxonRank':'category'
+                ,'taxonomicStatus':'category'
+                ,'nomenclaturalStatus':'category'
+                ,'kingdom':'category'
+                ,'phylum':'category'}
+
+GBIF2WCVP_SCHEMA=dict(GBIF_TAXON_SCHEMA, **{'original_id':'Int64'
+                ,'match_id':'Int64'
+                ,'accepted_id':'Int64'
+                ,'plant_name_id':'Int64'
+                ,'match_stage':'Int64'
+                ,'match_distance':'Int64'
+                ,'first_published_yr':'Int64'
+                ,'match_rank':'category'
+                ,'match_status':'category'
+                ,'accepted_rank':'category'})
+
+WCVP_NAMES_SCHEMA={'plant_name_id':'Int64'
+                ,'accepted_plant_name_id':'Int64'
+                ,'taxon_rank':'category'
+                ,'taxon_status':'category'
+                ,'family':'category'
+                ,'genus':'category'
+                ,'genus_hybrid':'category'
+                ,'species_hybrid':'category'
+                ,'infraspecific_rank':'category'
+                ,'homotypic_synonym':'category'
+                ,'first_published':'category'
+                ,'taxon_authors':'category'
+                ,'species':'string[pyarrow]'
+                ,'infraspecies':'string[pyarrow]'
+                ,'taxon_name':'string[pyarrow]'
+                # Columns added when the names are prepared for matching
+                ,'genericName':'category'
+                ,'taxon_name_plus_authors':'string[pyarrow]'
+                ,'taxon_name_minus_authors':'string[pyarrow]'}
+
+WCVP_DISTRIBUTION_SCHEMA={'plant_name_id':'Int64'
+                ,'area_code_l3':'category'
+                ,'area':'category'
+                ,'region':'category'
+                ,'continent':'category'}
+
+# Keys and years of GBIF occurrences are read as (nullable) integers, and the 
+# type status, which has few distinct values, as a category
+OCCURRENCE_SCHEMA={'gbifID':'Int64'
+                ,'taxonKey':'Int64'
+                ,'year':'Int64'
+                ,'typeStatus':'category'
+                ,'publishingOrgKey':'string[pyarrow]'}
+
+PUBLISHER_LOCATIONS_SCHEMA={'latitude':'float64'
+                ,'longitude':'float64'
+                ,'country':'category'}
+
+def readTable(filepath, format='tsv', sep='\t', nrows=None, usecols=None, schema=None, **kwargs):
+    if format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        # Memory map the file, and read only the requested columns (and rows)
+        parquet_file = pq.ParquetFile(filepath, memory_map=True)
+        if nrows is None:
+            table = parquet_file.read(columns=usecols)
+        else:
+            batches = []
+            remaining = nrows
+            for batch in parquet_file.iter_batches(columns=usecols):
+                batches.append(batch.slice(0, remaining))
+                remaining -= len(batches[-1])
+                if remaining <= 0:
+                    break
+            table = pa.Table.from_batches(batches) if batches else parquet_file.schema_arrow.empty_table().select(usecols or parquet_file.schema_arrow.names)
+        # Integer columns with missing values come back as float, as they
+        # would from read_csv, so downstream processing is the same for both
+        return applySchema(table.to_pandas(ignore_metadata=True), schema)
+    # Text types are set as the file is parsed, so the text is never held as
+    # Python strings. Numbers are typed afterwards, as integer IDs may have
+    # been written as floats
+    df = pd.read_csv(filepath, sep=sep, nrows=nrows, usecols=usecols, dtype=textTypes(schema), **kwargs)
+    return applySchema(df, schema)
+
+def isNumericType(dtype):
+    return pd.api.types.is_numeric_dtype(pd.api.types.pandas_dtype(dtype))
+
+def textTypes(schema):
+    if schema is None:
+        return None
+    return {column: dtype for column, dtype in schema.items() if not isNumericType(dtype)}
+
+def numericTypes(schema):
+    if schema is None:
+        return None
+    return {column: dtype for column, dtype in schema.items() if isNumericType(dtype)}
+
+def applySchema(df, schema):
+    if schema is None:
+        return df
+    columns = dict()
+    for column, dtype in schema.items():
+        if column in df.columns:
+            values = df[column]
+            if values.dtype == dtype:
+                continue
+            # Numbers read as text are parsed first (text which is not
+            # numbers, eg IDs, is left as it is)
+            if values.dtype == object and isNumericType(dtype):
+                try:
+                    values = pd.to_numeric(values)
+                except (ValueError, TypeError):
+                    continue
+            columns[column] = values.astype(dtype)
+    return df.assign(**columns)
+
+def writeTable(df, filepath, format='tsv', sep='\t', schema=None):
+    df = applySchema(df, numericTypes(schema))
+    if format == 'parquet':
+        df.to_parquet(filepath, index=False)
+    else:
+        df.to_csv(filepath, sep=sep, index=False)
+
+def writeTableChunks(chunks, filepath, format='tsv', sep='\t', schema=None):
+    # Write an iterable of dataframes (with the same columns) to a single file,
+    # appending one at a time so that only one needs to be held in memory.
+    # Returns the number of rows written
+    row_count = 0
+    writer = None
+    for i, df in enumerate(chunks):
+        df = applySchema(df, numericTypes(schema))
+        if format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if writer is None:
+                # Columns which are empty in the first chunk are typed as text
+                arrow_schema = pa.Schema.from_pandas(df, preserve_index=False)
+                for j, field in enumerate(arrow_schema):
+                    if pa.types.is_null(field.type):
+                        arrow_schema = arrow_schema.set(j, field.with_type(pa.string()))
+                writer = pq.ParquetWriter(filepath, arrow_schema)
+            writer.write_table(pa.Table.from_pandas(df, schema=writer.schema, preserve_index=False))
+        else:
+            df.to_csv(filepath, sep=sep, index=False, mode='w' if i == 0 else 'a', header=(i == 0))
+        row_count += len(df)
+    if writer is not None:
+        writer.close()
+    return row_count
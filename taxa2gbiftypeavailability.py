@@ -5,8 +5,12 @@ from unidecode import unidecode
 import re
 from pygbif import registry
 import yaml
+from gbifoccurrences import OCCURRENCE_COLUMNS, readOccurrences
+from instrumentation import Instrumentation, addInstrumentationArguments
+from periods import applyYearMin, checkPeriods, parsePeriods, periodFilepath, periodSuffix
+from tableio import FORMATS, GBIF2WCVP_SCHEMA, readTable, writeTable
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--limit", default=None, type=int)
     parser.add_argument("inputfile_tax", type=str)
@@ -14,52 +18,70 @@ def main():
     parser.add_argument("inputfile_occ", type=str)
     parser.add_argument('--delimiter_occ', type=str, default='\t')
     parser.add_argument('--year_min', type=int, default=None)
+    parser.add_argument('--periods', type=checkPeriods, default=None, help='Comma separated list of periods to analyse in one pass, each as name:year_min or name (for no minimum year), eg: all,cbd:1992. Overrides --year_min')
+    parser.add_argument('--format', type=str, choices=FORMATS, default='tsv', help='Format of the taxonomy input file and the output data file')
+    addInstrumentationArguments(parser)
     parser.add_argument("outputfile_data", type=str)
     parser.add_argument("outputfile_yaml", type=str)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    instrumentation = Instrumentation.fromArgs('taxa2gbiftypeavailability', args)
 
     ###########################################################################
     # 1. Read input files
     ###########################################################################
     #
     # 1.1 Taxonomy (WCVP and GBIF integrated) =================================
-    df_tax = pd.read_csv(args.inputfile_tax, sep=args.delimiter_tax, nrows=args.limit, usecols=['original_id','accepted_id','first_published_yr'])
-    print('Read {} taxonomy lines from: {}'.format(len(df_tax), args.inputfile_tax))
+    with instrumentation.span('read_taxonomy') as span:
+        df_tax = readTable(args.inputfile_tax, format=args.format, sep=args.delimiter_tax, nrows=args.limit, usecols=['original_id','accepted_id','first_published_yr'], schema=GBIF2WCVP_SCHEMA)
+        print('Read {} taxonomy lines from: {}'.format(len(df_tax), args.inputfile_tax))
+        span['rows'] = len(df_tax)
 
     # 1.2 Occurrences from GBIF with type status set ==========================
-    df_occ = pd.read_csv(args.inputfile_occ, sep=args.delimiter_occ, nrows=args.limit)
-    print('Read {} type occurrence GBIF lines from: {}'.format(len(df_occ), args.inputfile_occ))
+    # (dropping those with typestatus "NOTATYPE" as they are read)
+    with instrumentation.span('read_occurrences') as span:
+        df_occ = readOccurrences(args.inputfile_occ, sep=args.delimiter_occ, nrows=args.limit, usecols=OCCURRENCE_COLUMNS, exclude_notatype=True)
+        print('Read {} type occurrence GBIF lines from: {}, excluding those flagged NOTATYPE'.format(len(df_occ), args.inputfile_occ))
+        span['rows'] = len(df_occ)
 
-    # 1.3 Drop those with typestatus "NOTATYPE"
-    dropmask = df_occ.typeStatus.isin(['NOTATYPE'])
-    df_occ.drop(df_occ[dropmask].index,inplace=True)
-    print('Dropped occurrences flagged NOTATYPE, retained {} lines'.format(len(df_occ)))
-
-    # 1.4 Drop those outside specified date range
-    if args.year_min is not None:
-        # Occurrences
-        dropmask = df_occ.year.notnull() & (df_occ.year < args.year_min)
-        df_occ.drop(df_occ[dropmask].index,inplace=True)
-        print('Dropped occurrences outside date range ({}-date), retained {} lines'.format(args.year_min, len(df_occ)))
-        # Taxonomy
-        dropmask = df_tax.first_published_yr.isnull()
-        df_tax.drop(df_tax[dropmask].index,inplace=True)
-        dropmask = (df_tax.first_published_yr.astype(int) < args.year_min)
-        df_tax.drop(df_tax[dropmask].index,inplace=True)
-        print('Dropped taxonomy outside date range ({}-date), retained {} lines'.format(args.year_min, len(df_tax)))
+    ###########################################################################
+    # 2. Analyse each period
+    ###########################################################################
+    periods = [(None, args.year_min)] if args.periods is None else parsePeriods(args.periods)
+    output_variables = dict()
+    for name, year_min in periods:
+        suffix = '' if name is None else periodSuffix(name, year_min)
+        #
+        # 2.1 Drop those outside specified date range =========================
+        with instrumentation.span('apply_year_min' + suffix) as span:
+            df_tax_period, df_occ_period = (df_tax, df_occ) if year_min is None else applyYearMin(df_tax, df_occ, year_min)
+            span['rows'] = len(df_tax_period)
+        #
+        # 2.2 Attach integrated taxonomy to GBIF occurrence type data and report
+        # on number of taxa with occurrences claiming type status in GBIF ======
+        with instrumentation.span('analyse' + suffix, rows=len(df_tax_period)):
+            df, analysis_variables = analyseTypeAvailability(df_tax_period, df_occ_period)
+        output_variables['taxa2gbiftypeavailability' + suffix]=analysis_variables
+        #
+        # 2.3 Output data =====================================================
+        outputfile_data = periodFilepath(args.outputfile_data, suffix)
+        with instrumentation.span('write_data' + suffix, rows=len(df)):
+            print('Outputting {} rows to {}'.format(len(df), outputfile_data))
+            writeTable(df, outputfile_data, format=args.format)
 
     ###########################################################################
-    # 2. Attach integrated taxonomy to GBIF occurrence type data
+    # 3. Output analysis variables (a section per period)
     ###########################################################################
+    with open(args.outputfile_yaml, 'w') as f:
+        yaml.dump(output_variables, f)
+    if args.spans_file is not None:
+        instrumentation.write(args.spans_file)
+
+def analyseTypeAvailability(df_tax, df_occ):
     df = pd.merge(left=df_tax,
                     right=df_occ,
                     left_on='original_id',
                     right_on='taxonKey',
                     how='left' )
-
-    ###########################################################################
-    # 3. Report on number of taxa with occurrences claiming type status in GBIF
-    ###########################################################################
     mask = (df.typeStatus.notnull())
     type_status_available_count = df[mask].accepted_id.nunique()
     total_taxa_count = df.accepted_id.nunique()
@@ -67,16 +89,7 @@ def main():
     analysis_variables['taxon_count'] = total_taxa_count
     analysis_variables['taxa_with_types_available_count'] = type_status_available_count
     analysis_variables['taxa_with_types_available_pc'] = round((type_status_available_count/total_taxa_count)*100)
-    output_variables = dict()
-    output_variables['taxa2gbiftypeavailability']=analysis_variables
-    with open(args.outputfile_yaml, 'w') as f:
-        yaml.dump(output_variables, f)
-
-    ###########################################################################
-    # 4. Output
-    ###########################################################################
-    print('Outputting {} rows to {}'.format(len(df), args.outputfile_data))
-    df.to_csv(args.outputfile_data,sep='\t',index=False)
+    return df, analysis_variables
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -2,14 +2,15 @@ import pandas as pd
 pd.set_option('display.max_rows',100)
 import geopandas as gpd
 import argparse
-from unidecode import unidecode
-import re
-from pygbif import registry
-import numpy as np
 import yaml
-import matplotlib.pyplot as plt
-
-def main():
+from gadm2tdwg import buildGadmTdwgLookup, buildPointsMask, buildPublisherPoints, locatePublishers, readGadmL1, readGadmTdwgLookup
+from gbifoccurrences import OCCURRENCE_COLUMNS, readOccurrences
+from instrumentation import Instrumentation, addInstrumentationArguments
+from periods import applyYearMin, checkPeriods, parsePeriods, periodSuffix
+from tableio import FORMATS, GBIF2WCVP_SCHEMA, PUBLISHER_LOCATIONS_SCHEMA, WCVP_DISTRIBUTION_SCHEMA, readTable
+from wgsrpd import buildHierarchy, mapAreaCodes
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--limit", default=None, type=int)
     parser.add_argument("inputfile_tax", type=str)
@@ -18,54 +19,56 @@ def main():
     parser.add_argument('--delimiter_dist', type=str, default='|')
     parser.add_argument("inputfile_occ", type=str)
     parser.add_argument('--year_min', type=int, default=None)
+    parser.add_argument('--periods', type=checkPeriods, default=None, help='Comma separated list of periods to analyse in one pass, each as name:year_min or name (for no minimum year), eg: all,cbd:1992. Overrides --year_min')
     parser.add_argument('--delimiter_occ', type=str, default='\t')
     parser.add_argument("inputfile_publ", type=str)
     parser.add_argument('--delimiter_publ', type=str, default='\t')
     parser.add_argument('gadm_geopackage_file', type=str, help='Path to GADM geopackage file')    
     parser.add_argument("inputfile_tdwg_wgsrpd_l3_json", type=str)
-    parser.add_argument("--output_spatial_debug_info", default=False, action='store_true')
-    parser.add_argument('--output_spatial_debug_dir', type=str, default='data/')
+    parser.add_argument('--gadm_tdwg_lookup_file', type=str, default=None, help='Path to a GADM L1 to TDWG L3 lookup prepared by gadm2tdwg.py, used in place of the GADM geopackage file')
+    parser.add_argument('--gadm_mask_buffer', type=float, default=None, help='Only read GADM units within this distance (in degrees) of a publisher location from the GADM geopackage file')
+    parser.add_argument('--gadm_simplify_tolerance', type=float, default=None, help='Simplify GADM unit polygons read from the GADM geopackage file to this tolerance (in degrees)')
+    parser.add_argument('--format', type=str, choices=FORMATS, default='tsv', help='Format of the taxonomy and publisher location input files')
+    # Deprecated, as the plots are now made by spatialdebugplots.py
+    parser.add_argument("--output_spatial_debug_info", default=False, action='store_true', help='Deprecated, has no effect: use spatialdebugplots.py')
+    parser.add_argument('--output_spatial_debug_dir', type=str, default=None, help='Deprecated, has no effect: use spatialdebugplots.py')
+    addInstrumentationArguments(parser)
     parser.add_argument("outputfile_data", type=str)
     parser.add_argument("outputfile_yaml", type=str)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.output_spatial_debug_info or args.output_spatial_debug_dir is not None:
+        print('--output_spatial_debug_info and --output_spatial_debug_dir are deprecated and have no effect, spatial debug plots are made by spatialdebugplots.py (make spatialdebug)')
+    instrumentation = Instrumentation.fromArgs('taxa2nativerangetypeavailability', args)
 
     ###########################################################################
     # 1. Read input files
     ###########################################################################
     #
     # 1.1 Taxonomy (WCVP and GBIF integrated) =================================
-    df_tax = pd.read_csv(args.inputfile_tax, sep=args.delimiter_tax, nrows=args.limit,usecols=['original_id','accepted_id','first_published_yr'])
-    print('Read {} taxonomy lines from: {}'.format(len(df_tax), args.inputfile_tax))
-    df_tax = df_tax.replace({np.nan:None})
+    with instrumentation.span('read_taxonomy') as span:
+        df_tax = readTable(args.inputfile_tax, format=args.format, sep=args.delimiter_tax, nrows=args.limit,usecols=['original_id','accepted_id','first_published_yr'], schema=GBIF2WCVP_SCHEMA)
+        print('Read {} taxonomy lines from: {}'.format(len(df_tax), args.inputfile_tax))
+        span['rows'] = len(df_tax)
 
     # 1.2 WCVP distributions ==================================================
-    df_dist = pd.read_csv(args.inputfile_dist, sep=args.delimiter_dist, nrows=args.limit)
-    print('Read {} WCVP distributions lines from: {}'.format(len(df_dist), args.inputfile_dist))
+    with instrumentation.span('read_distributions') as span:
+        df_dist = readTable(args.inputfile_dist, sep=args.delimiter_dist, nrows=args.limit, schema=WCVP_DISTRIBUTION_SCHEMA)
+        print('Read {} WCVP distributions lines from: {}'.format(len(df_dist), args.inputfile_dist))
+        span['rows'] = len(df_dist)
 
     # 1.3 Occurrences from GBIF with type status set ==========================
-    df_occ = pd.read_csv(args.inputfile_occ, sep=args.delimiter_occ, nrows=args.limit, usecols=['gbifID','typeStatus','taxonKey','publishingOrgKey','year'])
-    print('Read {} type occurrence GBIF lines from: {}'.format(len(df_occ), args.inputfile_occ))
-    # 1.3.1 Drop GBIF occurrences with typestatus "NOTATYPE" ===============================
-    dropmask = df_occ.typeStatus.isin(['NOTATYPE'])
-    df_occ.drop(df_occ[dropmask].index,inplace=True)
-    print('Dropped occurrences flagged NOTATYPE, retained {} lines'.format(len(df_occ)))
-    # 1.3.2 Drop data outside specified daterange ==============================
-    if args.year_min is not None:
-        # Occurrences
-        dropmask = df_occ.year.notnull() & (df_occ.year < args.year_min)
-        df_occ.drop(df_occ[dropmask].index,inplace=True)
-        print('Dropped occurrences outside date range ({}-date), retained {} lines'.format(args.year_min, len(df_occ)))
-        # Taxonomy
-        dropmask = df_tax.first_published_yr.isnull()
-        df_tax.drop(df_tax[dropmask].index,inplace=True)
-        dropmask = (df_tax.first_published_yr.astype(int) < args.year_min)
-        df_tax.drop(df_tax[dropmask].index,inplace=True)
-        print('Dropped taxonomy outside date range ({}-date), retained {} lines'.format(args.year_min, len(df_tax)))
+    # (dropping GBIF occurrences with typestatus "NOTATYPE" as they are read)
+    with instrumentation.span('read_occurrences') as span:
+        df_occ = readOccurrences(args.inputfile_occ, sep=args.delimiter_occ, nrows=args.limit, usecols=OCCURRENCE_COLUMNS, exclude_notatype=True)
+        print('Read {} type occurrence GBIF lines from: {}, excluding those flagged NOTATYPE'.format(len(df_occ), args.inputfile_occ))
+        span['rows'] = len(df_occ)
 
     # 1.4 Publishing organisation locations (GBIF) ============================
-    df_publ = pd.read_csv(args.inputfile_publ, sep=args.delimiter_publ, nrows=args.limit, usecols=['publishingOrgKey','latitude','longitude','country', 'title'])
-    df_publ.drop_duplicates(inplace=True)
-    print('Read {} GBIF publishing organisation lines from: {}'.format(len(df_publ), args.inputfile_publ))
+    with instrumentation.span('read_publishers') as span:
+        df_publ = readTable(args.inputfile_publ, format=args.format, sep=args.delimiter_publ, nrows=args.limit, usecols=['publishingOrgKey','latitude','longitude','country', 'title'], schema=PUBLISHER_LOCATIONS_SCHEMA)
+        df_publ.drop_duplicates(inplace=True)
+        print('Read {} GBIF publishing organisation lines from: {}'.format(len(df_publ), args.inputfile_publ))
+        span['rows'] = len(df_publ)
 
     ###########################################################################    
     # 2 Determine TDWG WGSRPD L3 region from lat/long =========================
@@ -73,153 +76,140 @@ def main():
 
     #
     # 2.1 Convert publishing organization locations to points ==================
-    # Make a geodataframe "df_gbif_point" where the geometry is a point built form the lat/long values
-    df_gbif_point = gpd.GeoDataFrame(df_publ[['publishingOrgKey','latitude','longitude','country', 'title']].drop_duplicates(), geometry=gpd.points_from_xy(df_publ['longitude'], df_publ['latitude']))
+    df_gbif_point = buildPublisherPoints(df_publ)
     print('Number of points requiring assignment to TDWG regions:', len(df_gbif_point))
-    df_gbif_point['geometry_original_point'] = df_gbif_point.geometry
-    df_gbif_point.rename(columns={'country':'country_gbif','title':'title_gbif'}, inplace=True)
-
-    # 2.2 Read GADM level 1 geojson format shape file ========================
-    df_gadm_l1 = gpd.read_file(args.gadm_geopackage_file,layer="ADM_1")
-    df_gadm_l1['geometry_gadm_l1'] = df_gadm_l1.geometry
-    # Save the representative point of each GADM unit
-    df_gadm_l1['geometry_gadm_l1_repr_point'] = df_gadm_l1.geometry.representative_point()
-    print('df_gadm_l1','*'*60)   
-    print(df_gadm_l1.sample(n=1).T)
-
-    # 2.3 Determine intersection between GBIF publisher location and GADM L1 unit
-    # The join will be made on the geometry columns ie point in polygon
-    df_gbif_point.crs = df_gadm_l1.crs
-    df_intersect = df_gbif_point.sjoin(df_gadm_l1, how="left")
-
-    # 2.4 Read TDWG WGSRPD L3 geojson format shape file ========================
-    df_tdwg_poly = gpd.read_file(args.inputfile_tdwg_wgsrpd_l3_json)
-    df_tdwg_poly['geometry_tdwg_l3'] = df_tdwg_poly.geometry
-    print('Read {} TDWG WGSRPD l3 shapes from {}'.format(len(df_tdwg_poly), args.inputfile_tdwg_wgsrpd_l3_json))
-    #
-    # 2.5 Determine intersection between the GADM representative point and the TDWG L3 polygon
-    df_intersect.crs = df_tdwg_poly.crs
-    df_intersect.geometry = df_intersect.geometry_gadm_l1_repr_point
-    # Rename index_left and index_right (legacy from previous spatial join)
-    df_intersect.rename(columns={'index_left':'index_left_legacy','index_right':'index_right_legacy'}, inplace=True)
-    df_intersect = df_intersect.sjoin(df_tdwg_poly, how="left")
 
-    if args.output_spatial_debug_info:
-        generateSpatialDebugInfo(df_intersect, outputdir=args.output_spatial_debug_dir)
+    # 2.2 GADM level 1 units, with the TDWG L3 region containing the 
+    # representative point of each. This is read from the prepared lookup if
+    # available, otherwise built from the GADM geopackage file and the TDWG
+    # WGSRPD L3 geojson format shape file (which is only read to do so) =====
+    if args.gadm_tdwg_lookup_file is None:
+        with instrumentation.span('read_tdwg') as span:
+            df_tdwg_poly = gpd.read_file(args.inputfile_tdwg_wgsrpd_l3_json)
+            df_tdwg_poly['geometry_tdwg_l3'] = df_tdwg_poly.geometry
+            print('Read {} TDWG WGSRPD l3 shapes from {}'.format(len(df_tdwg_poly), args.inputfile_tdwg_wgsrpd_l3_json))
+            span['rows'] = len(df_tdwg_poly)
+    with instrumentation.span('read_gadm_tdwg_lookup') as span:
+        if args.gadm_tdwg_lookup_file is not None:
+            df_gadm_tdwg = readGadmTdwgLookup(args.gadm_tdwg_lookup_file)
+            print('Read {} GADM L1 to TDWG L3 lookup lines from {}'.format(len(df_gadm_tdwg), args.gadm_tdwg_lookup_file))
+        else:
+            # Optionally only read the GADM units near the publisher locations 
+            mask = None
+            if args.gadm_mask_buffer is not None:
+                mask = buildPointsMask(df_gbif_point, args.gadm_mask_buffer)
+            df_gadm_l1 = readGadmL1(args.gadm_geopackage_file, mask=mask)
+            print('Read {} GADM L1 units from {}'.format(len(df_gadm_l1), args.gadm_geopackage_file))
+            df_gadm_tdwg = buildGadmTdwgLookup(df_gadm_l1, df_tdwg_poly, simplify_tolerance=args.gadm_simplify_tolerance)
+        span['rows'] = len(df_gadm_tdwg)
+
+    # 2.3 Determine intersection between GBIF publisher location and GADM L1 
+    # unit, and so the TDWG L3 region (plots of these, to check assignments, 
+    # can be made with spatialdebugplots.py)
+    with instrumentation.span('locate_publishers', rows=len(df_gbif_point)):
+        df_intersect = locatePublishers(df_gbif_point, df_gadm_tdwg)
+
+    ###########################################################################
+    # 3. Analyse each period
+    ###########################################################################
+    periods = [(None, args.year_min)] if args.periods is None else parsePeriods(args.periods)
+    output_variables = dict()
+    for name, year_min in periods:
+        suffix = '' if name is None else periodSuffix(name, year_min)
+        #
+        # 3.1 Drop data outside specified daterange ===========================
+        with instrumentation.span('apply_year_min' + suffix) as span:
+            df_tax_period, df_occ_period = (df_tax, df_occ) if year_min is None else applyYearMin(df_tax, df_occ, year_min)
+            span['rows'] = len(df_tax_period)
+        #
+        # 3.2 Count number of taxa with type material served from within native range
+        with instrumentation.span('analyse' + suffix, rows=len(df_tax_period)):
+            analysis_variables = analyseNativeRangeTypeAvailability(df_tax_period, df_occ_period, df_dist, df_intersect)
+        output_variables['taxa2nativerangetypeavailability' + suffix] = analysis_variables
 
+    # ###########################################################################
+    # # 4. Output
+    # ###########################################################################
+    #
+    # 4.1 YAML format data variables (a section per period)
+    with open(args.outputfile_yaml, 'w') as f:
+        yaml.dump(output_variables, f)
+    if args.spans_file is not None:
+        instrumentation.write(args.spans_file)
+        
+    # 4.2 Data
+    # TBC
+    # print('Outputting {} rows to {}'.format(len(df), args.outputfile_data))
+    # df.to_csv(args.outputfile_data,sep='\t',index=False)
+
+def analyseNativeRangeTypeAvailability(df_tax, df_occ, df_dist, df_intersect):
+    # Rather than joining taxonomy, occurrences, publisher locations and 
+    # native distributions into one (very large) dataframe, each is first 
+    # reduced to the distinct values needed, and these are then joined
+    #
     ###########################################################################
-    # 3. Integrate taxonomy (df_tax), occurrences (df_occ) and TDWG WGSRPD L3 
-    # (df_intersect) in which the publisher is located
+    # 1. Reduce inputs to distinct taxon / WGSRPD area pairs
     ###########################################################################
     #
-    # 3.1 Attach integrated taxonomy to GBIF occurrence type data==============
-    mask=(df_tax['original_id'].notnull())
-    df_tax.loc[mask,'original_id']=df_tax[mask]['original_id'].astype(int)
-    mask=(df_occ['taxonKey'].notnull())
-    df_occ.loc[mask,'taxonKey']=df_occ[mask]['taxonKey'].astype(int)
-    df = pd.merge(left=df_tax[df_tax['original_id'].notnull()],
-                    right=df_occ[df_occ['taxonKey'].notnull()],
+    # 1.1 Taxa with a GBIF name ===============================================
+    df_taxa = df_tax.loc[df_tax['original_id'].notnull(),['original_id','accepted_id']].drop_duplicates()
+    df_accepted = df_taxa[['accepted_id']][df_taxa.accepted_id.notnull()].drop_duplicates()
+
+    # 1.2 TDWG WGSRPD L3 regions in which each taxon has type material published
+    # Taxa without occurrences are kept (with a null publishingOrgKey) as 
+    # these are joined to publisher locations in the same way
+    df_occ_publ = df_occ.loc[df_occ['taxonKey'].notnull(),['taxonKey','publishingOrgKey']].drop_duplicates()
+    df_taxon_publ = pd.merge(left=df_taxa,
+                    right=df_occ_publ,
                     left_on='original_id',
                     right_on='taxonKey',
-                    how='left' )
-
-    # 3.2 Attach publ org locations and containing TDWG WGSRPD L3 region ======
-    df = pd.merge(left=df,
-                    right=df_intersect[['publishingOrgKey','latitude','longitude','LEVEL3_COD']],
-                    left_on='publishingOrgKey',
-                    right_on='publishingOrgKey',
-                    how='left',
-                    suffixes=['','_org'])
-    df.rename(columns={'LEVEL3_COD':'publishingOrg_area_code_l3'},inplace=True)
-
-    # 3.3 Attach native distributions =========================================
-    df = pd.merge(left=df,
-                    right=df_dist[df_dist.introduced==0],
-                    left_on='accepted_id',
-                    right_on='plant_name_id',
-                    how='left' )
-        
-    # 3.4 Establish WGSRPD level 2 and level 1 codes from LEVEL3_COD ==========
+                    how='left')[['accepted_id','publishingOrgKey']].drop_duplicates()
+    df_publ_l3 = df_intersect.loc[df_intersect.LEVEL3_COD.notnull(),['publishingOrgKey','LEVEL3_COD']].drop_duplicates()
+    df_taxon_publ_l3 = (pd.merge(left=df_taxon_publ[df_taxon_publ.accepted_id.notnull()],
+                    right=df_publ_l3,
+                    on='publishingOrgKey')[['accepted_id','LEVEL3_COD']]
+                    .drop_duplicates()
+                    .rename(columns={'LEVEL3_COD':'publishingOrg_area_code_l3'}))
+
+    # 1.3 Native distributions of these taxa ==================================
+    df_native = pd.merge(left=df_dist.loc[df_dist.introduced==0,['plant_name_id','continent_code_l1','region_code_l2','area_code_l3']],
+                    right=df_accepted,
+                    left_on='plant_name_id',
+                    right_on='accepted_id')
+    df_native = df_native[['accepted_id','continent_code_l1','region_code_l2','area_code_l3']].drop_duplicates()
+
+    # 1.4 Establish WGSRPD level 2 and level 1 codes from LEVEL3_COD (using
+    # the WGSRPD hierarchy of the native distributions) =====================
+    df_wgsrpd = buildHierarchy(df_native)
     for higher_level_code in ['region_code_l2','continent_code_l1']:
-        wgsrpd_mapper = df[['area_code_l3',higher_level_code]].drop_duplicates().set_index('area_code_l3')[higher_level_code].to_dict()
         new_col = 'publishingOrg_' + higher_level_code
-        df[new_col] = df['publishingOrg_area_code_l3'].map(wgsrpd_mapper)
-   
+        df_taxon_publ_l3[new_col] = mapAreaCodes(df_taxon_publ_l3['publishingOrg_area_code_l3'], df_wgsrpd, higher_level_code)
+
     ###########################################################################
-    # 4. Count number of taxa with type material served from within native range
+    # 2. Count number of taxa with type material served from within native range
     ###########################################################################
     wgsrpd_columns = {'continent_code_l1':'publishingOrg_continent_code_l1',
                         'region_code_l2':'publishingOrg_region_code_l2',
                         'area_code_l3':'publishingOrg_area_code_l3'}
     analysis_variables = dict()
-    accepted_id_count = df.accepted_id.nunique()
+    accepted_id_count = df_taxa.accepted_id.nunique()
     analysis_variables['taxon_count'] = accepted_id_count
     summary_message=""
     for (distribution_loc, publishing_org_loc) in wgsrpd_columns.items():
-        mask=(df[distribution_loc] == df[publishing_org_loc])
-        accepted_id_served_from_within_native_range_count = df[mask].accepted_id.nunique()
+        # Semi join the distinct areas in which each taxon is published to 
+        # its distinct native areas at this level
+        df_published = df_taxon_publ_l3[['accepted_id',publishing_org_loc]].dropna().drop_duplicates()
+        df_served_natively = pd.merge(left=df_published,
+                    right=df_native[['accepted_id',distribution_loc]].dropna().drop_duplicates(),
+                    left_on=['accepted_id',publishing_org_loc],
+                    right_on=['accepted_id',distribution_loc])
+        accepted_id_served_from_within_native_range_count = df_served_natively.accepted_id.nunique()
         summary_message += ('- {:.2%} taxa ({} of {}) are represented by type material served from within their native range in {}\n'.format(accepted_id_served_from_within_native_range_count/accepted_id_count, accepted_id_served_from_within_native_range_count, accepted_id_count, distribution_loc))
         current_level_variables = dict()
         current_level_variables['taxon_represented_total']=accepted_id_served_from_within_native_range_count
         current_level_variables['taxon_represented_pc']=round((accepted_id_served_from_within_native_range_count/accepted_id_count)*100)
         analysis_variables[distribution_loc] = current_level_variables
-    
-    output_variables = dict()
-    output_variables['taxa2nativerangetypeavailability'] = analysis_variables
-
-    # ###########################################################################
-    # # 4. Output
-    # ###########################################################################
-    #
-    # 4.1 YAML format data variables
-    with open(args.outputfile_yaml, 'w') as f:
-        yaml.dump(output_variables, f)
-        
-    # 4.2 Data
-    # TBC
-    # print('Outputting {} rows to {}'.format(len(df), args.outputfile_data))
-    # df.to_csv(args.outputfile_data,sep='\t',index=False)
-
-def generateSpatialDebugInfo(df, outputdir, orig_point_geometry_column_name='geometry_original_point', first_poly_geometry_column_name='geometry_gadm_l1', repr_point_geometry_column_name='geometry_gadm_l1_repr_point', final_poly_geometry_column_name='geometry_tdwg_l3'):
-    df['geometry_safe'] = df['geometry']
-
-    for i, row in df.iterrows():
-        
-        print(row)
-        
-        # Create a figure
-        fig, ax = plt.subplots(figsize=(8,10))
-
-        # Plot original point
-        try:
-            df[df.index==i].set_geometry(orig_point_geometry_column_name).plot(ax=ax, marker='x', color='red', markersize=5)
-        except:
-            print('Unable to plot {} for index {}'.format(orig_point_geometry_column_name, i))
-
-        # Plot GADM poly
-        try:
-            df[df.index==i].set_geometry(first_poly_geometry_column_name).plot(ax=ax,color='red',alpha=0.1)
-        except:
-            print('Unable to plot {} for index {}'.format(first_poly_geometry_column_name, i))
-
-        # Plot representative point
-        try:
-            df[df.index==i].set_geometry(repr_point_geometry_column_name).plot(ax=ax, marker='x', color='blue', markersize=5)
-        except:
-            print('Unable to plot {} for index {}'.format(repr_point_geometry_column_name, i))
-
-        # Plot TDWG poly
-        try:
-            df[df.index==i].set_geometry(final_poly_geometry_column_name).plot(ax=ax,color='green',alpha=0.1)
-        except:
-            print('Unable to plot {} for index {}'.format(final_poly_geometry_column_name, i))
-
-        title = '{org_title} ({country})'.format(org_title = row['title_gbif'], country = row['country_gbif'])
-        plt.title(title)
-
-        # Save the plot
-        figname = '{outputdir}/{id}.png'.format(outputdir = outputdir, id = i)
-        plt.savefig(figname)
+    return analysis_variables
 
 if __name__ == '__main__':
     main()
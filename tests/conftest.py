@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The scripts are modules at the repository root (there is no package), so
+# the root is put on the path whichever directory pytest is run from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
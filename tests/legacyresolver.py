@@ -0,0 +1,43 @@
+import pandas as pd
+import re
+
+# The resolution of multiple matches as it was before gbif2wcvp.py resolved
+# them column-wise (each name's group of matches resolved in turn, with
+# groupby.apply), kept unchanged as the reference its results are checked
+# against in test_gbif2wcvp.py
+
+def extractRank(s):
+    rank = None
+    m = re.search(r'(?<= )(var\.|ssp\.|subsp\.|f.)(?= )',s)
+    if m:
+        rank = m.groups()[0]
+        if rank == 'ssp.':
+            rank = 'subsp.'
+    return rank
+
+def resolveMultiGroup(dfg):
+    matched_row = None
+    original_name = dfg['original_name'].unique()[0]
+    if len(dfg) == 1:
+        matched_row = dfg
+    rank = extractRank(original_name)
+    if matched_row is None and rank is not None:
+        padded_rank = ' {} '.format(rank)
+        mask = (dfg.original_name.str.contains(padded_rank))
+        if len(dfg[mask]) == 1:
+            matched_row = dfg[mask]
+    for status in ['Accepted','Orthographic','Homotypic Synonym']:
+        if matched_row is None:
+            mask = (dfg.match_status == status)
+            if len(dfg[mask]) == 1:
+                matched_row = dfg[mask]
+    return matched_row
+
+def resolveMultipleMatchesByGroup(df):
+    # resolveMultipleMatches as it was, resolving each group in turn
+    dfg = df.groupby('original_name')['match_id'].nunique().to_frame('match_count')
+    df_single = pd.merge(left=df, right=dfg[dfg.match_count==1], left_on='original_name', right_index=True, how='inner').drop(columns='match_count')
+    df_multi = pd.merge(left=df, right=dfg[dfg.match_count>1], left_on='original_name', right_index=True, how='inner').drop(columns='match_count')
+    df_multi = df_multi.groupby('original_name').apply(lambda x: resolveMultiGroup(x))
+    df_multi.reset_index(drop=True, inplace=True)
+    return pd.concat([df_single, df_multi])
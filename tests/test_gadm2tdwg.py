@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+from benchmarks import synthetic
+from gadm2tdwg import buildGadmTdwgLookup, buildPointsMask, buildPublisherPoints, locatePublishers, readGadmL1
+
+# Reading only the GADM units near the publisher locations (--gadm_mask_buffer
+# of taxa2nativerangetypeavailability.py), with a synthetic grid of units
+
+@pytest.fixture(scope='module')
+def gadm_geopackage_file(tmp_path_factory):
+    filepath = tmp_path_factory.mktemp('gadm2tdwg') / 'gadm.gpkg'
+    synthetic.makeGadmUnits().to_file(filepath, layer='ADM_1', driver='GPKG')
+    return str(filepath)
+
+def makePublishers(latitudes, longitudes):
+    return pd.DataFrame({'publishingOrgKey': ['p{}'.format(i) for i in range(len(latitudes))]
+                         ,'latitude': latitudes
+                         ,'longitude': longitudes
+                         ,'country': 'GB'
+                         ,'title': 'Publisher'})
+
+def testMaskedRead(gadm_geopackage_file):
+    df_gbif_point = buildPublisherPoints(makePublishers([51.5, np.nan], [2.5, np.nan]))
+    df_gadm_l1 = readGadmL1(gadm_geopackage_file, mask=buildPointsMask(df_gbif_point, 1))
+    assert 0 < len(df_gadm_l1) < len(readGadmL1(gadm_geopackage_file))
+    df_located = locatePublishers(df_gbif_point, buildGadmTdwgLookup(df_gadm_l1, synthetic.makeTdwgAreas()))
+    assert df_located.LEVEL3_COD.notnull().tolist() == [True, False]
+
+def testMaskedReadWithoutLocations(gadm_geopackage_file):
+    # No publisher has a location, so no units are read (rather than all)
+    df_gbif_point = buildPublisherPoints(makePublishers([np.nan], [np.nan]))
+    mask = buildPointsMask(df_gbif_point, 1)
+    assert mask.is_empty
+    df_gadm_l1 = readGadmL1(gadm_geopackage_file, mask=mask)
+    assert len(df_gadm_l1) == 0
+    df_located = locatePublishers(df_gbif_point, buildGadmTdwgLookup(df_gadm_l1, synthetic.makeTdwgAreas()))
+    assert df_located.LEVEL3_COD.isnull().all()
@@ -0,0 +1,192 @@
+import pandas as pd
+import numpy as np
+import contextlib
+import io
+import os
+import pytest
+import gbif2wcvp
+from benchmarks import synthetic
+from benchmarks.fuzzymatch import bruteForceMatches, makeMisspelledTaxa
+from benchmarks.publicationyears import asYears, cleanPublicationYearsPerValue, makeCorpus
+from legacyresolver import resolveMultipleMatchesByGroup
+
+# Checks that the optimised parts of gbif2wcvp give the same results as the
+# simpler versions they replaced (or as a direct computation), on small
+# synthetic inputs with the awkward cases of the real data: names without a
+# genus, homonyms, names shared across genera and empty partitions.
+#
+# Run from the repository root: python -m pytest tests
+
+GBIF_TAXON_COLUMNS=['taxonID','scientificName','genericName','specificEpithet','taxonRank','family']
+
+def makeGbifNames(df_wcvp_source, n, rng, first_taxon_id=1):
+    # GBIF names (as filtered by filtergbif.py) with, besides those made by
+    # synthetic.makeGbifTaxa, homonyms (the same name in another family),
+    # names also used in another genus, and names without a genus
+    df = synthetic.makeGbifTaxa(df_wcvp_source, n, rng, first_taxon_id=first_taxon_id)[GBIF_TAXON_COLUMNS]
+    families = df.family.unique()
+    genera = df.genericName.unique()
+    df_homonyms = df.sample(n=n // 20, random_state=rng.integers(2**31)).copy()
+    df_homonyms['family'] = rng.choice(families, len(df_homonyms))
+    df_shared = df.sample(n=n // 20, random_state=rng.integers(2**31)).copy()
+    df_shared['genericName'] = rng.choice(genera, len(df_shared))
+    df_no_genus = df.sample(n=n // 50, random_state=rng.integers(2**31)).copy()
+    df_no_genus['genericName'] = np.nan
+    df_extra = pd.concat([df_homonyms, df_shared, df_no_genus], ignore_index=True)
+    df_extra['taxonID'] = np.arange(df.taxonID.max() + 1, df.taxonID.max() + 1 + len(df_extra))
+    return pd.concat([df, df_extra], ignore_index=True).sample(frac=1, random_state=rng.integers(2**31)).reset_index(drop=True)
+
+def writeGbif(df, filepath):
+    df.to_csv(filepath, sep='\t', index=False)
+
+def writeWcvp(df, filepath):
+    df.astype({'accepted_plant_name_id': 'Int64'}).to_csv(filepath, sep='|', index=False)
+
+def runGbif2wcvp(argv):
+    with contextlib.redirect_stdout(io.StringIO()):
+        gbif2wcvp.main(argv)
+
+@pytest.fixture(scope='module')
+def inputs(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    df_wcvp_source = synthetic.makeWcvpNames(3000, rng)
+    df_gbif = makeGbifNames(df_wcvp_source, 2000, rng)
+    datadir = tmp_path_factory.mktemp('gbif2wcvp')
+    writeGbif(df_gbif, datadir / 'gbif.tsv')
+    writeWcvp(df_wcvp_source, datadir / 'wcvp.txt')
+    return {'rng': rng, 'df_wcvp_source': df_wcvp_source, 'df_gbif': df_gbif, 'datadir': datadir}
+
+###############################################################################
+# Publication years (cleanPublicationYears, per value as cleanPublicationYear)
+###############################################################################
+
+def testPublicationYears():
+    rng = np.random.default_rng(0)
+    corpus = pd.Series(makeCorpus(5000, rng), dtype=object)
+    for dtype in ['object', 'category']:
+        s = corpus.astype(dtype)
+        assert asYears(gbif2wcvp.cleanPublicationYears(s)) == asYears(cleanPublicationYearsPerValue(s))
+
+def testPublicationYearsAllMissing():
+    for s in [pd.Series([np.nan, np.nan]), pd.Series([None, None], dtype=object), pd.Series([], dtype=object), pd.Series([None], dtype='category')]:
+        assert asYears(gbif2wcvp.cleanPublicationYears(s)) == [None] * len(s)
+
+###############################################################################
+# Resolution of multiple matches (columnar, as groupby.apply before)
+###############################################################################
+
+def makeMatches(n, rng):
+    # Matches of names (some infraspecific, some missing, and each of several
+    # GBIF taxa) to between one and four WCVP names of random status, in a
+    # random order
+    names = list(synthetic.randomWords(rng, 60).str.capitalize() + ' ' + synthetic.randomWords(rng, 60))
+    names += [name + ' ' + rank + ' abc' for name, rank in zip(names[:20], ['var.', 'subsp.', 'ssp.', 'f.'] * 5)]
+    match_counts = rng.choice([1, 1, 2, 3, 4], len(names) + 1)
+    statuses = np.array(synthetic.TAXON_STATUSES + ['Homotypic Synonym', None], dtype=object)
+    name_positions = rng.integers(0, len(names) + 1, n)
+    df = pd.DataFrame({'taxonID': np.arange(n)
+                       ,'original_name': np.array(names + [None], dtype=object)[name_positions]
+                       ,'match_id': rng.integers(0, match_counts[name_positions]).astype(str)
+                       ,'match_status': statuses[rng.integers(0, len(statuses), n)]})
+    return df
+
+def testResolveMultipleMatches():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        df = makeMatches(400, rng)
+        expected = resolveMultipleMatchesByGroup(df).reset_index(drop=True)
+        found = gbif2wcvp.resolveMultipleMatches(df).reset_index(drop=True)
+        pd.testing.assert_frame_equal(found, expected)
+
+###############################################################################
+# Fuzzy matching (as comparing every pair of names in the genus)
+###############################################################################
+
+def testFuzzyMatches(inputs):
+    rng = np.random.default_rng(0)
+    df_wcvp = gbif2wcvp.prepareWcvpNames(inputs['df_wcvp_source'].copy())
+    block_encoding = gbif2wcvp.encodeColumn(df_wcvp, 'genericName', dict())
+    accepted_positions = gbif2wcvp.buildAcceptedIndex(df_wcvp)
+    df_gbif = makeMisspelledTaxa(inputs['df_wcvp_source'], 500, rng)
+    df_no_genus = gbif2wcvp.prepareGbifNames(pd.DataFrame({'taxonID': [-1, -2], 'scientificName': ['nan abcde', None], 'genericName': [np.nan, np.nan], 'specificEpithet': ['abcde', 'abcdf']}))
+    df_gbif = pd.concat([df_gbif, df_no_genus], ignore_index=True)
+    with contextlib.redirect_stdout(io.StringIO()):
+        df_match = gbif2wcvp.matchNamesFuzzily(df_gbif, df_wcvp, block_encoding, accepted_positions, id_col='taxonID')
+    found = df_match[df_match.match_id.notnull()].groupby('original_id').match_id.agg(set)
+    positions = np.flatnonzero(df_gbif.genericName.notnull().to_numpy())
+    expected = bruteForceMatches(df_gbif, df_wcvp, positions, 2, 0.2)
+    assert {taxon_id: found.get(taxon_id, set()) for taxon_id in expected} == expected
+    # Names without a genus are in no block, so are not matched
+    assert not found.index.isin([-1, -2]).any()
+
+###############################################################################
+# Matching in partitions of the genera (as in a single process)
+###############################################################################
+
+def testPartitionGenera(inputs):
+    df_gbif = gbif2wcvp.prepareGbifNames(inputs['df_gbif'].copy())
+    for partition_count in [1, 3, 1000]:
+        partitions, genus_partitions, genera = gbif2wcvp.partitionGenera(df_gbif, partition_count)
+        assert len(partitions) == len(df_gbif)
+        assert ((partitions >= 0) & (partitions < partition_count)).all()
+        # Names shared across genera, and names without a genus, are each in
+        # a single partition
+        for column in ['scientificName', 'name', 'genericName']:
+            assert (pd.Series(partitions).groupby(df_gbif[column].fillna('').to_numpy()).nunique() == 1).all()
+
+def testPartitionMatching(inputs):
+    df_gbif = gbif2wcvp.prepareGbifNames(inputs['df_gbif'].copy())
+    df_wcvp = gbif2wcvp.prepareWcvpNames(inputs['df_wcvp_source'].copy())
+    with contextlib.redirect_stdout(io.StringIO()):
+        homonym_mask = gbif2wcvp.findHomonyms(df_gbif)
+        df_matches = pd.concat(gbif2wcvp.matchStages(df_gbif, df_wcvp, gbif2wcvp.MATCH_CONFIGURATIONS, homonym_mask))
+        expected = gbif2wcvp.resolveMultipleMatches(gbif2wcvp.resolveAccepted(df_matches)).reset_index(drop=True)
+    accepted_positions = gbif2wcvp.buildAcceptedIndex(df_wcvp)
+    # With more partitions than genera, most partitions are empty (and skipped)
+    for partition_count in [1, 4, 5 * df_gbif.genericName.nunique()]:
+        partitions = gbif2wcvp.partitionMatching(df_gbif, df_wcvp, accepted_positions, homonym_mask, gbif2wcvp.MATCH_CONFIGURATIONS, partition_count)
+        assert 0 < len(partitions) <= partition_count
+        assert all(len(partition['df_gbif']) > 0 for partition in partitions)
+        results = [gbif2wcvp.matchPartition(partition) for partition in partitions]
+        found = gbif2wcvp.mergePartitionMatches(df_gbif, [df_partition for df_partition, _ in results]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(found, expected)
+
+def testWorkersOutput(inputs):
+    datadir = inputs['datadir']
+    for workers in [1, 3]:
+        runGbif2wcvp([str(datadir / 'gbif.tsv'), str(datadir / 'wcvp.txt'), '--workers', str(workers), str(datadir / 'out-{}.tsv'.format(workers))])
+    with open(datadir / 'out-1.tsv', 'rb') as f1, open(datadir / 'out-3.tsv', 'rb') as f3:
+        assert f1.read() == f3.read()
+
+###############################################################################
+# Incremental matching (as matching all of the names, in the same order)
+###############################################################################
+
+def testIncrementalOutput(inputs):
+    rng = np.random.default_rng(1)
+    datadir = inputs['datadir']
+    df_gbif = inputs['df_gbif']
+    df_wcvp_source = inputs['df_wcvp_source']
+    # New GBIF names, some removed and some with changed authors, and new
+    # WCVP names, some removed and some with changed status
+    df_new_gbif = df_gbif.drop(df_gbif.sample(n=50, random_state=1).index)
+    changed = df_new_gbif.sample(n=50, random_state=2).index
+    df_new_gbif.loc[changed, 'scientificName'] = df_new_gbif.loc[changed, 'scientificName'] + ' ex Other'
+    df_new_gbif = pd.concat([df_new_gbif, makeGbifNames(df_wcvp_source, 100, rng, first_taxon_id=df_gbif.taxonID.max() + 1)], ignore_index=True)
+    df_new_wcvp = df_wcvp_source.drop(df_wcvp_source.sample(n=50, random_state=3).index)
+    changed = df_new_wcvp.sample(n=50, random_state=4).index
+    df_new_wcvp.loc[changed, 'taxon_status'] = 'Accepted'
+    df_added = synthetic.makeWcvpNames(100, rng)
+    df_added['plant_name_id'] += df_wcvp_source.plant_name_id.max()
+    df_added['accepted_plant_name_id'] += df_wcvp_source.plant_name_id.max()
+    df_new_wcvp = pd.concat([df_new_wcvp, df_added], ignore_index=True)
+    writeGbif(df_new_gbif, datadir / 'gbif-new.tsv')
+    writeWcvp(df_new_wcvp, datadir / 'wcvp-new.txt')
+
+    for fuzzy in [[], ['--fuzzy']]:
+        runGbif2wcvp([str(datadir / 'gbif.tsv'), str(datadir / 'wcvp.txt')] + fuzzy + [str(datadir / 'previous.tsv')])
+        runGbif2wcvp([str(datadir / 'gbif-new.tsv'), str(datadir / 'wcvp-new.txt')] + fuzzy + [str(datadir / 'full.tsv')])
+        runGbif2wcvp([str(datadir / 'gbif-new.tsv'), str(datadir / 'wcvp-new.txt')] + fuzzy + ['--previous_output', str(datadir / 'previous.tsv')
+                      , '--previous_gbif', str(datadir / 'gbif.tsv'), '--previous_wcvp', str(datadir / 'wcvp.txt'), str(datadir / 'incremental.tsv')])
+        with open(datadir / 'incremental.tsv', 'rb') as f_incremental, open(datadir / 'full.tsv', 'rb') as f_full:
+            assert f_incremental.read() == f_full.read()
@@ -0,0 +1,115 @@
+import contextlib
+import http.server
+import io
+import json
+import os
+import threading
+import time
+import urllib.error
+import pytest
+from gbifregistry import HttpTransport, OrganizationCache, getOrganizationsData
+
+# Registry lookups, with a stub transport (or a stub registry API server for
+# HttpTransport) and a temporary cache directory
+
+class StubTransport:
+    # Organizations from a dict (None for those unknown to the registry), and
+    # an error for any other key. Records the keys looked up
+    def __init__(self, organizations):
+        self.organizations = organizations
+        self.lookups = []
+        self.lock = threading.Lock()
+
+    def getOrganization(self, key):
+        with self.lock:
+            self.lookups.append(key)
+        if key not in self.organizations:
+            raise RuntimeError('lookup failed')
+        return self.organizations[key]
+
+ORGANIZATIONS={'a': {'key': 'a', 'title': 'A'}, 'b': {'key': 'b', 'title': 'B'}, 'unknown': None}
+
+def lookup(keys, transport, cache):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return getOrganizationsData(keys, transport=transport, cache=cache, workers=2)
+
+def testLookupsAreCached(tmp_path):
+    cache = OrganizationCache(str(tmp_path))
+    keys = ['a', None, 'unknown', 'b', 'failing']
+    transport = StubTransport(ORGANIZATIONS)
+    metadata = lookup(keys, transport, cache)
+    assert metadata == {'a': ORGANIZATIONS['a'], None: None, 'unknown': None, 'b': ORGANIZATIONS['b'], 'failing': None}
+    assert sorted(transport.lookups) == ['a', 'b', 'failing', 'unknown']
+    # Known and unknown organizations are read from the cache, failed
+    # lookups are retried
+    transport = StubTransport(ORGANIZATIONS)
+    assert lookup(keys, transport, cache) == metadata
+    assert transport.lookups == ['failing']
+
+def testExpiredEntriesAreLookedUpAgain(tmp_path):
+    transport = StubTransport(ORGANIZATIONS)
+    lookup(['a', 'unknown'], transport, OrganizationCache(str(tmp_path)))
+    transport = StubTransport(ORGANIZATIONS)
+    lookup(['a', 'unknown'], transport, OrganizationCache(str(tmp_path), ttl_days=0))
+    assert sorted(transport.lookups) == ['a', 'unknown']
+
+def testEvictExpired(tmp_path):
+    cache = OrganizationCache(str(tmp_path))
+    cache.put('a', ORGANIZATIONS['a'])
+    expired = time.time() - 31 * 24 * 60 * 60
+    with open(cache.path('old'), 'w') as f:
+        json.dump({'fetched': expired, 'data': None}, f)
+    with open(cache.path('corrupt'), 'w') as f:
+        f.write('{')
+    # A file being written by another run, one left by a run which stopped
+    # long ago, and a file which is not part of the cache
+    writing = tmp_path / 'b.json.123.tmp'
+    writing.write_text('{')
+    stale = tmp_path / 'c.json.456.tmp'
+    stale.write_text('{')
+    os.utime(stale, (expired, expired))
+    other = tmp_path / 'README'
+    other.write_text('')
+    assert cache.evictExpired() == 3
+    assert sorted(os.listdir(tmp_path)) == ['README', 'a.json', 'b.json.123.tmp']
+    assert cache.get('a')['data'] == ORGANIZATIONS['a']
+
+class StubRegistryHandler(http.server.BaseHTTPRequestHandler):
+    # /organization/<key> from ORGANIZATIONS, 404 for unknown organizations,
+    # and 500 for others
+    def do_GET(self):
+        key = self.path.rsplit('/', 1)[1]
+        if ORGANIZATIONS.get(key) is not None:
+            body = json.dumps(ORGANIZATIONS[key]).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_response(404 if key in ORGANIZATIONS else 500)
+            self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def registry_url():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubRegistryHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/v1/'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+def testHttpTransport(registry_url):
+    transport = HttpTransport(registry_url)
+    assert transport.getOrganization('a') == ORGANIZATIONS['a']
+    assert transport.getOrganization('unknown') is None
+    with pytest.raises(urllib.error.HTTPError):
+        transport.getOrganization('failing')
+
+def testHttpTransportLookups(registry_url, tmp_path):
+    cache = OrganizationCache(str(tmp_path))
+    metadata = lookup(['a', 'unknown', 'failing'], HttpTransport(registry_url), cache)
+    assert metadata == {'a': ORGANIZATIONS['a'], 'unknown': None, 'failing': None}
+    assert sorted(os.listdir(tmp_path)) == ['a.json', 'unknown.json']
@@ -0,0 +1,75 @@
+import argparse
+import os
+import pytest
+from pipeline import PERIODS, FileHashes, defineStages, isUpToDate, keyArgv, stageDependencies, stageKey, writeStageManifest
+
+# Stage keys, which decide whether a stage of pipeline.py is re-run: they
+# change with the content of the stage's inputs, not with their mtimes
+
+@pytest.fixture
+def stage(tmp_path):
+    inputfile = tmp_path / 'input.tsv'
+    inputfile.write_text('taxonID\n1\n')
+    outputfile = tmp_path / 'output.tsv'
+    outputfile.write_text('taxonID\n1\n')
+    return {'name': 'filter'
+            ,'script': 'filtergbif.py'
+            ,'inputs': [str(inputfile)]
+            ,'outputs': [str(outputfile)]
+            ,'argv': [str(inputfile), '--workers', '4', str(outputfile)]}
+
+def runStage(stage, hashes, cache_dir):
+    # Returns whether the stage would be run, recording it as run if so
+    key = stageKey(stage, hashes)
+    if isUpToDate(stage, key, hashes, str(cache_dir)):
+        return False
+    writeStageManifest(str(cache_dir), stage, key, hashes, 0)
+    return True
+
+def touch(filepath):
+    stat = os.stat(filepath)
+    os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+def testTouchedInputDoesNotRerun(stage, tmp_path):
+    hashes = FileHashes(str(tmp_path / 'hashes.json'))
+    assert runStage(stage, hashes, tmp_path)
+    assert not runStage(stage, hashes, tmp_path)
+    touch(stage['inputs'][0])
+    assert not runStage(stage, hashes, tmp_path)
+    # Nor with the hashes read back from their file
+    hashes.save()
+    touch(stage['inputs'][0])
+    assert not runStage(stage, FileHashes(str(tmp_path / 'hashes.json')), tmp_path)
+
+def testChangedInputReruns(stage, tmp_path):
+    hashes = FileHashes(str(tmp_path / 'hashes.json'))
+    assert runStage(stage, hashes, tmp_path)
+    with open(stage['inputs'][0], 'a') as f:
+        f.write('2\n')
+    assert runStage(stage, hashes, tmp_path)
+    assert not runStage(stage, hashes, tmp_path)
+
+def testChangedOutputReruns(stage, tmp_path):
+    hashes = FileHashes(str(tmp_path / 'hashes.json'))
+    assert runStage(stage, hashes, tmp_path)
+    with open(stage['outputs'][0], 'a') as f:
+        f.write('2\n')
+    assert runStage(stage, hashes, tmp_path)
+
+def testExecutionOptionsAreNotInKey(stage, tmp_path):
+    hashes = FileHashes(str(tmp_path / 'hashes.json'))
+    assert keyArgv(['a', '--workers', '4', '--spans_file=x.yaml', '--limit=10', 'b']) == ['a', '--limit=10', 'b']
+    assert runStage(stage, hashes, tmp_path)
+    stage['argv'] = [stage['inputs'][0], '--workers=8', stage['outputs'][0]]
+    assert not runStage(stage, hashes, tmp_path)
+    stage['argv'] = [stage['inputs'][0], '--limit=10', stage['outputs'][0]]
+    assert runStage(stage, hashes, tmp_path)
+
+def testParquetFileNames():
+    # Intermediate files are named after their format, so the stages still
+    # depend on each other with either
+    for file_format, extension in [(None, '.csv'), ('tsv', '.csv'), ('parquet', '.parquet')]:
+        args = argparse.Namespace(data_dir='data', downloads_dir='downloads', limit=None, format=file_format, periods=PERIODS, fuzzy=False, filter_workers=1, match_workers=1, spans=False)
+        stages = {stage['name']: stage for stage in defineStages(args)}
+        assert stages['gbif2wcvp']['outputs'] == [os.path.join('data', 'gbif2wcvp' + extension)]
+        assert stageDependencies(stages.values())['taxa2nativerangetypeavailability'] == {'gbif2wcvp', 'types2publisherlocations', 'gadm2tdwg'}
@@ -1,7 +1,10 @@
 import pandas as pd
 pd.set_option('display.max_rows',100)
 import argparse
-from pygbif import registry
+from gbifoccurrences import readOccurrences
+from gbifregistry import GBIF_API_URL, HttpTransport, OrganizationCache, PygbifTransport, getOrganizationsData
+from instrumentation import Instrumentation, addInstrumentationArguments
+from tableio import FORMATS, PUBLISHER_LOCATIONS_SCHEMA, writeTable
 
 GEONAMES_COLUMNS=['geonameid'
                 ,'name'
@@ -23,15 +26,7 @@ GEONAMES_COLUMNS=['geonameid'
                 ,'timezone'
                 ,'modification date']
 
-def getOrganizationData(key):
-    organization_data = None
-    try:
-        organization_data = registry.organizations(data='all', uuid=key)['data']
-    except:
-        pass
-    return organization_data
-
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--limit", default=None, type=int)
     parser.add_argument("inputfile_gbif", type=str)
@@ -41,32 +36,53 @@ def main():
     parser.add_argument("inputfile_geonames", type=str)
     parser.add_argument('--delimiter_geonames', type=str, default='\t')
     parser.add_argument('--ignore_gbif_publ_coordinates', type=str, default=None)
+    parser.add_argument('--format', type=str, choices=FORMATS, default='tsv', help='Format of the output file')
+    parser.add_argument('--per_publisher', action='store_true', help='Output one row per publisher, rather than one per occurrence')
+    parser.add_argument('--registry_workers', type=int, default=8, help='Number of concurrent GBIF registry lookups')
+    parser.add_argument('--registry_cache', type=str, default=None, help='Directory in which to cache GBIF registry lookups')
+    parser.add_argument('--registry_cache_ttl_days', type=float, default=30, help='Age after which cached GBIF registry lookups are refreshed')
+    parser.add_argument('--registry_url', type=str, default=None, help='Query the registry API at this URL (eg {} or a local stub server) rather than via pygbif'.format(GBIF_API_URL))
+    addInstrumentationArguments(parser)
     parser.add_argument("outputfile", type=str)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    instrumentation = Instrumentation.fromArgs('types2publisherlocations', args)
 
     ###########################################################################
     # 1. Read input files
     ###########################################################################
     #
     # 1.1 Read GBIF data file ===========================================================
-    df = pd.read_csv(args.inputfile_gbif, sep=args.delimiter_gbif, nrows=args.limit, usecols=['publishingOrgKey'])
-    print('Read {} GBIF lines from: {}'.format(len(df), args.inputfile_gbif))
+    with instrumentation.span('read_occurrences') as span:
+        df = readOccurrences(args.inputfile_gbif, sep=args.delimiter_gbif, nrows=args.limit, usecols=['publishingOrgKey'])
+        print('Read {} GBIF lines from: {}'.format(len(df), args.inputfile_gbif))
+        if args.per_publisher:
+            df.drop_duplicates(inplace=True, ignore_index=True)
+            print('Retained {} distinct publishers'.format(len(df)))
+        span['rows'] = len(df)
 
     # 1.2 Read IH data file ===========================================================
-    df_ih = pd.read_csv(args.inputfile_ih, sep=args.delimiter_ih, nrows=args.limit,on_bad_lines='warn')
-    print('Read {} IH lines from: {}'.format(len(df_ih), args.inputfile_ih))
+    with instrumentation.span('read_ih') as span:
+        df_ih = pd.read_csv(args.inputfile_ih, sep=args.delimiter_ih, nrows=args.limit,on_bad_lines='warn')
+        print('Read {} IH lines from: {}'.format(len(df_ih), args.inputfile_ih))
+        span['rows'] = len(df_ih)
 
     # 1.3 Read geonames data file ===========================================================
-    df_gn = pd.read_csv(args.inputfile_geonames, sep=args.delimiter_geonames, nrows=args.limit,on_bad_lines='warn', names=GEONAMES_COLUMNS)
-    print('Read {} geonames lines from: {}'.format(len(df_gn), args.inputfile_geonames))
-    df_gn.drop(df_gn[df_gn['feature code']!='PPLC'].index,inplace=True)
-    print('Retained {} geonames capital city lines'.format(len(df_gn)))
+    with instrumentation.span('read_geonames') as span:
+        df_gn = pd.read_csv(args.inputfile_geonames, sep=args.delimiter_geonames, nrows=args.limit,on_bad_lines='warn', names=GEONAMES_COLUMNS)
+        print('Read {} geonames lines from: {}'.format(len(df_gn), args.inputfile_geonames))
+        df_gn.drop(df_gn[df_gn['feature code']!='PPLC'].index,inplace=True)
+        print('Retained {} geonames capital city lines'.format(len(df_gn)))
+        span['rows'] = len(df_gn)
 
     ###########################################################################
     # 2. Process publishingOrgKey and join
     ###########################################################################
     # Pass all publishingOrgKey values to get organization metadata from registry
-    metadata = {key: getOrganizationData(key) for key in df.publishingOrgKey.unique()}
+    with instrumentation.span('registry_lookup') as span:
+        transport = PygbifTransport() if args.registry_url is None else HttpTransport(args.registry_url)
+        cache = None if args.registry_cache is None else OrganizationCache(args.registry_cache, ttl_days=args.registry_cache_ttl_days)
+        metadata = getOrganizationsData(df.publishingOrgKey.unique(), transport=transport, cache=cache, workers=args.registry_workers)
+        span['rows'] = len(metadata)
     # Make a dataframe with the data from the registry
     dfm=pd.DataFrame.from_dict(metadata).T
     # Join to original occurrence oriented dataframe    
@@ -88,36 +104,40 @@ def main():
     ###########################################################################
     #
     # 3.1 Using IH - first on title, then on city =============================
-    for (local_column, ih_column) in {'title':'organization','city':'physicalCity'}.items():
-        df = mapLocation(df, local_column, df_ih, ih_column)
+    with instrumentation.span('map_location_ih', rows=len(df)):
+        for (local_column, ih_column) in {'title':'organization','city':'physicalCity'}.items():
+            df = mapLocation(df, local_column, df_ih, ih_column)
     #
     # 3.2 Using geonames to get lat/long of capital city of country============
-    df = mapLocation(df, 'country', df_gn, 'country code')
+    with instrumentation.span('map_location_geonames', rows=len(df)):
+        df = mapLocation(df, 'country', df_gn, 'country code')
 
     ###########################################################################
     # 4. Output
     ###########################################################################
-    print('Outputting {} rows to {}'.format(len(df), args.outputfile))
-    df.to_csv(args.outputfile,sep='\t',index=False)
+    with instrumentation.span('write_output', rows=len(df)):
+        print('Outputting {} rows to {}'.format(len(df), args.outputfile))
+        writeTable(df, args.outputfile, format=args.format, schema=PUBLISHER_LOCATIONS_SCHEMA)
+    if args.spans_file is not None:
+        instrumentation.write(args.spans_file)
 
 def mapLocation(df, local_column, df_lookup, lookup_column, lat_column='latitude', long_column='longitude'):
-    location_mapper = dict()
     # Establish a mask to find records with no lat/long
-    coordinates_missing_mask=df.latitude.isnull()&df.longitude.isnull()
-    # Loop over records with missing lat/long, try to find matches in IH on link_column:
-    for local_value in df[coordinates_missing_mask][local_column].unique():
-        mask = (df_lookup[lookup_column]==local_value)
-        if len(df_lookup[mask]) > 0:
-            # Save in mapper data structure
-            location_mapper[local_value] = (df_lookup[mask].head(n=1)[lat_column].iloc[0],df_lookup[mask].head(n=1)[long_column].iloc[0])
-    # Map IH derived lat/long data to temporary column
-    df.loc[coordinates_missing_mask,'location_temp']=df[coordinates_missing_mask][local_column].map(location_mapper)
-    # Read values from temp column into permanent lat/long home
-    coordinates_missing_mask = df.location_temp.notnull()
-    df.loc[coordinates_missing_mask,'latitude']=df[coordinates_missing_mask].location_temp.apply(lambda x: x[0])
-    df.loc[coordinates_missing_mask,'longitude']=df[coordinates_missing_mask].location_temp.apply(lambda x: x[1])
-    # Drop temporary column
-    df.drop(columns=['location_temp'],inplace=True)
+    coordinates_missing_mask=(df.latitude.isnull()&df.longitude.isnull()).to_numpy()
+    # Index the lookup table on the first occurrence of each (non null) value
+    # of lookup_column, and find records with missing lat/long which match 
+    # one of these on local_column
+    df_index = (df_lookup.loc[df_lookup[lookup_column].notnull(),[lookup_column,lat_column,long_column]]
+                    .drop_duplicates(subset=lookup_column)
+                    .set_index(lookup_column))
+    local_values = df[local_column][coordinates_missing_mask]
+    found_mask = local_values.isin(df_index.index).to_numpy()
+    positions = df_index.index.get_indexer(local_values[found_mask])
+    # Copy lat/long from the matched lookup records
+    update_mask = coordinates_missing_mask.copy()
+    update_mask[coordinates_missing_mask] = found_mask
+    df.loc[update_mask,'latitude']=df_index[lat_column].to_numpy()[positions]
+    df.loc[update_mask,'longitude']=df_index[long_column].to_numpy()[positions]
     return df
 
 if __name__ == '__main__':
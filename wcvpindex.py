@@ -0,0 +1,125 @@
+import pandas as pd
+import numpy as np
+import argparse
+import hashlib
+import json
+import os
+from gbif2wcvp import MATCH_CONFIGURATIONS, WCVP_MATCH_COLUMNS, buildAcceptedIndex, encodeColumn, prepareWcvpNames, readWcvpNames
+from tableio import WCVP_NAMES_SCHEMA, readTable
+
+# A compiled index of the WCVP names, built once and reused by each run of
+# gbif2wcvp.py. It holds the prepared names (only the columns used in
+# matching and output, stored as parquet so that strings are dictionary
+# encoded), the integer codes and categories of each match key column, and
+# the row position of the accepted name of each name. The codes and accepted
+# name positions are stored as .npy files, which are memory mapped on load.
+# The index is keyed on the checksum of the WCVP source file, so it is
+# rebuilt when that changes.
+
+INDEX_VERSION=2
+
+MANIFEST_FILENAME='manifest.json'
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputfile_wcvp", type=str)
+    parser.add_argument('--delimiter_wcvp', type=str, default='|')
+    parser.add_argument("--force", action='store_true', help='Rebuild the index even if it is up to date')
+    parser.add_argument("outputdir", type=str, help='Directory to write the index to')
+    args = parser.parse_args(argv)
+
+    checksum = fileChecksum(args.inputfile_wcvp)
+    if not args.force and readManifest(args.outputdir, checksum, args.delimiter_wcvp) is not None:
+        print('WCVP index in {} is up to date with {}'.format(args.outputdir, args.inputfile_wcvp))
+        return
+    df_wcvp, encodings, accepted_positions = buildWcvpIndex(args.inputfile_wcvp, args.delimiter_wcvp)
+    writeWcvpIndex(args.outputdir, df_wcvp, encodings, accepted_positions, checksum, args.delimiter_wcvp)
+    print('Wrote WCVP index of {} names to {}'.format(len(df_wcvp), args.outputdir))
+
+def fileChecksum(filepath, blocksize=2**20):
+    checksum = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def indexKeyColumns(match_configurations=MATCH_CONFIGURATIONS):
+    # The WCVP columns which the match stages use as keys, in first use order
+    key_cols = []
+    for match_configuration in match_configurations:
+        for column in match_configuration['match_cols'] + [match_configuration['wcvp_name_source']]:
+            if column not in key_cols:
+                key_cols.append(column)
+    return key_cols
+
+def buildWcvpIndex(filepath, sep='|'):
+    # Returns the prepared WCVP names, the encodings (categories and codes) of
+    # the match key columns and the accepted name positions
+    df_wcvp = readWcvpNames(filepath, sep=sep)
+    print('Read {} WCVP lines from: {}'.format(len(df_wcvp), filepath))
+    df_wcvp = prepareWcvpNames(df_wcvp)[WCVP_MATCH_COLUMNS].reset_index(drop=True)
+    encodings = dict()
+    for column in indexKeyColumns():
+        encodeColumn(df_wcvp, column, encodings)
+    accepted_positions = buildAcceptedIndex(df_wcvp)
+    return df_wcvp, encodings, accepted_positions
+
+def writeWcvpIndex(indexdir, df_wcvp, encodings, accepted_positions, checksum, sep='|'):
+    os.makedirs(indexdir, exist_ok=True)
+    # Remove the manifest first, so that a partly written index is never read
+    manifest_filepath = os.path.join(indexdir, MANIFEST_FILENAME)
+    if os.path.exists(manifest_filepath):
+        os.remove(manifest_filepath)
+    df_wcvp.to_parquet(os.path.join(indexdir, 'names.parquet'), index=False)
+    np.save(os.path.join(indexdir, 'accepted_positions.npy'), np.asarray(accepted_positions, dtype=np.int64))
+    for i, (column, (categories, codes)) in enumerate(encodings.items()):
+        pd.DataFrame({'category': categories}).to_parquet(os.path.join(indexdir, 'categories-{}.parquet'.format(i)), index=False)
+        np.save(os.path.join(indexdir, 'codes-{}.npy'.format(i)), codes)
+    manifest = {'version': INDEX_VERSION
+                ,'checksum': checksum
+                ,'delimiter': sep
+                ,'rows': len(df_wcvp)
+                ,'key_cols': list(encodings.keys())}
+    with open(manifest_filepath, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+def readManifest(indexdir, checksum, sep='|'):
+    # Returns the manifest of the index, or None if there is no index or it
+    # was built from a different file (or by a different version)
+    try:
+        with open(os.path.join(indexdir, MANIFEST_FILENAME), encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != INDEX_VERSION or manifest.get('checksum') != checksum or manifest.get('delimiter') != sep:
+        return None
+    return manifest
+
+def readWcvpIndex(indexdir, manifest):
+    df_wcvp = readTable(os.path.join(indexdir, 'names.parquet'), format='parquet', schema=WCVP_NAMES_SCHEMA)
+    accepted_positions = np.load(os.path.join(indexdir, 'accepted_positions.npy'), mmap_mode='r')
+    encodings = dict()
+    for i, column in enumerate(manifest['key_cols']):
+        categories = pd.Index(readTable(os.path.join(indexdir, 'categories-{}.parquet'.format(i)), format='parquet').category)
+        encodings[column] = (categories, np.load(os.path.join(indexdir, 'codes-{}.npy'.format(i)), mmap_mode='r'))
+    return df_wcvp, encodings, accepted_positions
+
+def loadWcvpIndex(filepath, indexdir, sep='|', build=True):
+    # Returns the prepared WCVP names, key column encodings and accepted name
+    # positions from the index in indexdir, (re)building it first if it is
+    # missing or out of date with the WCVP file (or, if build is False,
+    # raising an error)
+    checksum = fileChecksum(filepath)
+    manifest = readManifest(indexdir, checksum, sep)
+    if manifest is None and not build:
+        raise RuntimeError('WCVP index in {} is missing or out of date with {}, build it with wcvpindex.py'.format(indexdir, filepath))
+    if manifest is None:
+        print('WCVP index in {} is missing or out of date, building it from {}'.format(indexdir, filepath))
+        writeWcvpIndex(indexdir, *buildWcvpIndex(filepath, sep), checksum, sep)
+        manifest = readManifest(indexdir, checksum, sep)
+    df_wcvp, encodings, accepted_positions = readWcvpIndex(indexdir, manifest)
+    print('Read WCVP index of {} names from: {}'.format(len(df_wcvp), indexdir))
+    return df_wcvp, encodings, accepted_positions
+
+if __name__ == '__main__':
+    main()
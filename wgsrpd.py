@@ -0,0 +1,31 @@
+import pandas as pd
+
+# The TDWG World Geographical Scheme for Recording Plant Distributions
+# (WGSRPD) hierarchy: each level 3 area is within a level 2 region, which is
+# within a level 1 continent. The hierarchy is small (a few hundred areas),
+# so it is built once per analysis, and level 3 codes are mapped to higher
+# levels via their category codes.
+
+WGSRPD_LEVELS=['area_code_l3','region_code_l2','continent_code_l1']
+
+def buildHierarchy(df):
+    # Returns a dataframe indexed by (categorical) area_code_l3 with the
+    # region_code_l2 and continent_code_l1 of each area, from a dataframe
+    # with these columns (eg WCVP distributions). The last occurrence of
+    # each area is used. Rows are sorted by area, so are in the order of the
+    # categories
+    # (area codes read as categories are converted back to text, so that the
+    # categories are only those of the areas present)
+    df_hierarchy = (df.loc[df.area_code_l3.notnull(),WGSRPD_LEVELS]
+                    .astype({'area_code_l3':object})
+                    .drop_duplicates(subset='area_code_l3', keep='last')
+                    .sort_values('area_code_l3'))
+    df_hierarchy.index = pd.CategoricalIndex(df_hierarchy.pop('area_code_l3'))
+    return df_hierarchy
+
+def mapAreaCodes(area_codes, df_hierarchy, level):
+    # Returns the code of the given (higher) level for each of a series of
+    # level 3 area codes. Codes not in the hierarchy (or null) map to null
+    codes = pd.Categorical(area_codes, categories=df_hierarchy.index.categories).codes
+    values = pd.api.extensions.take(df_hierarchy[level].to_numpy(), codes, allow_fill=True)
+    return pd.Series(values, index=area_codes.index, name=level)